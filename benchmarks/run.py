@@ -0,0 +1,338 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Runs the Worker end to end against moto S3 and SQS and an in-process SFTP server, for each scenario,
+and reports files/s, MB/s, per file latency percentiles and peak RSS.
+
+    python benchmarks/run.py --scenario small-files --latency-ms 40 --bandwidth-mbps 100 \
+        --worker-options '{"concurrency": 4}' --output results.json
+
+Use ``--compare`` with the output of a previous run, for example on master, to print the differences.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import monotonic, time
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.abspath(f"{here}/.."))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_EMF_ENVIRONMENT", "Local")
+
+import boto3
+from moto import mock_aws
+from scenarios import SCENARIOS, Scenario
+from sftp_server import LocalSFTPServer
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.worker import Worker
+
+MB = 1024 * 1024
+BUCKET = "s3-to-sftp-benchmark"
+REMOTE_PATH = "benchmark"
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size of the process, from /proc on Linux, else the peak from getrusage.
+    """
+    try:
+        with open("/proc/self/statm") as statm_fd:
+            return int(statm_fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RSSSampler(Thread):
+    """
+    Samples the RSS every ``interval`` seconds, to get its peak over the worker run only.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.baseline = rss_bytes()
+        self.peak = self.baseline
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+
+class RepeatingReader:
+    """
+    File-like object returning ``size`` bytes made of a repeated random block, to upload large objects
+    without holding them in memory.
+    """
+
+    block = os.urandom(MB)
+
+    def __init__(self, size: int):
+        self.remaining = size
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b""
+        while len(data) < size:
+            start = self.offset % len(self.block)
+            piece = self.block[start : start + size - len(data)]
+            self.offset += len(piece)
+            data += piece
+        self.remaining -= len(data)
+        return data
+
+
+class BenchmarkWorker(Worker):
+    """
+    Records when each file transfer completes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.completed_at: dict = {}
+
+    def complete_transfer(self, file_to_transfer) -> bool:
+        completed = super().complete_transfer(file_to_transfer)
+        if completed:
+            self.completed_at[file_to_transfer.file_name] = time()
+        return completed
+
+
+def percentile(values: list, rank: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(rank / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def stop_when_done(worker: Worker, sqs, queue_url: str, timeout: float) -> None:
+    deadline = monotonic() + timeout
+    while monotonic() < deadline and worker.keep_running:
+        attributes = sqs.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=[
+                "ApproximateNumberOfMessages",
+                "ApproximateNumberOfMessagesNotVisible",
+            ],
+        )["Attributes"]
+        if (
+            attributes["ApproximateNumberOfMessages"] == "0"
+            and attributes["ApproximateNumberOfMessagesNotVisible"] == "0"
+        ):
+            break
+        Event().wait(0.2)
+    worker.keep_running = 0
+
+
+def run_scenario(
+    scenario: Scenario,
+    latency: float,
+    bandwidth: float,
+    worker_options: dict,
+    timeout: float,
+) -> dict:
+    with TemporaryDirectory() as sftp_root, mock_aws():
+        os.mkdir(f"{sftp_root}/{REMOTE_PATH}")
+        sftp_server = LocalSFTPServer(sftp_root, latency, bandwidth).start()
+        session = boto3.session.Session()
+        s3 = session.client("s3")
+        sqs = session.client("sqs")
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": session.region_name},
+        )
+        queue_url = sqs.create_queue(
+            QueueName="s3-to-sftp-benchmark",
+            Attributes={"VisibilityTimeout": str(int(timeout))},
+        )["QueueUrl"]
+        files = scenario.files()
+        for key, size in files:
+            s3.upload_fileobj(RepeatingReader(size), BUCKET, key)
+        sent_at: dict = {}
+        for batch_start in range(0, len(files), 10):
+            entries = []
+            for index, (key, size) in enumerate(files[batch_start : batch_start + 10]):
+                body = {
+                    "Records": [
+                        {
+                            "eventName": "ObjectCreated:Put",
+                            "s3": {
+                                "bucket": {"name": BUCKET},
+                                "object": {"key": key, "size": size},
+                            },
+                        }
+                    ]
+                }
+                entries.append({"Id": str(index), "MessageBody": json.dumps(body)})
+                sent_at[key] = time()
+            sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+
+        sftp_info = dict(sftp_server.connection_details, default_path=REMOTE_PATH)
+        worker = BenchmarkWorker(queue_url, sftp_info, session=session)
+        options = {"poll_intervals": 1, "max_messages_batch": 10}
+        options.update(worker_options)
+        Thread(
+            target=stop_when_done,
+            args=(worker, sqs, queue_url, timeout),
+            daemon=True,
+        ).start()
+        sampler = RSSSampler()
+        sampler.start()
+        start = monotonic()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            worker.run(**options)
+        duration = monotonic() - start
+        sampler.stopped.set()
+        sftp_server.stop()
+
+        transferred = [
+            (key, size)
+            for key, size in files
+            if os.path.exists(f"{sftp_root}/{REMOTE_PATH}/{key}")
+            and os.path.getsize(f"{sftp_root}/{REMOTE_PATH}/{key}") == size
+        ]
+        latencies = [
+            worker.completed_at[key] - sent_at[key]
+            for key, _size in files
+            if key in worker.completed_at
+        ]
+        total_size = sum(size for _key, size in transferred)
+        return {
+            "scenario": scenario.name,
+            "files": len(files),
+            "transferred": len(transferred),
+            "duration": round(duration, 3),
+            "files_per_second": round(len(transferred) / duration, 2),
+            "mb_per_second": round(total_size / MB / duration, 2),
+            "latency_p50": round(percentile(latencies, 50), 3),
+            "latency_p99": round(percentile(latencies, 99), 3),
+            "peak_rss_mb": round(sampler.peak / MB, 1),
+            "rss_growth_mb": round((sampler.peak - sampler.baseline) / MB, 1),
+        }
+
+
+COLUMNS: list = [
+    "scenario",
+    "transferred",
+    "duration",
+    "files_per_second",
+    "mb_per_second",
+    "latency_p50",
+    "latency_p99",
+    "peak_rss_mb",
+]
+
+
+def print_results(results: list, baseline: dict = None) -> None:
+    print(" ".join(f"{column:>16}" for column in COLUMNS))
+    for result in results:
+        print(" ".join(f"{str(result[column]):>16}" for column in COLUMNS))
+        previous = (baseline or {}).get(result["scenario"])
+        if not previous:
+            continue
+        changes = []
+        for column in COLUMNS[2:]:
+            if previous.get(column):
+                change = (result[column] - previous[column]) / previous[column] * 100
+                changes.append(f"{change:>+15.1f}%")
+            else:
+                changes.append(f"{'-':>16}")
+        print(" ".join([f"{'vs baseline':>16}", f"{'':>16}"] + changes))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run. Repeat for several. Defaults to all.",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiplies the number of files."
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0, help="One way latency of the SFTP link."
+    )
+    parser.add_argument(
+        "--bandwidth-mbps",
+        type=float,
+        default=0,
+        help="SFTP link bandwidth, in Mbit/s. 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--worker-options",
+        type=json.loads,
+        default={},
+        help="Worker.run options, as JSON.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=600,
+        help="Maximum duration of each scenario, in seconds.",
+    )
+    parser.add_argument("--output", help="Writes the results to this JSON file.")
+    parser.add_argument(
+        "--compare", help="Results JSON file of a previous run to compare with."
+    )
+    args = parser.parse_args()
+    LOG.setLevel(logging.WARNING)
+    results = []
+    for name in args.scenario or SCENARIOS:
+        scenario = SCENARIOS[name].scaled(args.scale)
+        print(f"Running {name}: {scenario.description}", file=sys.stderr)
+        results.append(
+            run_scenario(
+                scenario,
+                latency=args.latency_ms / 1000,
+                bandwidth=args.bandwidth_mbps * 1000 * 1000 / 8,
+                worker_options=args.worker_options,
+                timeout=args.timeout,
+            )
+        )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare_fd:
+            baseline = {
+                result["scenario"]: result
+                for result in json.load(compare_fd)["results"]
+            }
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as output_fd:
+            json.dump(
+                {
+                    "latency_ms": args.latency_ms,
+                    "bandwidth_mbps": args.bandwidth_mbps,
+                    "scale": args.scale,
+                    "worker_options": args.worker_options,
+                    "results": results,
+                },
+                output_fd,
+                indent=2,
+            )
+    return (
+        0 if all(result["transferred"] == result["files"] for result in results) else 1
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
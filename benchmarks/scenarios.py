@@ -0,0 +1,81 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Benchmark scenarios: the S3 objects to transfer, one SQS message per object.
+"""
+
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass, replace
+
+KB = 1024
+MB = KB * KB
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    description: str
+    count: int
+    min_size: int
+    max_size: int
+    depth: int = 1
+    seed: int = 42
+
+    def scaled(self, scale: float) -> "Scenario":
+        return replace(self, count=max(1, int(self.count * scale)))
+
+    def files(self) -> list:
+        """
+        :return: the (key, size) of the objects, the same for every run. Sizes are spread evenly on a
+            logarithmic scale between the minimum and maximum sizes.
+        """
+        generator = random.Random(self.seed)
+        files = []
+        for index in range(self.count):
+            size = int(
+                self.min_size * (self.max_size / self.min_size) ** generator.random()
+            )
+            prefix = "/".join(
+                f"level-{level}-{generator.randrange(4)}" for level in range(self.depth)
+            )
+            files.append((f"{self.name}/{prefix}/file-{index:06d}.bin", size))
+        return files
+
+
+SCENARIOS: dict = {
+    scenario.name: scenario
+    for scenario in [
+        Scenario(
+            "small-files",
+            "500 files of 4 to 64 KB",
+            count=500,
+            min_size=4 * KB,
+            max_size=64 * KB,
+        ),
+        Scenario(
+            "huge-files",
+            "2 files of 256 to 512 MB",
+            count=2,
+            min_size=256 * MB,
+            max_size=512 * MB,
+        ),
+        Scenario(
+            "deep-prefixes",
+            "200 files of 64 KB, 8 directories deep",
+            count=200,
+            min_size=64 * KB,
+            max_size=64 * KB,
+            depth=8,
+        ),
+        Scenario(
+            "mixed-sizes",
+            "100 files of 1 KB to 64 MB",
+            count=100,
+            min_size=KB,
+            max_size=64 * MB,
+            depth=2,
+        ),
+    ]
+}
@@ -0,0 +1,237 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+In-process SFTP server storing the files in a local directory, behind a TCP proxy emulating the
+latency and bandwidth of the link to the partner's server.
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+from queue import Queue
+from threading import Event, Thread
+from time import monotonic, sleep
+
+import paramiko
+from paramiko import (
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTP_OK,
+    ServerInterface,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+)
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+
+
+class BenchmarkServer(ServerInterface):
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+
+class LocalHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+def local_sftp_interface(root: str) -> type:
+    """
+    Returns the SFTP server interface serving the files of the ``root`` directory.
+    """
+
+    class LocalSFTP(SFTPServerInterface):
+        def canonicalize(self, remote_path):
+            return os.path.normpath("/" + remote_path)
+
+        def local_path(self, remote_path):
+            return root + self.canonicalize(remote_path)
+
+        def stat(self, remote_path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(self.local_path(remote_path)))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+
+        lstat = stat
+
+        def list_folder(self, remote_path):
+            local_path = self.local_path(remote_path)
+            try:
+                return [
+                    SFTPAttributes.from_stat(
+                        os.stat(os.path.join(local_path, name)), name
+                    )
+                    for name in os.listdir(local_path)
+                ]
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+
+        def mkdir(self, remote_path, attr):
+            try:
+                os.mkdir(self.local_path(remote_path))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            return SFTP_OK
+
+        def remove(self, remote_path):
+            try:
+                os.remove(self.local_path(remote_path))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            return SFTP_OK
+
+        def rename(self, old_path, new_path):
+            try:
+                os.rename(self.local_path(old_path), self.local_path(new_path))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            return SFTP_OK
+
+        def open(self, remote_path, flags, attr):
+            try:
+                file_fd = os.open(self.local_path(remote_path), flags, 0o644)
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            if flags & os.O_WRONLY:
+                mode = "ab" if flags & os.O_APPEND else "wb"
+            elif flags & os.O_RDWR:
+                mode = "a+b" if flags & os.O_APPEND else "r+b"
+            else:
+                mode = "rb"
+            handle = LocalHandle(flags)
+            handle.readfile = handle.writefile = os.fdopen(file_fd, mode)
+            return handle
+
+    return LocalSFTP
+
+
+class LinkEmulator:
+    """
+    TCP proxy delaying each chunk of data by ``latency`` seconds, in each direction, and limiting the
+    throughput of each direction of each connection to ``bandwidth`` bytes per second.
+    Chunks are delayed, not the connection, so that pipelined requests are not serialized.
+    """
+
+    def __init__(self, target_port: int, latency: float = 0, bandwidth: float = 0):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stopped = Event()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def start(self) -> None:
+        Thread(target=self._accept, name="link-accept", daemon=True).start()
+
+    def _accept(self) -> None:
+        while not self.stopped.is_set():
+            client, _ = self.listener.accept()
+            server = socket.create_connection(("127.0.0.1", self.target_port))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._pump(client, server)
+            self._pump(server, client)
+
+    def _pump(self, source: socket.socket, destination: socket.socket) -> None:
+        chunks: Queue = Queue()
+
+        def receive():
+            while True:
+                try:
+                    data = source.recv(256 * 1024)
+                except OSError:
+                    data = b""
+                chunks.put((monotonic() + self.latency, data))
+                if not data:
+                    return
+
+        def send():
+            while True:
+                deliver_at, data = chunks.get()
+                delay = deliver_at - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                if not data:
+                    try:
+                        destination.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                if self.bandwidth:
+                    sleep(len(data) / self.bandwidth)
+                try:
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        Thread(target=receive, name="link-receive", daemon=True).start()
+        Thread(target=send, name="link-send", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.listener.close()
+
+
+class LocalSFTPServer:
+    """
+    Serves the ``root`` directory over SFTP on 127.0.0.1, through a :class:`LinkEmulator`.
+    Use ``port`` to connect.
+    """
+
+    def __init__(self, root: str, latency: float = 0, bandwidth: float = 0):
+        self.root = root
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.interface = local_sftp_interface(root)
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.link = LinkEmulator(self.listener.getsockname()[1], latency, bandwidth)
+        self.transports: list = []
+
+    @property
+    def port(self) -> int:
+        return self.link.port
+
+    @property
+    def connection_details(self) -> dict:
+        return {
+            "host": "127.0.0.1",
+            "port": self.port,
+            "username": USERNAME,
+            "password": PASSWORD,
+        }
+
+    def start(self) -> LocalSFTPServer:
+        Thread(target=self._accept, name="sftp-accept", daemon=True).start()
+        self.link.start()
+        return self
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, self.interface)
+            transport.start_server(server=BenchmarkServer())
+            self.transports.append(transport)
+
+    def stop(self) -> None:
+        self.link.stop()
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
@@ -8,7 +8,6 @@ from tempfile import TemporaryDirectory
 
 from s3_to_sftp import get_sftp_info
 from s3_to_sftp.logger import LOG
-from s3_to_sftp.worker import Worker
 
 MB: int = 1024**2
 TRANSFER_RATE: int = int(environ.get("TRANSFER_RATE", 1))
@@ -16,6 +15,43 @@ ERROR_MARGIN: int = int(environ.get("TRANSFER_MARGIN_PERCENT", 15))
 MAX_MESSAGES_BATCH = int(environ.get("SQS_MAX_MESSAGES", 10))
 ATTEMPT_INTERACTIVE_AUTH: bool = bool(environ.get("ATTEMPT_INTERACTIVE_AUTH", False))
 POLL_INTERVALS = int(environ.get("POLLING_INTERVAL", 10))
+STREAMING: bool = bool(environ.get("STREAMING_TRANSFER", False))
+STREAM_CHUNK_SIZE: int = int(environ.get("STREAM_CHUNK_SIZE", 8))
+CONCURRENCY: int = int(environ.get("CONCURRENCY", 1))
+SFTP_CONNECTIONS: int = int(environ.get("SFTP_CONNECTIONS", 1))
+PREFETCH_SIZE: int = int(environ.get("PREFETCH_SIZE", 0))
+LARGE_FILE_THRESHOLD: int = int(environ.get("LARGE_FILE_THRESHOLD", 0))
+LARGE_FILE_CHUNK_SIZE: int = int(environ.get("LARGE_FILE_CHUNK_SIZE", 64))
+LARGE_FILE_FAN_OUT: int = int(environ.get("LARGE_FILE_FAN_OUT", 4))
+VISIBILITY_HEARTBEAT: int = int(environ.get("VISIBILITY_HEARTBEAT", 0))
+ADAPTIVE_RATE: bool = bool(environ.get("ADAPTIVE_TRANSFER_RATE", False))
+THROUGHPUT_STATE_FILE: str = environ.get("THROUGHPUT_STATE_FILE", None)
+ACK_FLUSH_INTERVAL: int = int(environ.get("ACK_FLUSH_INTERVAL", 5))
+SFTP_KEEPALIVE: int = int(environ.get("SFTP_KEEPALIVE", 30))
+SFTP_SPARE_CONNECTIONS: int = int(environ.get("SFTP_SPARE_CONNECTIONS", 0))
+EXISTING_FILES: str = environ.get("EXISTING_FILES", "overwrite")
+VERIFY_CHECKSUMS: bool = bool(environ.get("VERIFY_CHECKSUMS", False))
+CHECKSUM_SIDECAR: bool = bool(environ.get("CHECKSUM_SIDECAR", False))
+CHECKSUM_CHECK_FILE: bool = bool(environ.get("CHECKSUM_CHECK_FILE", False))
+METRICS_PORT: int = int(environ.get("METRICS_PORT", 0))
+WORKER_PROCESSES: int = int(environ.get("WORKER_PROCESSES", 1))
+SCHEDULE_POLICY: str = environ.get("SCHEDULE_POLICY", "fifo")
+SCHEDULE_PREFIX_DEPTH: int = int(environ.get("SCHEDULE_PREFIX_DEPTH", 1))
+RELEASE_LATE_MESSAGES: bool = bool(environ.get("RELEASE_LATE_MESSAGES", False))
+MAX_BANDWIDTH: float = float(environ.get("MAX_BANDWIDTH", 0))
+MAX_CONCURRENT_FILES: int = int(environ.get("MAX_CONCURRENT_FILES", 0))
+TRANSFER_JOURNAL: str = environ.get("TRANSFER_JOURNAL", None)
+BACKFILL_SOURCE: str = environ.get("BACKFILL_SOURCE", None)
+BACKFILL_CHECKPOINT: str = environ.get(
+    "BACKFILL_CHECKPOINT", "backfill-checkpoint.json"
+)
+BACKFILL_MODIFIED_AFTER: str = environ.get("BACKFILL_MODIFIED_AFTER", None)
+BACKFILL_MODIFIED_BEFORE: str = environ.get("BACKFILL_MODIFIED_BEFORE", None)
+BACKFILL_MIN_SIZE: float = float(environ.get("BACKFILL_MIN_SIZE", 0))
+BACKFILL_MAX_SIZE: float = float(environ.get("BACKFILL_MAX_SIZE", 0))
+BACKFILL_BATCH_SIZE: int = int(environ.get("BACKFILL_BATCH_SIZE", 0))
+SECRETS_CACHE_FILE: str = environ.get("SECRETS_CACHE_FILE", None)
+SECRETS_CACHE_TTL: int = int(environ.get("SECRETS_CACHE_TTL", 300))
 
 
 def get_queue_url() -> str:
@@ -27,6 +63,8 @@ def get_queue_url() -> str:
     if not queue_url:
         queue_name = environ.get("QUEUE_NAME", None)
         if queue_name and isinstance(queue_name, str):
+            from s3_to_sftp.worker import Worker
+
             return Worker.get_queue_url_from_name(queue_name)
     return queue_url
 
@@ -71,13 +109,266 @@ def s3_to_sftp():
         default=ATTEMPT_INTERACTIVE_AUTH,
         help="Enables automatic fallback use of the password for interactive auth. Rarely required.",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        required=False,
+        default=STREAMING,
+        help="Streams the files from S3 to the SFTP target without storing them on local disk.",
+    )
+    parser.add_argument(
+        "--stream-chunk-size",
+        type=int,
+        required=False,
+        default=STREAM_CHUNK_SIZE,
+        help="In MB, size of the chunks read from S3 and written to SFTP when streaming.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        required=False,
+        default=CONCURRENCY,
+        help="Number of files to transfer in parallel, each over its own SFTP session.",
+    )
+    parser.add_argument(
+        "--sftp-connections",
+        type=int,
+        required=False,
+        default=SFTP_CONNECTIONS,
+        help="Number of SSH connections the SFTP sessions are spread across. Defaults to 1 (multiplexed).",
+    )
+    parser.add_argument(
+        "--prefetch-size",
+        type=int,
+        required=False,
+        default=PREFETCH_SIZE,
+        help="In MB, how much to pull from S3 ahead of the file being uploaded to SFTP. 0 disables prefetching.",
+    )
+    parser.add_argument(
+        "--large-file-threshold",
+        type=int,
+        required=False,
+        default=LARGE_FILE_THRESHOLD,
+        help="In MB, size from which files are transferred in ranges written in parallel. 0 disables it.",
+    )
+    parser.add_argument(
+        "--large-file-chunk-size",
+        type=int,
+        required=False,
+        default=LARGE_FILE_CHUNK_SIZE,
+        help="In MB, size of the ranges large files are split into.",
+    )
+    parser.add_argument(
+        "--large-file-fan-out",
+        type=int,
+        required=False,
+        default=LARGE_FILE_FAN_OUT,
+        help="Number of SFTP channels writing the ranges of a large file in parallel.",
+    )
+    parser.add_argument(
+        "--visibility-heartbeat",
+        type=int,
+        required=False,
+        default=VISIBILITY_HEARTBEAT,
+        help="In seconds, interval at which the in-flight messages visibility is extended while the transfers"
+        " progress. Replaces the visibility estimate from --transfer-rate. 0 disables it.",
+    )
+    parser.add_argument(
+        "--adaptive-rate",
+        action="store_true",
+        required=False,
+        default=ADAPTIVE_RATE,
+        help="Learns the transfer rate from the transfers, per file size, to estimate transfers duration,"
+        " batch sizes and large files threshold. --transfer-rate is used until files were transferred.",
+    )
+    parser.add_argument(
+        "--throughput-state-file",
+        type=str,
+        required=False,
+        default=THROUGHPUT_STATE_FILE,
+        help="Path to the file where the learned transfer rates are stored, to start from on restart.",
+    )
+    parser.add_argument(
+        "--ack-flush-interval",
+        type=int,
+        required=False,
+        default=ACK_FLUSH_INTERVAL,
+        help="In seconds, how often the completed messages are deleted in batches. They are always deleted"
+        " at the end of each batch of messages. 0 only deletes at the end of batches.",
+    )
+    parser.add_argument(
+        "--sftp-keepalive",
+        type=int,
+        default=SFTP_KEEPALIVE,
+        help="In seconds, interval of the SSH keepalive messages. 0 disables keepalives.",
+    )
+    parser.add_argument(
+        "--sftp-spare-connections",
+        type=int,
+        default=SFTP_SPARE_CONNECTIONS,
+        help="Number of SFTP connections kept opened and ready to replace the ones that get closed.",
+    )
+    parser.add_argument(
+        "--existing-files",
+        choices=["overwrite", "skip", "resume"],
+        default=EXISTING_FILES,
+        help="What to do with files already on the SFTP server. skip does not transfer the files of the"
+        " same size and checksum, resume also completes the partial files.",
+    )
+    parser.add_argument(
+        "--verify-checksums",
+        action="store_true",
+        default=VERIFY_CHECKSUMS,
+        help="Computes the checksums of the files while transferred, and compares these with the S3 ones.",
+    )
+    parser.add_argument(
+        "--checksum-sidecar",
+        action="store_true",
+        default=CHECKSUM_SIDECAR,
+        help="Writes the SHA-256 of each file transferred to a .sha256 file next to it.",
+    )
+    parser.add_argument(
+        "--checksum-check-file",
+        action="store_true",
+        default=CHECKSUM_CHECK_FILE,
+        help="Compares the SHA-256 of the files transferred with the one computed by the SFTP server,"
+        " if it supports the check-file extension.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Port to serve the transfer phases durations on, in the OpenMetrics format, at /metrics."
+        " 0 disables it. With --processes, each worker uses the next port.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=WORKER_PROCESSES,
+        help="Number of worker processes polling the queue, each with its own SFTP connection(s)."
+        " Workers that exit are restarted.",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=["fifo", "sjf", "fair"],
+        default=SCHEDULE_POLICY,
+        help="Order of the files transfers within each batch. fifo follows the messages order, sjf transfers"
+        " the smallest files first, fair alternates between the S3 prefixes, smallest files first.",
+    )
+    parser.add_argument(
+        "--schedule-prefix-depth",
+        type=int,
+        default=SCHEDULE_PREFIX_DEPTH,
+        help="Number of folders of the object keys that make the prefixes alternated with --schedule fair.",
+    )
+    parser.add_argument(
+        "--release-late-messages",
+        action="store_true",
+        default=RELEASE_LATE_MESSAGES,
+        help="Releases the messages of the files not expected to be transferred before the queue visibility"
+        " timeout back to the queue, instead of holding these.",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        type=float,
+        default=MAX_BANDWIDTH,
+        help="In MB/s, bandwidth used at most to send the files to the SFTP target, unless set in its limits."
+        " 0 for no limit.",
+    )
+    parser.add_argument(
+        "--max-concurrent-files",
+        type=int,
+        default=MAX_CONCURRENT_FILES,
+        help="Number of files sent at once to the SFTP target at most, unless set in its limits. 0 for no limit.",
+    )
+    parser.add_argument(
+        "--journal",
+        default=TRANSFER_JOURNAL,
+        help="SQLite file recording the transfers in progress, to recover these when the worker restarts."
+        " With --processes, each worker uses its own file, suffixed with its index.",
+    )
+    parser.add_argument(
+        "--backfill",
+        metavar="s3://bucket/prefix",
+        default=BACKFILL_SOURCE,
+        help="Transfers the existing objects of the S3 prefix, instead of the files from the SQS queue, then exits.",
+    )
+    parser.add_argument(
+        "--backfill-checkpoint",
+        default=BACKFILL_CHECKPOINT,
+        help="File to record the backfill progress in, and to resume it from.",
+    )
+    parser.add_argument(
+        "--backfill-modified-after",
+        default=BACKFILL_MODIFIED_AFTER,
+        help="ISO 8601 date or datetime, UTC unless specified. Only backfills the objects modified since then.",
+    )
+    parser.add_argument(
+        "--backfill-modified-before",
+        default=BACKFILL_MODIFIED_BEFORE,
+        help="ISO 8601 date or datetime, UTC unless specified. Only backfills the objects modified before then.",
+    )
+    parser.add_argument(
+        "--backfill-min-size",
+        type=float,
+        default=BACKFILL_MIN_SIZE,
+        help="In MB, only backfills the objects of at least that size.",
+    )
+    parser.add_argument(
+        "--backfill-max-size",
+        type=float,
+        default=BACKFILL_MAX_SIZE,
+        help="In MB, only backfills the objects of at most that size. 0 for no limit.",
+    )
+    parser.add_argument(
+        "--backfill-batch-size",
+        type=int,
+        default=BACKFILL_BATCH_SIZE,
+        help="Number of objects transferred between two checkpoints. Defaults to 4 times --concurrency.",
+    )
+    parser.add_argument(
+        "--secrets-cache",
+        default=SECRETS_CACHE_FILE,
+        help="File to keep the secrets values in, for the workers started shortly after not to fetch these"
+        " again. The values are stored in plain text, readable by the owner only: keep it on a private volume.",
+    )
+    parser.add_argument(
+        "--secrets-cache-ttl",
+        type=int,
+        default=SECRETS_CACHE_TTL,
+        help="In seconds, how long the secrets values are read from --secrets-cache before fetched again.",
+    )
     args = parser.parse_args()
     if args.debug and LOG.hasHandlers():
         LOG.setLevel(logging.DEBUG)
         LOG.handlers[0].setLevel(logging.DEBUG)
     client_temp_dir = TemporaryDirectory()
-    worker = Worker(get_queue_url(), get_sftp_info(client_temp_dir))
-    worker.run(**vars(args))
+    sftp_info = get_sftp_info(
+        client_temp_dir,
+        secrets_cache=args.secrets_cache,
+        secrets_cache_ttl=args.secrets_cache_ttl,
+    )
+    if args.backfill:
+        from s3_to_sftp.backfill import BackfillWorker
+
+        worker = BackfillWorker(args.backfill, sftp_info)
+        summary = worker.run(**vars(args))
+        return 0 if summary["completed"] and not summary["failed"] else 1
+    if args.processes > 1:
+        from s3_to_sftp.supervisor import Supervisor
+
+        supervisor = Supervisor(
+            args.processes,
+            get_queue_url(),
+            sftp_info,
+            **vars(args),
+        )
+        supervisor.run()
+    else:
+        from s3_to_sftp.worker import Worker
+
+        worker = Worker(get_queue_url(), sftp_info)
+        worker.run(**vars(args))
 
 
 if __name__ == "__main__":
@@ -12,13 +12,11 @@ from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from tempfile import TemporaryDirectory
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from json import JSONDecodeError, loads
 from os import environ, path
 
-from boto3.session import Session
-from compose_x_common.aws.secrets_manager import SECRET_ARN_RE
-from jsonschema import validate
-
 from s3_to_sftp.logger import LOG
 
 __author__ = """John Preston"""
@@ -40,9 +38,39 @@ SFTP_CLIENT_KEY_PATH = "private_key"
 SFTP_CLIENT_KEY_PASSWORD = "private_key_pass"
 
 
+@lru_cache()
+def get_secrets_manager_client():
+    """
+    Secrets Manager client, created once and shared by the secrets fetched, in parallel.
+    """
+    from boto3.session import Session
+
+    return Session().client("secretsmanager")
+
+
+@lru_cache()
+def get_secret_validator():
+    """
+    Validator of the SFTP details against secret-format.json, with the schema loaded and checked once.
+    """
+    from jsonschema import Draft7Validator
+
+    with open(
+        f"{path.abspath(path.dirname(__file__))}/secret-format.json"
+    ) as secret_format_fd:
+        secret_schema = json.loads(secret_format_fd.read())
+    Draft7Validator.check_schema(secret_schema)
+    return Draft7Validator(secret_schema)
+
+
+def is_secret_arn(value: str) -> bool:
+    from compose_x_common.aws.secrets_manager import SECRET_ARN_RE
+
+    return bool(value and isinstance(value, str) and SECRET_ARN_RE.match(value))
+
+
 def get_sftp_details_from_secrets_manager(secret_arn: str) -> dict:
-    session = Session()
-    client = session.client("secretsmanager")
+    client = get_secrets_manager_client()
     try:
         secret_r = client.get_secret_value(SecretId=secret_arn)
         return secret_r
@@ -72,40 +100,113 @@ def get_sftp_details_from_env(sftp_details: dict) -> None:
                 print(f"Override value for {key} from environment variable")
 
 
+def get_secrets(
+    secret_arns: list[str], cache_file: str = None, cache_ttl: int = None
+) -> dict:
+    """
+    Function fetching the secrets values, all at once. With ``cache_file``, the values fetched less than
+    ``cache_ttl`` seconds ago are read from it instead, and the ones fetched are added to it.
+
+    :return: the secrets values, by ARN
+    """
+    secret_arns = list(dict.fromkeys(secret_arns))
+    cache = None
+    secrets: dict = {}
+    if cache_file:
+        from s3_to_sftp.secrets_cache import DEFAULT_TTL, SecretsCache
+
+        cache = SecretsCache(
+            cache_file, DEFAULT_TTL if cache_ttl is None else cache_ttl
+        )
+        secrets = cache.load(secret_arns)
+        if secrets:
+            LOG.info(f"Loaded {len(secrets)} secret(s) from {cache_file}")
+    to_fetch = [secret_arn for secret_arn in secret_arns if secret_arn not in secrets]
+    if not to_fetch:
+        return secrets
+    # boto3 creating clients is not thread safe: created here, shared by the threads fetching the secrets.
+    get_secrets_manager_client()
+    with ThreadPoolExecutor(
+        max_workers=len(to_fetch), thread_name_prefix="secrets"
+    ) as executor:
+        fetched = dict(
+            zip(
+                to_fetch,
+                executor.map(
+                    lambda secret_arn: get_sftp_details_from_secrets_manager(
+                        secret_arn
+                    )["SecretString"],
+                    to_fetch,
+                ),
+            )
+        )
+    if cache:
+        cache.save(fetched)
+    secrets.update(fetched)
+    return secrets
+
+
 def get_sftp_ssh_key_details(
-    sftp_connection_details: dict, temp_directory: TemporaryDirectory
+    sftp_connection_details: dict,
+    temp_directory: TemporaryDirectory,
+    secrets: dict = None,
 ) -> None:
+    """
+    Sets the private key and passphrase from Secrets Manager. The values already fetched are taken
+    from ``secrets``, by ARN.
+    """
+    if secrets is None:
+        secrets = {}
     client_key = environ.get(PRIVATE_KEY_SECRET_ARN, None)
-    if client_key and SECRET_ARN_RE.match(client_key):
-        private_key = get_sftp_details_from_secrets_manager(client_key)
+    if is_secret_arn(client_key):
+        if client_key not in secrets:
+            secrets.update(get_secrets([client_key]))
         temp_key_path = f"{temp_directory.name}/private_key"
         with open(temp_key_path, "w") as private_key_fd:
-            private_key_fd.write(private_key["SecretString"])
+            private_key_fd.write(secrets[client_key])
             LOG.info(f"Pulled private key. Stored in {temp_key_path}")
         sftp_connection_details[SFTP_CLIENT_KEY_PATH] = temp_key_path
     client_key_passphrase = environ.get(PRIVATE_KEY_PASSPHRASE_SECRET_ARN, None)
-    if client_key_passphrase and SECRET_ARN_RE.match(client_key_passphrase):
-        sftp_connection_details[
-            SFTP_CLIENT_KEY_PASSWORD
-        ] = get_sftp_details_from_secrets_manager(client_key_passphrase)["SecretString"]
+    if is_secret_arn(client_key_passphrase):
+        if client_key_passphrase not in secrets:
+            secrets.update(get_secrets([client_key_passphrase]))
+        sftp_connection_details[SFTP_CLIENT_KEY_PASSWORD] = secrets[
+            client_key_passphrase
+        ]
         LOG.info("Private key passphrase pulled from Secrets Manager")
 
 
-def get_sftp_info(temp_directory: TemporaryDirectory) -> dict:
+def get_sftp_info(
+    temp_directory: TemporaryDirectory,
+    secrets_cache: str = None,
+    secrets_cache_ttl: int = None,
+) -> dict:
     """
-    Function retrieving the SFTP target information from environment variable.
+    Function retrieving the SFTP target information from environment variable. The secrets set by ARN
+    are fetched in parallel, or read from the ``secrets_cache`` file for ``secrets_cache_ttl`` seconds.
 
     :return: SFTP connection details
     :rtype: dict
     """
     sftp_connection_details: dict = {}
-    get_sftp_ssh_key_details(sftp_connection_details, temp_directory)
     sftp_info = environ.get(SFTP_DETAILS_ENV_NAME, None)
-    if sftp_info and isinstance(sftp_info, str) and SECRET_ARN_RE.match(sftp_info):
-        try:
-            sftp_details = loads(
-                get_sftp_details_from_secrets_manager(sftp_info)["SecretString"]
+    secrets = get_secrets(
+        [
+            secret_arn
+            for secret_arn in (
+                environ.get(PRIVATE_KEY_SECRET_ARN, None),
+                environ.get(PRIVATE_KEY_PASSPHRASE_SECRET_ARN, None),
+                sftp_info,
             )
+            if is_secret_arn(secret_arn)
+        ],
+        cache_file=secrets_cache,
+        cache_ttl=secrets_cache_ttl,
+    )
+    get_sftp_ssh_key_details(sftp_connection_details, temp_directory, secrets)
+    if is_secret_arn(sftp_info):
+        try:
+            sftp_details = loads(secrets[sftp_info])
             LOG.info("Loaded sftp details from Secrets Manager")
         except JSONDecodeError:
             print("sftp_details in secrets manager are not in a valid JSON Format")
@@ -123,17 +224,19 @@ def get_sftp_info(temp_directory: TemporaryDirectory) -> dict:
         raise ValueError(f"Unable to get secrets details from {SFTP_DETAILS_ENV_NAME}")
     sftp_connection_details.update(sftp_details)
     get_sftp_details_from_env(sftp_connection_details)
-    with open(
-        f"{path.abspath(path.dirname(__file__))}/secret-format.json"
-    ) as secret_format_fd:
-        secret_schema = json.loads(secret_format_fd.read())
-    validate(sftp_connection_details, secret_schema)
+    validator = get_secret_validator()
+    validator.validate(sftp_connection_details)
+    from s3_to_sftp.routing import get_targets_settings
+
+    targets, _ = get_targets_settings(sftp_connection_details)
+    for target_name, target_details in targets.items():
+        validator.validate(target_details)
+        LOG.info(
+            f"SFTP Connection {target_name}: "
+            f"{target_details['username']}@"
+            f"{target_details['host']}:"
+            f"{target_details['port']}"
+        )
     LOG.info("Successfully retrieved SFTP session details")
-    LOG.info(
-        "SFTP Connection: "
-        f"{sftp_connection_details['username']}@"
-        f"{sftp_connection_details['host']}:"
-        f"{sftp_connection_details['port']}"
-    )
     LOG.debug(sftp_connection_details.keys())
     return sftp_connection_details
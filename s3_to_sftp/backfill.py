@@ -0,0 +1,334 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Transfers the existing objects of an S3 prefix, listed from S3 instead of received from SQS, with
+a checkpoint to resume an interrupted backfill from.
+"""
+
+from __future__ import annotations
+
+import json
+from datetime import datetime, timezone
+from itertools import islice
+from os import makedirs, path, replace
+from time import monotonic
+from typing import Iterator, Union
+from urllib.parse import quote_plus
+
+from compose_x_common.compose_x_common import set_else_none
+
+from s3_to_sftp import worker as worker_module
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.transfer_file import MB, TransferMessage
+from s3_to_sftp.worker import Worker
+
+DEFAULT_CHECKPOINT_FILE = "backfill-checkpoint.json"
+
+
+def parse_s3_url(s3_url: str) -> tuple[str, str]:
+    """
+    :return: the bucket and the prefix of ``s3://bucket/prefix``
+    """
+    if not s3_url.startswith("s3://"):
+        raise ValueError(
+            "Backfill source must be an s3://bucket/prefix URL. Got", s3_url
+        )
+    bucket, _, prefix = s3_url[len("s3://") :].partition("/")
+    if not bucket:
+        raise ValueError("Backfill source has no bucket", s3_url)
+    return bucket, prefix
+
+
+def parse_datetime(value: Union[str, datetime, None]) -> Union[datetime, None]:
+    """
+    Parses an ISO 8601 date or datetime. Assumed UTC without timezone.
+    """
+    if not value:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def list_objects(
+    s3_client,
+    bucket: str,
+    prefix: str = "",
+    start_after: str = None,
+    modified_after: datetime = None,
+    modified_before: datetime = None,
+    min_size: int = 0,
+    max_size: int = 0,
+    stats: dict = None,
+) -> Iterator[dict]:
+    """
+    Lists the objects of the prefix, in key order, a page at a time, and yields the ones matching the
+    filters. Folder markers are ignored. ``stats["listed"]`` counts the objects listed.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    options = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        options["StartAfter"] = start_after
+    for page in paginator.paginate(**options):
+        for s3_object in page.get("Contents", []):
+            if stats is not None:
+                stats["listed"] += 1
+            if s3_object["Key"].endswith("/"):
+                continue
+            if modified_after and s3_object["LastModified"] < modified_after:
+                continue
+            if modified_before and s3_object["LastModified"] >= modified_before:
+                continue
+            if s3_object["Size"] < min_size or (
+                max_size and s3_object["Size"] > max_size
+            ):
+                continue
+            yield s3_object
+
+
+class BackfillMessage:
+    """
+    Stands for the SQS message of an object listed, with the body of an S3 event notification,
+    so that it is transferred as if received from the queue.
+    """
+
+    attributes: dict = {}
+
+    def __init__(self, bucket: str, s3_object: dict):
+        self.key = s3_object["Key"]
+        self.message_id = self.receipt_handle = f"{bucket}/{self.key}"
+        self.body = json.dumps(
+            {
+                "Records": [
+                    {
+                        "eventName": "ObjectCreated:Backfill",
+                        "s3": {
+                            "bucket": {"name": bucket},
+                            "object": {
+                                "key": quote_plus(self.key),
+                                "size": s3_object["Size"],
+                                "eTag": s3_object.get("ETag"),
+                            },
+                        },
+                    }
+                ]
+            }
+        )
+
+
+class BackfillCheckpoint:
+    """
+    Takes the acknowledgements of the transfers instead of the SQS batcher, and records the progress of
+    the backfill in ``checkpoint_file``: the key all the objects up to which were processed, the objects
+    that failed, and the statistics so far. The objects listed are only counted for the current run.
+    """
+
+    def __init__(self, checkpoint_file: str, source: str):
+        self.checkpoint_file = checkpoint_file
+        self.source = source
+        self.start_after: str = None
+        self.failed: list = []
+        self.stats: dict = {
+            "listed": 0,
+            "transferred": 0,
+            "skipped": 0,
+            "failed": 0,
+            "bytes": 0,
+        }
+        self.done: set = set()
+        self.released: set = set()
+
+    def load(self) -> None:
+        if not path.exists(self.checkpoint_file):
+            return
+        try:
+            with open(self.checkpoint_file) as checkpoint_fd:
+                checkpoint = json.load(checkpoint_fd)
+        except (OSError, ValueError) as error:
+            LOG.warning(f"Unable to load the checkpoint {self.checkpoint_file}")
+            LOG.exception(error)
+            return
+        if checkpoint.get("source") != self.source:
+            LOG.warning(
+                f"{self.checkpoint_file} is the checkpoint of {checkpoint.get('source')}. Starting over."
+            )
+            return
+        self.start_after = checkpoint.get("start_after")
+        self.failed = checkpoint.get("failed", [])
+        self.stats.update(checkpoint.get("stats", {}))
+        self.stats["listed"] = 0
+        LOG.info(f"Resuming backfill of {self.source} after {self.start_after}")
+
+    def save(self) -> None:
+        checkpoint = {
+            "source": self.source,
+            "start_after": self.start_after,
+            "failed": self.failed,
+            "stats": self.stats,
+        }
+        try:
+            makedirs(path.dirname(path.abspath(self.checkpoint_file)), exist_ok=True)
+            temp_file = f"{self.checkpoint_file}.tmp"
+            with open(temp_file, "w") as checkpoint_fd:
+                json.dump(checkpoint, checkpoint_fd)
+            replace(temp_file, self.checkpoint_file)
+        except OSError as error:
+            LOG.warning(f"Unable to save the checkpoint {self.checkpoint_file}")
+            LOG.exception(error)
+
+    def delete(self, message) -> None:
+        self.done.add(message.receipt_handle)
+
+    def change_visibility(self, message, timeout: int) -> None:
+        if not timeout:
+            self.released.add(message.receipt_handle)
+
+    def flush(self) -> list:
+        return []
+
+    def advance(
+        self, transfer_messages: list[TransferMessage], stopped: bool = False
+    ) -> bool:
+        """
+        Records the results of a batch, in key order. The objects released are failed, as the ones not
+        routed or with their SFTP target unreachable, unless the worker ``stopped``: the objects from the
+        first released on were then not processed, and the backfill is to be resumed before these.
+
+        :return: whether all the objects of the batch were processed
+        """
+        for transfer_message in transfer_messages:
+            message = transfer_message.message
+            if stopped and message.receipt_handle in self.released:
+                self.save()
+                return False
+            for transfer_file in transfer_message.files:
+                if message.receipt_handle not in self.done:
+                    self.stats["failed"] += 1
+                    self.failed.append(message.key)
+                elif transfer_file.file_transfer_status == "SFTP_SKIPPED":
+                    self.stats["skipped"] += 1
+                else:
+                    self.stats["transferred"] += 1
+                    self.stats["bytes"] += (
+                        transfer_file.file_size - transfer_file.resume_offset
+                    )
+            self.start_after = message.key
+        self.done.clear()
+        self.released.clear()
+        self.save()
+        return True
+
+
+class BackfillWorker(Worker):
+    """
+    Transfers the objects of ``s3_url``, in batches of ``backfill_batch_size``, with the same transfer
+    options as the SQS worker. The checkpoint is saved after each batch.
+    """
+
+    def __init__(self, s3_url: str, sftp_info: dict, session=None):
+        super().__init__(None, sftp_info, session=session)
+        self.s3_url = s3_url
+        self.bucket, self.prefix = parse_s3_url(s3_url)
+
+    @property
+    def queue_name(self) -> str:
+        return f"backfill-{self.bucket}"
+
+    def run(self, **kwargs) -> dict:
+        """
+        :return: the backfill statistics
+        """
+        kwargs["release_late_messages"] = False
+        self.prepare(**kwargs)
+        checkpoint = BackfillCheckpoint(
+            set_else_none(
+                "backfill_checkpoint", kwargs, alt_value=DEFAULT_CHECKPOINT_FILE
+            ),
+            self.s3_url,
+        )
+        checkpoint.load()
+        self.sqs_batcher = checkpoint
+        concurrency = int(set_else_none("concurrency", kwargs, alt_value=1))
+        batch_size = int(
+            set_else_none("backfill_batch_size", kwargs, alt_value=concurrency * 4)
+        )
+        objects = list_objects(
+            self.s3_client,
+            self.bucket,
+            self.prefix,
+            start_after=checkpoint.start_after,
+            modified_after=parse_datetime(
+                set_else_none("backfill_modified_after", kwargs)
+            ),
+            modified_before=parse_datetime(
+                set_else_none("backfill_modified_before", kwargs)
+            ),
+            min_size=int(set_else_none("backfill_min_size", kwargs, alt_value=0) * MB),
+            max_size=int(set_else_none("backfill_max_size", kwargs, alt_value=0) * MB),
+            stats=checkpoint.stats,
+        )
+        start = monotonic()
+        session_stats = dict(checkpoint.stats)
+        worker_module.sftp_connection = self.router
+        completed = False
+        with self.router:
+            LOG.info(f"Backfilling {self.s3_url} to {self.connection_string}")
+            while self.keep_running:
+                transfer_messages = [
+                    TransferMessage(BackfillMessage(self.bucket, s3_object))
+                    for s3_object in islice(objects, max(batch_size, 1))
+                ]
+                if not transfer_messages:
+                    completed = True
+                    break
+                self.transfer_files_to_sftp(
+                    [
+                        transfer_file
+                        for transfer_message in transfer_messages
+                        for transfer_file in transfer_message.files
+                    ],
+                    **kwargs,
+                )
+                self.flush_coalesced(force=True)
+                if not checkpoint.advance(
+                    transfer_messages, stopped=not self.keep_running
+                ):
+                    break
+        duration = monotonic() - start
+        return self.summary(checkpoint, session_stats, duration, completed)
+
+    def summary(
+        self,
+        checkpoint: BackfillCheckpoint,
+        session_stats: dict,
+        duration: float,
+        completed: bool,
+    ) -> dict:
+        """
+        Logs the statistics of the whole backfill, and the throughput of this run. The backfill is
+        ``completed`` once all the objects listed were processed.
+        """
+        summary = dict(checkpoint.stats)
+        transferred = summary["transferred"] - session_stats["transferred"]
+        transferred_bytes = summary["bytes"] - session_stats["bytes"]
+        summary.update(
+            {
+                "source": self.s3_url,
+                "completed": completed,
+                "duration": round(duration, 3),
+                "files_per_second": round(transferred / duration, 2) if duration else 0,
+                "mb_per_second": (
+                    round(transferred_bytes / MB / duration, 2) if duration else 0
+                ),
+            }
+        )
+        LOG.info(
+            f"Backfill of {self.s3_url} {'completed' if summary['completed'] else 'interrupted'}"
+            f" - Transferred: {summary['transferred']} - Skipped: {summary['skipped']}"
+            f" - Failed: {summary['failed']} - {summary['bytes'] / MB:.1f}MB"
+            f" - This run: listed {summary['listed']}, transferred {transferred} files in {summary['duration']}s,"
+            f" {summary['files_per_second']} files/s, {summary['mb_per_second']}MB/s"
+        )
+        if checkpoint.failed:
+            LOG.warning(f"Failed to transfer: {checkpoint.failed}")
+        return summary
@@ -0,0 +1,172 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Checksums computed over the bytes sent to the SFTP server, while these are transferred, and compared
+to the checksums S3 has for the object.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import zlib
+from base64 import b64encode
+from typing import Union
+
+from s3_to_sftp.logger import LOG
+
+try:
+    from awscrt import checksums as crt_checksums
+except ImportError:
+    crt_checksums = None
+
+S3_CHECKSUMS: dict = {
+    "ChecksumCRC32": "crc32",
+    "ChecksumCRC32C": "crc32c",
+    "ChecksumSHA1": "sha1",
+    "ChecksumSHA256": "sha256",
+}
+
+
+def etag_md5(s3_object: dict) -> Union[str, None]:
+    """
+    :return: the object ETag if it is its MD5, None for the objects uploaded in multiple parts, and
+      encrypted with SSE-KMS or SSE-C, of which the ETag is not
+    """
+    etag = str(s3_object.get("ETag", "")).strip('"')
+    if (
+        not etag
+        or "-" in etag
+        or str(s3_object.get("ServerSideEncryption", "")).startswith("aws:kms")
+        or s3_object.get("SSECustomerAlgorithm")
+    ):
+        return None
+    return etag
+
+
+class Crc32:
+    """
+    Incremental CRC32, with the digest in the S3 checksums format.
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self) -> str:
+        return self.digest().hex()
+
+
+class Crc32c(Crc32):
+    """
+    Incremental CRC32C. Requires awscrt, installed with ``boto3[crt]``.
+    """
+
+    def update(self, data: bytes) -> None:
+        self.value = crt_checksums.crc32c(data, self.value)
+
+
+def new_hasher(algorithm: str):
+    if algorithm == "crc32":
+        return Crc32()
+    if algorithm == "crc32c":
+        return Crc32c()
+    return hashlib.new(algorithm)
+
+
+class TransferChecksums:
+    """
+    Computes, in a single pass over the bytes transferred, the checksums S3 has for the object:
+    the MD5 for the ETag of objects not uploaded in multiple parts, and the additional checksums
+    stored for the whole object. The SHA-256 is also computed when ``sidecar`` is set, to write it
+    to a ``.sha256`` file next to the remote file. With ``check_file``, the remote file checksum is
+    also requested from the server, if it supports the check-file extension.
+    """
+
+    def __init__(self, sidecar: bool = False, check_file: bool = False):
+        self.sidecar = sidecar
+        self.check_file = check_file
+        self.expected: dict = {}
+        self.hashers: dict = {}
+
+    def expect(self, s3_object: dict) -> None:
+        """
+        Sets the checksums to compute and to compare, from the head_object response.
+        Composite checksums of objects uploaded in parts cannot be compared to the whole file's. These
+        are told apart by ``ChecksumType``, or when not set, by the object ETag part count, as
+        head_object does not suffix these with the part count.
+        """
+        etag = etag_md5(s3_object)
+        if etag:
+            self.expected["md5"] = etag
+        checksum_type = s3_object.get("ChecksumType")
+        multipart = "-" in str(s3_object.get("ETag", ""))
+        for key, algorithm in S3_CHECKSUMS.items():
+            value = s3_object.get(key)
+            if not value:
+                continue
+            if checksum_type:
+                if checksum_type != "FULL_OBJECT":
+                    continue
+            elif multipart or "-" in value:
+                continue
+            if algorithm == "crc32c" and crt_checksums is None:
+                LOG.warning(
+                    "awscrt is not installed. Unable to verify CRC32C checksums."
+                )
+                continue
+            self.expected[algorithm] = value
+        algorithms = set(self.expected)
+        if self.sidecar or self.check_file:
+            algorithms.add("sha256")
+        self.hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+
+    def update(self, data: bytes) -> None:
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigest(self, algorithm: str) -> str:
+        return self.hashers[algorithm].hexdigest()
+
+    def verify(self, file_name: str) -> dict:
+        """
+        Compares the computed checksums with the expected ones.
+
+        :return: the computed checksums, hex encoded
+        :raises OSError: if any of the checksums differs
+        """
+        for algorithm, expected in self.expected.items():
+            hasher = self.hashers[algorithm]
+            computed = (
+                hasher.hexdigest()
+                if algorithm == "md5"
+                else b64encode(hasher.digest()).decode()
+            )
+            if computed != expected:
+                raise OSError(
+                    f"{algorithm} checksum mismatch for {file_name}! {computed} != {expected}"
+                )
+        if self.expected:
+            LOG.info(f"{file_name} - Verified checksums: {', '.join(self.expected)}")
+        return {
+            algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()
+        }
+
+
+class ChecksumReader:
+    """
+    File object wrapper updating the checksums with the bytes read.
+    """
+
+    def __init__(self, file_fd, checksums: TransferChecksums):
+        self.file_fd = file_fd
+        self.checksums = checksums
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file_fd.read(size)
+        self.checksums.update(data)
+        return data
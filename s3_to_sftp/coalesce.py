@@ -0,0 +1,259 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Coalescing of the small files into archives, uploaded to the SFTP target as a single file.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from s3_to_sftp.rate_limit import RateLimiter
+    from s3_to_sftp.transfer_file import TransferFile
+    from s3_to_sftp.transfer_handler import RemoteDirectoryCache
+
+import io
+import json
+import shutil
+import tarfile
+import zipfile
+from datetime import datetime as dt
+from os import path
+from threading import Lock
+from time import monotonic, time
+from uuid import uuid4
+
+from compose_x_common.compose_x_common import keyisset, set_else_none
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.timers import TIMERS
+from s3_to_sftp.transfer_handler import recursive_mkdir
+
+MB: int = 1024**2
+FORMATS: dict = {"tar": ".tar", "tar.gz": ".tar.gz", "zip": ".zip"}
+MANIFEST_NAME: str = "manifest.json"
+
+
+class ArchiveWriter:
+    """
+    Write-only file object sending the archive bytes to the remote file, within the rate limits.
+    """
+
+    def __init__(self, remote_fd, rate_limiter: RateLimiter = None):
+        self.remote_fd = remote_fd
+        self.rate_limiter = rate_limiter
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        if self.rate_limiter:
+            self.rate_limiter.throttle(len(data))
+        self.remote_fd.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self.remote_fd.flush()
+
+
+def add_member(
+    archive: Union[tarfile.TarFile, zipfile.ZipFile], name: str, size: int, source
+) -> None:
+    """
+    Adds the ``size`` bytes read from ``source`` to the archive, as ``name``.
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        info = zipfile.ZipInfo(name, dt.utcnow().timetuple()[:6])
+        with archive.open(info, "w") as member_fd:
+            shutil.copyfileobj(source, member_fd, MB)
+    else:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time())
+        archive.addfile(info, source)
+
+
+class Coalescer:
+    """
+    Buffers the files of up to ``max_file_size`` bytes, until the oldest was buffered ``max_wait`` seconds
+    ago or the files add up to ``max_size`` bytes, to then upload them all in one ``archive_format`` archive,
+    with a manifest of the files if ``manifest`` is set. Files are added and taken from different threads.
+    """
+
+    def __init__(
+        self,
+        archive_format: str = "tar",
+        max_wait: int = 60,
+        max_size: int = 64 * MB,
+        max_file_size: int = 1 * MB,
+        manifest: bool = False,
+        prefix: str = "batch-",
+    ):
+        if archive_format not in FORMATS:
+            raise ValueError(
+                "Archive format must be one of", list(FORMATS), "Got", archive_format
+            )
+        self.archive_format = archive_format
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.manifest = manifest
+        self.prefix = prefix
+        self.files: list = []
+        self.size = 0
+        self.first_added = 0.0
+        self._lock = Lock()
+
+    @property
+    def visibility_timeout(self) -> int:
+        """
+        Visibility timeout of the messages of the buffered files, to cover the buffering and the upload.
+        """
+        return int(self.max_wait * 2 + 60)
+
+    def accepts(self, transfer_file: TransferFile) -> bool:
+        return transfer_file.file_size <= self.max_file_size
+
+    def add(self, transfer_file: TransferFile) -> None:
+        with self._lock:
+            if not self.files:
+                self.first_added = monotonic()
+            self.files.append(transfer_file)
+            self.size += transfer_file.file_size
+
+    def due(self) -> bool:
+        with self._lock:
+            return bool(self.files) and (
+                self.size >= self.max_size
+                or monotonic() - self.first_added >= self.max_wait
+            )
+
+    def buffers(self, transfer_file: TransferFile) -> bool:
+        with self._lock:
+            return any(_file is transfer_file for _file in self.files)
+
+    def take(self) -> list[TransferFile]:
+        with self._lock:
+            files, self.files, self.size = self.files, [], 0
+        return files
+
+    def archive_path(self, sftp_info: dict) -> str:
+        prefix_path = set_else_none("default_path", sftp_info, alt_value="")
+        if prefix_path and not prefix_path.startswith(r"/"):
+            prefix_path = "/" + prefix_path
+        if prefix_path and not prefix_path.endswith(r"/"):
+            prefix_path += r"/"
+        return (
+            f"{prefix_path}{self.prefix}{dt.utcnow().strftime('%Y%m%dT%H%M%SZ')}"
+            f"-{uuid4().hex[:8]}{FORMATS[self.archive_format]}"
+        )
+
+    def new_manifest(self, files: list[TransferFile]) -> bytes:
+        return json.dumps(
+            [
+                {
+                    "bucket": transfer_file.s3_bucket,
+                    "key": transfer_file.file_name,
+                    "size": transfer_file.file_size,
+                    "etag": set_else_none("etag", transfer_file.file_info),
+                    "version_id": set_else_none("version_id", transfer_file.file_info),
+                }
+                for transfer_file in files
+            ],
+            indent=2,
+        ).encode()
+
+    def write_archive(
+        self, writer: ArchiveWriter, files: list[TransferFile], s3_client
+    ) -> None:
+        """
+        Streams the S3 objects into the archive, one after the other, without local copy.
+        """
+        if self.archive_format == "zip":
+            archive = zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED)
+        else:
+            archive = tarfile.open(
+                fileobj=writer, mode="w|gz" if self.archive_format == "tar.gz" else "w|"
+            )
+        with archive:
+            for transfer_file in files:
+                with TIMERS.time("s3_first_byte"):
+                    s3_object = s3_client.get_object(
+                        Bucket=transfer_file.s3_bucket, Key=transfer_file.file_name
+                    )
+                try:
+                    add_member(
+                        archive,
+                        transfer_file.file_name,
+                        s3_object["ContentLength"],
+                        s3_object["Body"],
+                    )
+                finally:
+                    s3_object["Body"].close()
+            if self.manifest:
+                manifest = self.new_manifest(files)
+                add_member(archive, MANIFEST_NAME, len(manifest), io.BytesIO(manifest))
+
+    def upload(
+        self,
+        sftp_fd,
+        files: list[TransferFile],
+        remote_path: str,
+        s3_client,
+        rate_limiter: RateLimiter = None,
+        directories_cache: RemoteDirectoryCache = None,
+    ) -> int:
+        """
+        Uploads the archive of the files, with a temporary name, renamed once complete so that the
+        archive is never seen partial on the SFTP server.
+
+        :return: the archive size
+        """
+        with TIMERS.time("mkdir"):
+            recursive_mkdir(sftp_fd, path.dirname(remote_path), directories_cache)
+        partial_path = f"{remote_path}.part"
+        with TIMERS.time("sftp_open"):
+            remote_fd = sftp_fd.open(partial_path, "wb")
+        write_start = monotonic()
+        writer = ArchiveWriter(remote_fd, rate_limiter)
+        try:
+            with remote_fd:
+                remote_fd.set_pipelined(True)
+                self.write_archive(writer, files, s3_client)
+            TIMERS.record("sftp_write", monotonic() - write_start)
+            with TIMERS.time("verify"):
+                remote_size = sftp_fd.stat(partial_path).st_size
+                if remote_size != writer.written:
+                    raise OSError(
+                        f"size mismatch in archive upload! {remote_size} != {writer.written}"
+                    )
+            sftp_fd.rename(partial_path, remote_path)
+        except Exception:
+            try:
+                sftp_fd.remove(partial_path)
+            except OSError:
+                pass
+            raise
+        LOG.info(
+            f"Uploaded {len(files)} files to {remote_path} - {writer.written} bytes"
+        )
+        return writer.written
+
+
+def get_coalescer(sftp_info: dict) -> Union[Coalescer, None]:
+    """
+    Returns the coalescer of the SFTP target, if its ``coalesce`` settings are set.
+    """
+    options = set_else_none("coalesce", sftp_info)
+    if not options:
+        return None
+    return Coalescer(
+        archive_format=set_else_none("format", options, alt_value="tar"),
+        max_wait=int(set_else_none("max_wait", options, alt_value=60)),
+        max_size=int(float(set_else_none("max_size", options, alt_value=64)) * MB),
+        max_file_size=int(
+            float(set_else_none("max_file_size", options, alt_value=1)) * MB
+        ),
+        manifest=keyisset("manifest", options),
+        prefix=set_else_none("prefix", options, alt_value="batch-"),
+    )
@@ -0,0 +1,225 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Local journal of the transfers in progress and completed, to recover from a worker killed mid-batch.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from s3_to_sftp.transfer_file import TransferFile
+
+import json
+import sqlite3
+from os import makedirs, path
+from threading import Lock
+from time import time
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.routing import DEFAULT_TARGET
+
+IN_PROGRESS: str = "in_progress"
+COMPLETED: str = "completed"
+RETENTION: int = 14 * 24 * 3600
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS transfers (
+    unit TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    receipt_handle TEXT NOT NULL,
+    message_files INTEGER NOT NULL,
+    version TEXT,
+    file_size INTEGER NOT NULL,
+    remote_path TEXT NOT NULL,
+    size_only INTEGER NOT NULL,
+    bytes_committed INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    target TEXT NOT NULL
+)
+"""
+
+
+class JournaledMessage:
+    """
+    The SQS message of a journal entry, with the receipt handle it was last received with.
+    """
+
+    def __init__(self, message_id: str, receipt_handle: str):
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+
+
+class TransferJournal:
+    """
+    SQLite database, in WAL mode, recording for each file transfer its message, the S3 object version,
+    the SFTP target and remote path, whether the remote file size is all the transfer verifies, the
+    bytes committed, and whether the transfer completed.
+    Each change is committed on its own, so the journal survives the worker process being killed.
+    Entries are removed once their message is deleted, or after ``RETENTION`` seconds.
+    """
+
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        makedirs(path.dirname(path.abspath(journal_file)), exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(
+            journal_file, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+        self._db.execute(
+            "DELETE FROM transfers WHERE updated < ?", (time() - RETENTION,)
+        )
+
+    def _execute(self, statement: str, parameters: tuple = ()) -> list:
+        with self._lock:
+            return self._db.execute(statement, parameters).fetchall()
+
+    def begin(self, transfer_file: TransferFile, size_only: bool = True) -> None:
+        """
+        Records the transfer as in progress. With ``size_only``, the file is written in order to the remote
+        path, and only its size verified, so a remote file of the object size proves the transfer completed.
+        """
+        message = transfer_file.transfer_message
+        self._execute(
+            "INSERT OR REPLACE INTO transfers"
+            " (unit, message_id, receipt_handle, message_files, version, file_size, remote_path, size_only,"
+            " status, updated, target) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                json.dumps(transfer_file.unit_key),
+                transfer_file.message.message_id,
+                transfer_file.message.receipt_handle,
+                len(message.files) + len(message.completed_units) if message else 1,
+                str(transfer_file.unit_key[-1]),
+                transfer_file.file_size,
+                transfer_file.file_handler.remote_file_path,
+                int(size_only),
+                IN_PROGRESS,
+                time(),
+                transfer_file.target.name if transfer_file.target else DEFAULT_TARGET,
+            ),
+        )
+
+    def complete(self, transfer_file: TransferFile) -> None:
+        self._execute(
+            "UPDATE transfers SET status = ?, bytes_committed = file_size, updated = ? WHERE unit = ?",
+            (COMPLETED, time(), json.dumps(transfer_file.unit_key)),
+        )
+
+    def discard(self, transfer_file: TransferFile) -> None:
+        self._execute(
+            "DELETE FROM transfers WHERE unit = ? AND status = ?",
+            (json.dumps(transfer_file.unit_key), IN_PROGRESS),
+        )
+
+    def forget(self, messages: list) -> None:
+        """
+        Removes the entries of the messages deleted from the queue.
+        """
+        for message in messages:
+            self._execute(
+                "DELETE FROM transfers WHERE message_id = ?", (message.message_id,)
+            )
+
+    def entries(self) -> list[dict]:
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT * FROM transfers ORDER BY message_id, unit"
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        return [
+            dict(zip(columns, row), key=row[0], unit=tuple(json.loads(row[0])))
+            for row in rows
+        ]
+
+    def targets(self) -> list[str]:
+        """
+        :return: the SFTP targets of the transfers in progress
+        """
+        return [
+            row[0]
+            for row in self._execute(
+                "SELECT DISTINCT target FROM transfers WHERE status = ?", (IN_PROGRESS,)
+            )
+        ]
+
+    def reconcile(self, sftp_fds: dict) -> tuple[list, list, dict]:
+        """
+        Compares the transfers in progress with the remote files, over the SFTP session of their target
+        in ``sftp_fds``. The ones with the remote file of the object size are marked as completed, if only
+        their size was to be verified: not for the files sent in ranges, with the remote file only replaced
+        once complete, nor with checksums. Partial remote files are only written in order, so the ones with
+        a partial remote file are to be resumed. The others, or of a target without session, are
+        forgotten, to be transferred again.
+
+        :return: the messages with all their files completed, to delete, the other messages, to release,
+          and the remote size of the partial files, by unit
+        """
+        partials: dict = {}
+        messages: dict = {}
+        for entry in self.entries():
+            messages[entry["message_id"]] = JournaledMessage(
+                entry["message_id"], entry["receipt_handle"]
+            )
+            if entry["status"] != IN_PROGRESS:
+                continue
+            try:
+                remote_size = (
+                    sftp_fds[entry["target"]].stat(entry["remote_path"]).st_size
+                )
+            except (KeyError, OSError):
+                remote_size = 0
+            if remote_size == entry["file_size"] and entry["size_only"]:
+                LOG.info(f"{entry['remote_path']} - Found completed on SFTP.")
+                self._execute(
+                    "UPDATE transfers SET status = ?, bytes_committed = ?, updated = ? WHERE unit = ?",
+                    (COMPLETED, remote_size, time(), entry["key"]),
+                )
+            elif 0 < remote_size < entry["file_size"]:
+                LOG.info(
+                    f"{entry['remote_path']} - Found partial on SFTP."
+                    f" {remote_size}/{entry['file_size']} bytes committed."
+                )
+                self._execute(
+                    "UPDATE transfers SET bytes_committed = ?, updated = ? WHERE unit = ?",
+                    (remote_size, time(), entry["key"]),
+                )
+                partials[entry["unit"]] = remote_size
+            else:
+                self._execute("DELETE FROM transfers WHERE unit = ?", (entry["key"],))
+        completed: dict = dict.fromkeys(messages, 0)
+        totals: dict = dict.fromkeys(messages, 1)
+        for entry in self.entries():
+            totals[entry["message_id"]] = entry["message_files"]
+            if entry["status"] == COMPLETED:
+                completed[entry["message_id"]] += 1
+        to_delete = [
+            message
+            for message_id, message in messages.items()
+            if completed[message_id] >= totals[message_id]
+        ]
+        to_release = [
+            message
+            for message_id, message in messages.items()
+            if completed[message_id] < totals[message_id]
+        ]
+        return to_delete, to_release, partials
+
+    def completed_units(self) -> dict:
+        """
+        :return: the units of the completed transfers, by message ID
+        """
+        units: dict = {}
+        for entry in self.entries():
+            if entry["status"] == COMPLETED:
+                units.setdefault(entry["message_id"], set()).add(entry["unit"])
+        return units
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
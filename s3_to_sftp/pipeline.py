@@ -0,0 +1,110 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Two stages producer/consumer pipeline, so that pulling the next file from S3 overlaps
+pushing the current one to the SFTP target.
+"""
+
+from __future__ import annotations
+
+from queue import Queue
+from threading import Condition, Thread
+from typing import Any, Callable, Iterable
+
+from s3_to_sftp.logger import LOG
+
+_END = object()
+
+
+class ByteBudget:
+    """
+    Thread-safe budget of bytes. Acquiring blocks until enough bytes are released, so that the
+    prefetched data never exceeds ``max_bytes``. An item larger than the whole budget is let through
+    once nothing else is held, so it cannot block the pipeline forever.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not self.used or self.used + nbytes <= self.max_bytes
+            )
+            self.used += nbytes
+
+    def release(self, nbytes: int) -> None:
+        with self._condition:
+            self.used = max(self.used - nbytes, 0)
+            self._condition.notify_all()
+
+
+def run_pipeline(
+    items: Iterable,
+    stage_one: Callable[[Any], Any],
+    stage_two: Callable[[Any], Any],
+    size_of: Callable[[Any], int],
+    max_bytes: int,
+    on_skipped: Callable[[Any], Any] = None,
+) -> list:
+    """
+    Runs ``stage_one`` over the items in a background thread, and ``stage_two`` in the calling thread,
+    in order. At most ``max_bytes`` (as per ``size_of``) are held between the two stages.
+    When ``stage_one`` returns a falsy value or raises, the item skips ``stage_two``. When it returns
+    None, the pipeline stops, and the items not run yet are passed to ``on_skipped``.
+
+    :return: the result of the last stage run for each item, in the items order.
+    """
+    items = list(items)
+    budget = ByteBudget(max_bytes)
+    handover: Queue = Queue()
+    results: list = [None] * len(items)
+
+    def skip(skipped_items: list) -> None:
+        if not on_skipped:
+            return
+        for item in skipped_items:
+            try:
+                on_skipped(item)
+            except Exception as error:
+                LOG.exception(error)
+
+    def producer():
+        try:
+            for index, item in enumerate(items):
+                nbytes = size_of(item)
+                budget.acquire(nbytes)
+                try:
+                    result = stage_one(item)
+                except Exception as error:
+                    LOG.exception(error)
+                    result = False
+                if not result:
+                    budget.release(nbytes)
+                    results[index] = result
+                    if result is None:
+                        skip(items[index + 1 :])
+                        break
+                    continue
+                handover.put((index, item, nbytes))
+        finally:
+            handover.put(_END)
+
+    prefetcher = Thread(target=producer, name="prefetch", daemon=True)
+    prefetcher.start()
+    while True:
+        handed = handover.get()
+        if handed is _END:
+            break
+        index, item, nbytes = handed
+        try:
+            results[index] = stage_two(item)
+        except Exception as error:
+            LOG.exception(error)
+            results[index] = False
+        finally:
+            budget.release(nbytes)
+    prefetcher.join()
+    return results
@@ -0,0 +1,165 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Polling of the SQS queue ahead of the transfers, from a background thread.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from threading import Condition, Event, Thread
+from time import monotonic
+from typing import Callable
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.sqs_batch import batch_entries
+from s3_to_sftp.timers import TIMERS
+
+SQS_MAX_MESSAGES: int = 10
+MAX_RETRY_DELAY: int = 60
+CHECK_INTERVAL: float = 1.0
+
+
+class QueuePoller(Thread):
+    """
+    Background thread that long-polls the queue into a local buffer of up to ``max_buffered`` messages,
+    taken with ``get``. The queue is only polled when the buffer is empty and ``can_poll`` returns True,
+    which the worker does once no file waits for a transfer slot anymore. Until taken, the messages
+    buffered are kept invisible: their visibility is extended to ``visibility_timeout`` seconds again
+    once half of it elapsed. Failed calls are retried after an exponentially growing delay, up to
+    ``MAX_RETRY_DELAY`` seconds.
+    """
+
+    def __init__(
+        self,
+        queue,
+        max_buffered: int = SQS_MAX_MESSAGES,
+        wait_time: int = 20,
+        batch_size: Callable[[], int] = None,
+        can_poll: Callable[[], bool] = None,
+        visibility_timeout: int = 0,
+    ):
+        super().__init__(name="sqs-poller", daemon=True)
+        self.queue = queue
+        self.max_buffered = max(max_buffered, 1)
+        self.wait_time = wait_time
+        self.batch_size = batch_size
+        self.can_poll = can_poll
+        self.visibility_timeout = visibility_timeout
+        self.failures = 0
+        self._buffer: deque = deque()
+        self._held_since: float = 0.0
+        self._condition = Condition()
+        self._stopped = Event()
+
+    def wanted(self) -> int:
+        """
+        :return: how many messages to receive now, 0 if none
+        """
+        with self._condition:
+            if self._buffer:
+                return 0
+        if self.can_poll and not self.can_poll():
+            return 0
+        count = self.max_buffered
+        if self.batch_size:
+            count = min(count, self.batch_size())
+        return max(min(count, SQS_MAX_MESSAGES), 0)
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            count = self.wanted()
+            if not count:
+                with self._condition:
+                    self._condition.wait(CHECK_INTERVAL)
+                self.extend_buffered()
+                continue
+            try:
+                receive_start = monotonic()
+                messages = self.queue.receive_messages(
+                    WaitTimeSeconds=self.wait_time,
+                    MaxNumberOfMessages=count,
+                    AttributeNames=["SentTimestamp"],
+                )
+            except Exception as error:
+                delay = min(2**self.failures, MAX_RETRY_DELAY)
+                self.failures += 1
+                LOG.error(f"Failed to retrieve jobs from queue. Retrying in {delay}s")
+                LOG.exception(error)
+                self._stopped.wait(delay)
+                continue
+            self.failures = 0
+            if messages:
+                TIMERS.record("receive", monotonic() - receive_start)
+                with self._condition:
+                    self._buffer.extend(messages)
+                    self._held_since = monotonic()
+                    self._condition.notify_all()
+
+    def extend_buffered(self) -> None:
+        """
+        Extends the visibility of the messages buffered for more than half their visibility timeout.
+        Done holding the buffer, so that the worker does not take, and reserve, these meanwhile.
+        """
+        if not self.visibility_timeout:
+            return
+        with self._condition:
+            if (
+                not self._buffer
+                or monotonic() - self._held_since < self.visibility_timeout / 2
+            ):
+                return
+            entries = [
+                {
+                    "Id": str(index),
+                    "ReceiptHandle": message.receipt_handle,
+                    "VisibilityTimeout": self.visibility_timeout,
+                }
+                for index, message in enumerate(self._buffer)
+            ]
+            try:
+                for batch in batch_entries(entries):
+                    self.queue.meta.client.change_message_visibility_batch(
+                        QueueUrl=self.queue.url, Entries=batch
+                    )
+                self._held_since = monotonic()
+            except Exception as error:
+                LOG.error("Failed to extend the buffered messages visibility")
+                LOG.exception(error)
+
+    def get(self, timeout: float) -> list:
+        """
+        Waits up to ``timeout`` seconds for messages to be buffered. The poller is not woken up, for the
+        worker to account for the files of these messages before it checks whether to poll again.
+
+        :return: the messages buffered, if any
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._buffer or self._stopped.is_set(), timeout
+            )
+            messages = list(self._buffer)
+            self._buffer.clear()
+        return messages
+
+    def notify(self) -> None:
+        """
+        Wakes the poller up to check again whether to poll, as when transfer slots are about to free up.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def stop(self) -> list:
+        """
+        Stops polling, waiting for the receive call in progress, if any.
+
+        :return: the messages buffered and not taken, to release
+        """
+        self._stopped.set()
+        self.notify()
+        if self.is_alive():
+            self.join(self.wait_time + CHECK_INTERVAL)
+        with self._condition:
+            messages = list(self._buffer)
+            self._buffer.clear()
+        return messages
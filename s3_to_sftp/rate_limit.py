@@ -0,0 +1,134 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Limits the bandwidth used to, and the number of files transferred at once to, an SFTP target.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+
+from compose_x_common.compose_x_common import set_else_none
+
+from s3_to_sftp.timers import STARTUP, TIMERS
+
+MB: int = 1024**2
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket of ``rate`` bytes per second, holding up to ``burst`` bytes. Consuming more
+    than available puts the bucket in debt, and the caller waits for it to be repaid, so that chunks
+    larger than the burst are let through at the average rate.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst else rate
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def consume(self, nbytes: int) -> float:
+        """
+        :return: how long, in seconds, the caller waited for the bytes
+        """
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate, self.burst
+            )
+            self.updated = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+        return wait
+
+
+class ThrottledReader:
+    """
+    File object wrapper taking the bytes read from the rate limiter.
+    """
+
+    def __init__(self, file_fd, rate_limiter: RateLimiter):
+        self.file_fd = file_fd
+        self.rate_limiter = rate_limiter
+        self.waited = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file_fd.read(size)
+        self.waited += self.rate_limiter.throttle(len(data))
+        return data
+
+
+class RateLimiter:
+    """
+    Limits of an SFTP target: ``max_bandwidth``, in MB/s, shared by all the files transferred to it, and
+    ``max_files`` transferred at once. 0 for no limit.
+    """
+
+    def __init__(self, max_bandwidth: float = 0, max_files: int = 0):
+        self.max_bandwidth = max_bandwidth
+        self.max_files = max_files
+        self.bucket = TokenBucket(max_bandwidth * MB) if max_bandwidth else None
+        self._files = BoundedSemaphore(max_files) if max_files else None
+
+    def throttle(self, nbytes: int) -> float:
+        """
+        Waits until ``nbytes`` can be sent within the bandwidth limit. All the bytes sent to the SFTP
+        targets go through here, which marks the first one sent since the process started.
+
+        :return: how long, in seconds, it waited
+        """
+        if nbytes and STARTUP.first_byte is None:
+            STARTUP.mark_first_byte()
+        if not self.bucket or not nbytes:
+            return 0
+        return self.bucket.consume(nbytes)
+
+    @contextmanager
+    def file_slot(self):
+        """
+        Holds one of the ``max_files`` slots for the transfer of a file. The time waited for it is
+        recorded as throttling.
+        """
+        if not self._files:
+            yield
+            return
+        with TIMERS.time("throttle"):
+            self._files.acquire()
+        try:
+            yield
+        finally:
+            self._files.release()
+
+    def file_rate(self, concurrency: int = 1) -> float:
+        """
+        Transfer rate, in MB/s, each file gets at most when ``concurrency`` files share the bandwidth.
+        0 without bandwidth limit.
+        """
+        if not self.max_bandwidth:
+            return 0
+        if self.max_files:
+            concurrency = min(concurrency, self.max_files)
+        return self.max_bandwidth / max(concurrency, 1)
+
+
+def get_rate_limiter(
+    sftp_info: dict, max_bandwidth: float = 0, max_files: int = 0
+) -> RateLimiter:
+    """
+    Returns the rate limiter of the SFTP target, with its ``limits`` settings, else the defaults given.
+    """
+    limits = set_else_none("limits", sftp_info, alt_value={})
+    return RateLimiter(
+        max_bandwidth=float(
+            set_else_none("max_bandwidth", limits, alt_value=max_bandwidth)
+        ),
+        max_files=int(
+            set_else_none("max_concurrent_files", limits, alt_value=max_files)
+        ),
+    )
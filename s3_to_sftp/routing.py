@@ -0,0 +1,246 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Routing of the S3 objects to the SFTP targets, by bucket and key prefix, each target with its own
+pool of sessions, limits and settings.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable, Union
+
+if TYPE_CHECKING:
+    from s3_to_sftp.sftp_pool import SFTPSessionPool
+    from s3_to_sftp.transfer_file import TransferFile
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from threading import Lock
+from time import monotonic
+
+from compose_x_common.compose_x_common import keyisset, set_else_none
+
+from s3_to_sftp.coalesce import get_coalescer
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.rate_limit import get_rate_limiter
+
+DEFAULT_TARGET: str = "default"
+RETRY_INTERVAL: int = 60
+ROUTING_KEYS: list = ["targets", "routes"]
+
+
+def get_targets_settings(sftp_info: dict) -> tuple[dict, list]:
+    """
+    Settings of the SFTP targets, by name, and the routes to these. Without ``targets``, the SFTP
+    details are the only target, all the objects are routed to. The settings set outside of ``targets``
+    apply to all the targets not setting these.
+
+    :return: the targets settings, and the routes
+    """
+    if not keyisset("targets", sftp_info):
+        return {DEFAULT_TARGET: sftp_info}, [{"target": DEFAULT_TARGET}]
+    shared = {key: value for key, value in sftp_info.items() if key not in ROUTING_KEYS}
+    targets = {
+        name: dict(shared, **settings)
+        for name, settings in sftp_info["targets"].items()
+    }
+    routes = set_else_none("routes", sftp_info, alt_value=[])
+    for route in routes:
+        if route["target"] not in targets:
+            raise ValueError(
+                "Route to undefined target", route["target"], "Targets", list(targets)
+            )
+    return targets, routes
+
+
+class Route:
+    """
+    Routes the objects of the buckets matching the ``bucket`` pattern, with the key matching ``prefix``
+    followed by anything, to the ``target``. Patterns are shell-style, as in ``partner-*``.
+    """
+
+    def __init__(self, target: str, bucket: str = "*", prefix: str = ""):
+        self.target = target
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def matches(self, bucket: str, key: str) -> bool:
+        return fnmatchcase(bucket, self.bucket) and fnmatchcase(key, f"{self.prefix}*")
+
+
+class SFTPTarget:
+    """
+    An SFTP target, with its settings, limits and coalescer. Its pool of ``concurrency`` sessions is
+    connected when first checked out, retrying as the pool does. Once these attempts failed, the target
+    is not connected again for ``RETRY_INTERVAL`` seconds, so its files fail right away.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sftp_info: dict,
+        new_pool: Callable[[SFTPTarget], SFTPSessionPool],
+        concurrency: int = 1,
+        max_bandwidth: float = 0,
+        max_files: int = 0,
+    ):
+        self.name = name
+        self.sftp_info = sftp_info
+        self.concurrency = int(
+            set_else_none("concurrency", sftp_info, alt_value=concurrency)
+        )
+        self.rate_limiter = get_rate_limiter(
+            sftp_info, max_bandwidth=max_bandwidth, max_files=max_files
+        )
+        self.coalescer = get_coalescer(sftp_info)
+        self.pool = new_pool(self)
+        self.opened = False
+        self.failed_at: float = None
+        self._lock = Lock()
+
+    @property
+    def connection_string(self) -> str:
+        return (
+            f"{self.sftp_info['username']}@{self.sftp_info['host']}"
+            f":{set_else_none('port', self.sftp_info, alt_value=22)}"
+        )
+
+    def open(self) -> None:
+        """
+        Connects the pool of sessions, unless already connected.
+        """
+        with self._lock:
+            if self.opened:
+                return
+            if self.failed_at and monotonic() - self.failed_at < RETRY_INTERVAL:
+                raise ConnectionError(
+                    f"{self.name} - Connection failed less than {RETRY_INTERVAL}s ago"
+                )
+            try:
+                self.pool.open()
+            except Exception:
+                self.failed_at = monotonic()
+                self.pool.close()
+                raise
+            self.failed_at = None
+            self.opened = True
+        LOG.info(f"{self.name} - {self.connection_string} - Connection established.")
+
+    @contextmanager
+    def checkout(self):
+        """
+        Context manager that gives exclusive use of one of the target SFTP sessions, until exited.
+        """
+        self.open()
+        with self.pool.checkout() as sftp_fd:
+            yield sftp_fd
+
+    def close(self) -> None:
+        with self._lock:
+            if self.opened:
+                self.pool.close()
+                self.opened = False
+
+
+class Router:
+    """
+    Routes the objects to the first of the ``routes`` matching their bucket and key.
+    """
+
+    def __init__(self, targets: dict[str, SFTPTarget], routes: list[Route]):
+        self.targets = targets
+        self.routes = routes
+
+    def __enter__(self) -> Router:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def connection_string(self) -> str:
+        return ", ".join(target.connection_string for target in self.targets.values())
+
+    def route(self, bucket: str, key: str) -> Union[SFTPTarget, None]:
+        for route in self.routes:
+            if route.matches(bucket, key):
+                return self.targets[route.target]
+        return None
+
+    def open(self, targets: list[SFTPTarget]) -> list[SFTPTarget]:
+        """
+        Connects the targets not connected yet, in parallel.
+
+        :return: the targets that could not be connected
+        """
+        targets = [target for target in targets if not target.opened]
+        if not targets:
+            return []
+
+        def open_target(target: SFTPTarget) -> bool:
+            try:
+                target.open()
+                return True
+            except Exception as error:
+                LOG.error(
+                    f"{target.name} - Unable to connect to {target.connection_string}"
+                )
+                LOG.exception(error)
+                return False
+
+        with ThreadPoolExecutor(
+            max_workers=len(targets), thread_name_prefix="connect"
+        ) as executor:
+            opened = list(executor.map(open_target, targets))
+        return [target for target, is_open in zip(targets, opened) if not is_open]
+
+    def close(self) -> None:
+        for target in self.targets.values():
+            target.close()
+
+
+def interleave_targets(files_transfers: list[TransferFile]) -> list[TransferFile]:
+    """
+    Takes one file of each target in turn, keeping the order of the files of each target, so that the
+    transfers of a target held back by its limits do not hold the others back.
+    """
+    targets: dict = {}
+    for transfer_file in files_transfers:
+        targets.setdefault(transfer_file.target.name, []).append(transfer_file)
+    if len(targets) < 2:
+        return files_transfers
+    queues = list(targets.values())
+    ordered: list = []
+    while queues:
+        ordered += [queue.pop(0) for queue in queues]
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def get_router(
+    sftp_info: dict,
+    new_pool: Callable[[SFTPTarget], SFTPSessionPool],
+    concurrency: int = 1,
+    max_bandwidth: float = 0,
+    max_files: int = 0,
+) -> Router:
+    """
+    Returns the router to the SFTP targets of ``sftp_info``. The targets without their own
+    ``concurrency`` and ``limits`` settings use the ones given.
+    """
+    targets_settings, routes = get_targets_settings(sftp_info)
+    return Router(
+        {
+            name: SFTPTarget(
+                name,
+                settings,
+                new_pool,
+                concurrency=concurrency,
+                max_bandwidth=max_bandwidth,
+                max_files=max_files,
+            )
+            for name, settings in targets_settings.items()
+        },
+        [Route(**route) for route in routes],
+    )
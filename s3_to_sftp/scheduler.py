@@ -0,0 +1,96 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Orders the files of a received batch, and finds the messages that cannot be processed before their
+deadline, to release these back to the queue instead of holding them.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from s3_to_sftp.transfer_file import TransferFile
+
+from s3_to_sftp.logger import LOG
+
+POLICIES: list = ["fifo", "sjf", "fair"]
+
+
+def file_prefix(transfer_file: TransferFile, depth: int = 1) -> str:
+    """
+    Bucket and first ``depth`` "folders" of the object key. Files at the root of the bucket have the
+    bucket as prefix.
+    """
+    folders = transfer_file.file_name.split("/")[:-1]
+    return "/".join([transfer_file.s3_bucket] + folders[:depth])
+
+
+def order_files(
+    files_transfers: list[TransferFile], policy: str = "fifo", prefix_depth: int = 1
+) -> list[TransferFile]:
+    """
+    Orders the files to transfer according to the policy
+
+    * fifo: in the order of the messages
+    * sjf: shortest job first, the smallest files first
+    * fair: one file of each prefix in turn, the smallest first within each prefix, so that a prefix
+      with many files does not delay the others.
+    """
+    if policy == "sjf":
+        return sorted(files_transfers, key=lambda _file: _file.file_size)
+    if policy == "fair":
+        prefixes: dict = {}
+        for transfer_file in sorted(files_transfers, key=lambda _file: _file.file_size):
+            prefixes.setdefault(file_prefix(transfer_file, prefix_depth), []).append(
+                transfer_file
+            )
+        queues = list(prefixes.values())
+        ordered: list = []
+        while queues:
+            ordered += [queue.pop(0) for queue in queues]
+            queues = [queue for queue in queues if queue]
+        return ordered
+    if policy != "fifo":
+        raise ValueError("Scheduling policy must be one of", POLICIES, "Got", policy)
+    return list(files_transfers)
+
+
+def split_late_messages(
+    files_transfers: list[TransferFile],
+    duration_of: Callable,
+    concurrency: int = 1,
+    deadline: float = 0,
+) -> tuple[list[TransferFile], list]:
+    """
+    Simulates the transfer of the files, in order, over ``concurrency`` transfer slots, each file
+    taking ``duration_of(file)`` seconds. Files that would complete after ``deadline`` seconds are late,
+    unless first on their slot. Messages with no file on time are to be released, the files of the
+    other messages are kept, late or not, as messages cannot be partially released.
+
+    :return: the files to transfer, in order, and the messages to release
+    """
+    if not deadline:
+        return list(files_transfers), []
+    slots = [0.0] * max(concurrency, 1)
+    on_time: set = set()
+    for transfer_file in files_transfers:
+        slot = slots.index(min(slots))
+        completion = slots[slot] + duration_of(transfer_file)
+        if slots[slot] and completion > deadline:
+            continue
+        slots[slot] = completion
+        on_time.add(transfer_file.message.receipt_handle)
+    kept: list = []
+    released: dict = {}
+    for transfer_file in files_transfers:
+        receipt_handle = transfer_file.message.receipt_handle
+        if receipt_handle in on_time:
+            kept.append(transfer_file)
+        elif receipt_handle not in released:
+            LOG.info(
+                f"{transfer_file.file_name} - Not expected to be transferred within {deadline}s."
+                " Releasing its message."
+            )
+            released[receipt_handle] = transfer_file.message
+    return kept, list(released.values())
@@ -0,0 +1,82 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Local cache of the secrets values, for the workers started shortly after one another, as when scaled
+from zero, not to wait on Secrets Manager each time.
+"""
+
+from __future__ import annotations
+
+import json
+from os import O_CREAT, O_TRUNC, O_WRONLY, makedirs
+from os import open as os_open
+from os import path, replace
+from time import time
+
+from s3_to_sftp.logger import LOG
+
+DEFAULT_TTL: int = 300
+
+
+class SecretsCache:
+    """
+    Stores the secrets values in ``cache_file``, by ARN, with the time these were fetched. Values fetched
+    more than ``ttl`` seconds ago are ignored, and dropped. The file is only readable by its owner: keep it
+    on a volume private to the workers.
+    """
+
+    def __init__(self, cache_file: str, ttl: int = DEFAULT_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+
+    def entries(self) -> dict:
+        """
+        :return: the entries not expired, by ARN
+        """
+        if not path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as cache_fd:
+                entries = json.load(cache_fd)
+        except (OSError, ValueError) as error:
+            LOG.warning(f"Unable to read the secrets cache {self.cache_file}: {error}")
+            return {}
+        now = time()
+        return {
+            secret_arn: entry
+            for secret_arn, entry in entries.items()
+            if 0 <= now - entry["fetched"] < self.ttl
+        }
+
+    def load(self, secret_arns: list[str]) -> dict:
+        """
+        :return: the values of the secrets cached and not expired, by ARN
+        """
+        return {
+            secret_arn: entry["value"]
+            for secret_arn, entry in self.entries().items()
+            if secret_arn in secret_arns
+        }
+
+    def save(self, secrets: dict) -> None:
+        """
+        Adds the values of the secrets just fetched, by ARN, to the cache.
+        """
+        entries = self.entries()
+        now = time()
+        entries.update(
+            {
+                secret_arn: {"value": value, "fetched": now}
+                for secret_arn, value in secrets.items()
+            }
+        )
+        try:
+            makedirs(path.dirname(path.abspath(self.cache_file)), exist_ok=True)
+            temp_file = f"{self.cache_file}.tmp"
+            with open(
+                os_open(temp_file, O_WRONLY | O_CREAT | O_TRUNC, 0o600), "w"
+            ) as cache_fd:
+                json.dump(entries, cache_fd)
+            replace(temp_file, self.cache_file)
+        except OSError as error:
+            LOG.warning(f"Unable to save the secrets cache {self.cache_file}: {error}")
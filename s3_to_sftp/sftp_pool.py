@@ -0,0 +1,251 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Pool of SFTP sessions, to run several files transfers in parallel.
+"""
+
+from __future__ import annotations
+
+from contextlib import contextmanager
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+from paramiko import SFTPClient, SSHException
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.transfer_handler import (
+    RemoteDirectoryCache,
+    get_sftp_connection,
+    negotiated_transport_settings,
+)
+
+
+class SFTPSessionPool:
+    """
+    Class to manage a pool of SFTP channels. The channels are spread evenly across ``connections``
+    SSH transports, so they can all be multiplexed over a single one, or each use its own.
+    The remote directories known to exist are shared by all the sessions of the pool.
+
+    The transports send keepalives every ``keepalive`` seconds. Sessions are checked before being
+    checked out, and re-opened if their channel or transport was closed. Every ``health_check_interval``
+    seconds, a background thread reconnects the dead transports and keeps ``spares`` connections
+    opened, which are used first to replace a dead transport, so that reconnecting mostly happens
+    off the transfers path.
+    """
+
+    def __init__(
+        self,
+        sftp_connection_details: dict,
+        size: int = 1,
+        connections: int = 1,
+        attempt_interactive_auth_with_password: bool = False,
+        keepalive: int = 30,
+        spares: int = 0,
+        health_check_interval: int = 10,
+        reconnect_attempts: int = 5,
+        max_reconnect_delay: int = 60,
+    ):
+        self.sftp_connection_details = sftp_connection_details
+        self.size = max(size, 1)
+        self.connections = min(max(connections, 1), self.size)
+        self.attempt_interactive_auth_with_password = (
+            attempt_interactive_auth_with_password
+        )
+        self.keepalive = keepalive
+        self.spares = max(spares, 0)
+        self.health_check_interval = health_check_interval
+        self.reconnect_attempts = max(reconnect_attempts, 1)
+        self.max_reconnect_delay = max_reconnect_delay
+        self.sessions: list[SFTPClient] = []
+        self.transports: list = []
+        self.reconnections = 0
+        self.negotiated: dict = {}
+        self.directories = RemoteDirectoryCache()
+        self._available: Queue = Queue()
+        self._spares: Queue = Queue()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def __enter__(self) -> SFTPSessionPool:
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def new_connection(self) -> SFTPClient:
+        """
+        Opens a new SSH transport and returns its first SFTP channel.
+        """
+        sftp_fd = get_sftp_connection(
+            self.sftp_connection_details,
+            attempt_interactive_auth_with_password=self.attempt_interactive_auth_with_password,
+        )
+        if not sftp_fd or not hasattr(sftp_fd, "__enter__"):
+            raise ConnectionError(
+                "Unable to establish connection to SFTP server",
+                self.sftp_connection_details["host"],
+            )
+        if self.keepalive:
+            sftp_fd.get_channel().get_transport().set_keepalive(self.keepalive)
+        return sftp_fd
+
+    def reconnect(self) -> SFTPClient:
+        """
+        Returns a new connection, from the warm spares if any, or opens one, retrying with an
+        exponential backoff.
+        """
+        while True:
+            try:
+                sftp_fd = self._spares.get_nowait()
+            except Empty:
+                break
+            if is_healthy(sftp_fd):
+                LOG.info("Using a spare SFTP connection")
+                return sftp_fd
+            close_session(sftp_fd, with_transport=True)
+        for attempt in range(self.reconnect_attempts):
+            try:
+                return self.new_connection()
+            except (OSError, EOFError, SSHException) as error:
+                if attempt + 1 == self.reconnect_attempts or self._stopped.is_set():
+                    raise
+                delay = min(2**attempt, self.max_reconnect_delay)
+                LOG.warning(
+                    f"{self.sftp_connection_details['host']} - Connection failed ({error})."
+                    f" Retrying in {delay}s"
+                )
+                self._stopped.wait(delay)
+
+    def open(self) -> None:
+        """
+        Opens the SSH transports and the SFTP channels over these, then starts the health checks.
+        """
+        self._stopped.clear()
+        for index in range(self.size):
+            if len(self.transports) < self.connections:
+                sftp_fd = self.reconnect()
+                self.transports.append(sftp_fd.get_channel().get_transport())
+            else:
+                sftp_fd = SFTPClient.from_transport(
+                    self.transports[index % self.connections]
+                )
+            self.sessions.append(sftp_fd)
+            self._available.put(index)
+        LOG.info(
+            f"Opened {self.size} SFTP session(s) over {len(self.transports)} connection(s)"
+        )
+        self.negotiated = negotiated_transport_settings(self.sessions[0])
+        LOG.info(
+            f"{self.sftp_connection_details['host']} - Negotiated SSH settings: {self.negotiated}"
+        )
+        if self.health_check_interval and not self._thread:
+            self._thread = Thread(
+                target=self._run, name="sftp-pool-health", daemon=True
+            )
+            self._thread.start()
+
+    def healthy_session(self, index: int) -> SFTPClient:
+        """
+        Returns the session at ``index``, re-opening it if it was closed. A new channel is opened
+        on its transport if that is still active, otherwise the transport is replaced.
+        """
+        sftp_fd = self.sessions[index]
+        if is_healthy(sftp_fd):
+            return sftp_fd
+        LOG.warning(f"SFTP session {index} is closed. Re-opening it.")
+        close_session(sftp_fd)
+        slot = index % self.connections
+        with self._lock:
+            transport = self.transports[slot]
+            if transport and transport.is_active():
+                sftp_fd = SFTPClient.from_transport(transport)
+            else:
+                if transport:
+                    transport.close()
+                sftp_fd = self.reconnect()
+                self.transports[slot] = sftp_fd.get_channel().get_transport()
+                self.reconnections += 1
+            self.sessions[index] = sftp_fd
+        return sftp_fd
+
+    @contextmanager
+    def checkout(self):
+        """
+        Context manager that gives exclusive use of one of the SFTP sessions, until exited.
+        """
+        index = self._available.get()
+        try:
+            yield self.healthy_session(index)
+        finally:
+            self._available.put(index)
+
+    def check_connections(self) -> None:
+        """
+        Replaces the transports that are no longer active and tops up the spare connections.
+        The sessions over a replaced transport open a new channel when next checked out.
+        """
+        for slot, transport in enumerate(self.transports):
+            if self._stopped.is_set():
+                return
+            if transport and transport.is_active():
+                continue
+            LOG.warning(f"SFTP connection {slot} is closed. Reconnecting.")
+            with self._lock:
+                if self.transports[slot] is not transport:
+                    continue
+                if transport:
+                    transport.close()
+                sftp_fd = self.reconnect()
+                self.transports[slot] = sftp_fd.get_channel().get_transport()
+                close_session(sftp_fd)
+                self.reconnections += 1
+        while self._spares.qsize() < self.spares and not self._stopped.is_set():
+            self._spares.put(self.new_connection())
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.health_check_interval):
+            try:
+                self.check_connections()
+            except Exception as error:
+                LOG.error("SFTP connections health check failed")
+                LOG.exception(error)
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for sftp_fd in self.sessions:
+                close_session(sftp_fd)
+            for transport in self.transports:
+                if transport:
+                    transport.close()
+            while not self._spares.empty():
+                close_session(self._spares.get_nowait(), with_transport=True)
+            self.sessions = []
+            self.transports = []
+            self._available = Queue()
+
+
+def is_healthy(sftp_fd: SFTPClient) -> bool:
+    """
+    Whether the session channel and its transport are still opened.
+    """
+    channel = sftp_fd.get_channel()
+    if channel is None or channel.closed:
+        return False
+    transport = channel.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def close_session(sftp_fd: SFTPClient, with_transport: bool = False) -> None:
+    try:
+        transport = sftp_fd.get_channel().get_transport()
+        sftp_fd.close()
+        if with_transport and transport:
+            transport.close()
+    except Exception as error:
+        LOG.debug(f"Error closing SFTP session: {error}")
@@ -0,0 +1,158 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Batching of the SQS messages deletions and visibility changes.
+"""
+
+from __future__ import annotations
+
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable, Iterable, Iterator
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.timers import TIMERS
+
+SQS_BATCH_SIZE: int = 10
+SQS_MAX_VISIBILITY_TIMEOUT: int = 43200
+
+
+def batch_entries(entries: Iterable, size: int = SQS_BATCH_SIZE) -> Iterator[list]:
+    """
+    Splits the entries into lists of up to ``size`` entries, the maximum SQS batch calls accept.
+    """
+    batch: list = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class SQSBatcher:
+    """
+    Accumulates the messages deletions and visibility changes, and sends them with
+    delete_message_batch / change_message_visibility_batch, up to 10 messages per call.
+    Flushed every ``flush_interval`` seconds once started, and whenever ``flush`` is called.
+    Entries that failed on the SQS side are retried on the next flush, the others are dropped.
+    ``on_delete`` is called with the messages deleted, after each flush.
+    """
+
+    def __init__(self, queue, flush_interval: int = 0, on_delete: Callable = None):
+        self.client = queue.meta.client
+        self.queue_url = queue.url
+        self.flush_interval = flush_interval
+        self.on_delete = on_delete
+        self._deletes: dict = {}
+        self._visibility: dict = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def delete(self, message) -> None:
+        with self._lock:
+            self._visibility.pop(message.receipt_handle, None)
+            self._deletes[message.receipt_handle] = message
+
+    def change_visibility(self, message, visibility_timeout: int) -> None:
+        with self._lock:
+            if message.receipt_handle in self._deletes:
+                return
+            self._visibility[message.receipt_handle] = (
+                message,
+                min(int(visibility_timeout), SQS_MAX_VISIBILITY_TIMEOUT),
+            )
+
+    def start(self) -> None:
+        if self.flush_interval and not self._thread:
+            self._thread = Thread(target=self._run, name="sqs-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                LOG.error("Failed to flush SQS messages acknowledgements")
+                LOG.exception(error)
+
+    def flush(self) -> list:
+        """
+        Sends the pending visibility changes, then the deletions.
+
+        :return: the entries that could not be processed and will not be retried
+        """
+        with self._flush_lock:
+            with self._lock:
+                visibility, self._visibility = self._visibility, {}
+                deletes, self._deletes = self._deletes, {}
+            if not (visibility or deletes):
+                return []
+            ack_start = monotonic()
+            failed = self._send(
+                self.client.change_message_visibility_batch,
+                [
+                    {
+                        "ReceiptHandle": handle,
+                        "VisibilityTimeout": timeout,
+                    }
+                    for handle, (_message, timeout) in visibility.items()
+                ],
+                retry=lambda handle: handle in self._deletes
+                or self._visibility.setdefault(handle, visibility[handle]),
+            )
+            failed += self._send(
+                self.client.delete_message_batch,
+                [{"ReceiptHandle": handle} for handle in deletes],
+                retry=lambda handle: self._deletes.setdefault(handle, deletes[handle]),
+            )
+            TIMERS.record("ack", monotonic() - ack_start)
+            if deletes:
+                LOG.debug(f"Deleted {len(deletes)} messages")
+            if deletes and self.on_delete:
+                not_deleted = {entry["ReceiptHandle"] for entry in failed}
+                with self._lock:
+                    not_deleted.update(self._deletes)
+                deleted = [
+                    message
+                    for handle, message in deletes.items()
+                    if handle not in not_deleted
+                ]
+                if deleted:
+                    self.on_delete(deleted)
+            return failed
+
+    def _send(self, api_call, entries: list, retry) -> list:
+        failed_entries: list = []
+        for batch in batch_entries(entries):
+            by_id: dict = {}
+            for index, entry in enumerate(batch):
+                entry["Id"] = str(index)
+                by_id[entry["Id"]] = entry
+            try:
+                response = api_call(QueueUrl=self.queue_url, Entries=batch)
+            except Exception as error:
+                LOG.error(f"{api_call.__name__} failed. Retrying on next flush.")
+                LOG.exception(error)
+                with self._lock:
+                    for entry in batch:
+                        retry(entry["ReceiptHandle"])
+                continue
+            for failed in response.get("Failed", []):
+                entry = by_id[failed["Id"]]
+                if failed.get("SenderFault"):
+                    LOG.error(
+                        f"{api_call.__name__} - {failed.get('Code')}: {failed.get('Message')}"
+                    )
+                    failed_entries.append(entry)
+                else:
+                    with self._lock:
+                        retry(entry["ReceiptHandle"])
+        return failed_entries
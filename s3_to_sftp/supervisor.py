@@ -0,0 +1,177 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Runs several workers, each in its own process, to use more than one CPU core for the SFTP transfers.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import signal
+from os import path
+from queue import Empty
+from time import monotonic
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.timers import metric_scope
+
+STATS_KEYS: list = ["files_processed", "files_failed", "total_files_size"]
+
+
+def run_worker(
+    queue_url: str, sftp_info: dict, stats_queue: multiprocessing.Queue, kwargs: dict
+) -> None:
+    """
+    Child process target. SIGINT is ignored so that a Ctrl+C on the process group is handled by the
+    supervisor only, which then sends SIGTERM to the workers.
+    """
+    from s3_to_sftp.worker import Worker
+
+    worker = Worker(queue_url, sftp_info)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker.stats_queue = stats_queue
+    worker.run(**kwargs)
+
+
+class Supervisor:
+    """
+    Starts ``processes`` workers sharing the same queue, each with its own SFTP connection(s).
+    Restarts the workers that exit, with an exponential backoff when these keep failing, and combines
+    the workers transfer statistics into a single set of metrics every ``report_every`` seconds.
+    On SIGTERM/SIGINT, the workers are sent SIGTERM to finish their in-flight transfers, and the
+    supervisor waits for them. A second signal kills them.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        queue_url: str,
+        sftp_info: dict,
+        report_every: int = 60,
+        **kwargs,
+    ):
+        self.processes = processes
+        self.queue_url = queue_url
+        self.sftp_info = sftp_info
+        self.report_every = report_every
+        self.kwargs = kwargs
+        self.context = multiprocessing.get_context("spawn")
+        self.stats_queue = self.context.Queue()
+        self.children: list = [None] * processes
+        self.started_at: list = [0.0] * processes
+        self.failures: list = [0] * processes
+        self.restart_at: list = [0.0] * processes
+        self.restarts = 0
+        self.stats: dict = dict.fromkeys(STATS_KEYS, 0)
+        self.keep_running = True
+
+    @property
+    def queue_name(self) -> str:
+        return self.queue_url.rstrip("/").rsplit("/", 1)[-1]
+
+    def start_child(self, index: int) -> None:
+        kwargs = dict(self.kwargs)
+        if kwargs.get("metrics_port"):
+            kwargs["metrics_port"] += index
+        if kwargs.get("journal"):
+            root, extension = path.splitext(kwargs["journal"])
+            kwargs["journal"] = f"{root}-{index}{extension}"
+        child = self.context.Process(
+            target=run_worker,
+            args=(self.queue_url, self.sftp_info, self.stats_queue, kwargs),
+            name=f"s3-to-sftp-worker-{index}",
+        )
+        child.start()
+        self.children[index] = child
+        self.started_at[index] = monotonic()
+        LOG.info(f"Started worker {index} - PID {child.pid}")
+
+    def check_children(self) -> None:
+        """
+        Restarts the workers that exited. A worker that ran for less than a minute is restarted after
+        an exponentially growing delay.
+        """
+        now = monotonic()
+        for index, child in enumerate(self.children):
+            if child is not None and child.is_alive():
+                continue
+            if child is not None:
+                LOG.warning(
+                    f"Worker {index} - PID {child.pid} exited with code {child.exitcode}"
+                )
+                if now - self.started_at[index] < 60:
+                    self.failures[index] += 1
+                else:
+                    self.failures[index] = 0
+                self.restart_at[index] = now + min(2 ** self.failures[index] - 1, 60)
+                self.children[index] = None
+                self.restarts += 1
+            if now >= self.restart_at[index]:
+                self.start_child(index)
+
+    def collect_stats(self, timeout: float) -> None:
+        try:
+            stats = self.stats_queue.get(timeout=timeout)
+        except Empty:
+            return
+        for key in STATS_KEYS:
+            self.stats[key] += stats.get(key, 0)
+
+    @metric_scope
+    def publish_stats(self, metrics) -> None:
+        metrics.set_namespace("S3ToSFTP")
+        metrics.put_dimensions({"Queue": self.queue_name})
+        metrics.put_metric(
+            "WorkersRunning",
+            float(
+                len([child for child in self.children if child and child.is_alive()])
+            ),
+            "None",
+        )
+        metrics.put_metric("WorkersRestarts", float(self.restarts), "None")
+        metrics.put_metric(
+            "AllWorkersFilesProcessed", float(self.stats["files_processed"]), "None"
+        )
+        metrics.put_metric(
+            "AllWorkersFilesFailed", float(self.stats["files_failed"]), "None"
+        )
+        metrics.put_metric(
+            "AllWorkersTotalFilesSize", float(self.stats["total_files_size"]), "Bytes"
+        )
+        LOG.info(f"{self.queue_name} - All workers: {self.stats}")
+        self.stats = dict.fromkeys(STATS_KEYS, 0)
+        self.restarts = 0
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+        LOG.info(f"Starting {self.processes} workers")
+        last_report = monotonic()
+        while self.keep_running:
+            self.check_children()
+            self.collect_stats(timeout=1)
+            if monotonic() - last_report >= self.report_every:
+                self.publish_stats()
+                last_report = monotonic()
+        for child in self.children:
+            if child is not None:
+                child.join()
+        while not self.stats_queue.empty():
+            self.collect_stats(timeout=0)
+        self.publish_stats()
+        LOG.info("All workers stopped")
+
+    def exit_gracefully(self, signum: int, frame):
+        """
+        Propagates the signal to the workers so they finish the in-flight transfers. Kills them on second signal.
+        """
+        children = [child for child in self.children if child and child.is_alive()]
+        if not self.keep_running:
+            LOG.warning(f"Received signal {signum} again. Killing the workers.")
+            for child in children:
+                child.kill()
+            return
+        LOG.warning(f"Received signal {signum}. Stopping the workers.")
+        self.keep_running = False
+        for child in children:
+            child.terminate()
@@ -0,0 +1,154 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Model of the observed transfer rates, used to estimate transfers duration and size the batches.
+"""
+
+from __future__ import annotations
+
+import json
+from os import makedirs, path, replace
+from threading import Lock
+
+from s3_to_sftp.logger import LOG
+
+MB: int = 1024**2
+
+SIZE_CLASSES: list = [
+    ("1MB", 1 * MB),
+    ("16MB", 16 * MB),
+    ("128MB", 128 * MB),
+    ("1GB", 1024 * MB),
+    ("16GB", 16 * 1024 * MB),
+]
+LARGEST_SIZE_CLASS: str = "16GB+"
+
+
+class ThroughputModel:
+    """
+    Exponentially weighted moving average of the transfer rate, in MB/s, for each class of file size.
+    Small files transfer rate is mostly the per file overhead, so each class is learned on its own.
+    The model can be persisted to a state file, so that a restarted worker starts with it.
+    """
+
+    def __init__(
+        self,
+        default_rate: float = 1,
+        smoothing: float = 0.3,
+        state_file: str = None,
+    ):
+        self.default_rate = default_rate
+        self.smoothing = smoothing
+        self.state_file = state_file
+        self.rates: dict = {}
+        self.average_file_size: float = 0
+        self._lock = Lock()
+        if state_file and path.exists(state_file):
+            self.load()
+
+    @staticmethod
+    def size_class(file_size: int) -> str:
+        for name, upper_bound in SIZE_CLASSES:
+            if file_size < upper_bound:
+                return name
+        return LARGEST_SIZE_CLASS
+
+    def ewma(self, previous: float, value: float) -> float:
+        if not previous:
+            return value
+        return self.smoothing * value + (1 - self.smoothing) * previous
+
+    def observe(self, file_size: int, duration: float) -> None:
+        """
+        Records the transfer of ``file_size`` bytes in ``duration`` seconds.
+        """
+        if duration <= 0:
+            return
+        rate = (file_size / MB) / duration
+        size_class = self.size_class(file_size)
+        with self._lock:
+            self.rates[size_class] = self.ewma(self.rates.get(size_class), rate)
+            self.average_file_size = self.ewma(self.average_file_size, file_size)
+
+    def rate_for(self, file_size: int) -> float:
+        """
+        Expected transfer rate, in MB/s, for a file of that size. Defaults to the closest size class
+        observed, else to the default rate.
+        """
+        size_class = self.size_class(file_size)
+        with self._lock:
+            if size_class in self.rates:
+                return self.rates[size_class]
+            names = [name for name, _ in SIZE_CLASSES] + [LARGEST_SIZE_CLASS]
+            index = names.index(size_class)
+            known = sorted(
+                (abs(names.index(name) - index), name) for name in self.rates
+            )
+            if known:
+                return self.rates[known[0][1]]
+        return self.default_rate
+
+    def expected_duration(self, file_size: int) -> float:
+        return (file_size / MB) / max(self.rate_for(file_size), 0.001)
+
+    def batch_size(
+        self, max_batch: int, time_budget: float, concurrency: int = 1
+    ) -> int:
+        """
+        Number of messages that can be transferred within ``time_budget`` seconds, based on the average
+        file size observed, between 1 and ``max_batch``.
+        """
+        if not self.average_file_size:
+            return max_batch
+        per_file = self.expected_duration(int(self.average_file_size))
+        if per_file <= 0:
+            return max_batch
+        return int(min(max(time_budget * concurrency // per_file, 1), max_batch))
+
+    def large_file_threshold(self, default: int, max_duration: float = 120) -> int:
+        """
+        Size from which a single stream transfer is expected to take more than ``max_duration`` seconds,
+        based on the rate observed for the largest files. Returns ``default`` until such files were observed.
+        """
+        with self._lock:
+            large_rates = [
+                self.rates[name]
+                for name in ["128MB", "1GB", "16GB", LARGEST_SIZE_CLASS]
+                if name in self.rates
+            ]
+        if not large_rates or not default:
+            return default
+        return int(max(large_rates[-1] * max_duration * MB, 16 * MB))
+
+    def load(self) -> None:
+        try:
+            with open(self.state_file) as state_fd:
+                state = json.load(state_fd)
+            self.rates = {
+                size_class: float(rate)
+                for size_class, rate in state.get("rates", {}).items()
+            }
+            self.average_file_size = float(state.get("average_file_size", 0))
+            LOG.info(f"Loaded transfer rates from {self.state_file}: {self.rates}")
+        except (OSError, ValueError, AttributeError) as error:
+            LOG.warning(f"Unable to load transfer rates from {self.state_file}")
+            LOG.exception(error)
+
+    def save(self) -> None:
+        if not self.state_file:
+            return
+        with self._lock:
+            state = {
+                "rates": dict(self.rates),
+                "average_file_size": self.average_file_size,
+            }
+        try:
+            directory = path.dirname(path.abspath(self.state_file))
+            makedirs(directory, exist_ok=True)
+            temp_file = f"{self.state_file}.tmp"
+            with open(temp_file, "w") as state_fd:
+                json.dump(state, state_fd)
+            replace(temp_file, self.state_file)
+        except OSError as error:
+            LOG.warning(f"Unable to save transfer rates to {self.state_file}")
+            LOG.exception(error)
@@ -0,0 +1,263 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Timers of the phases of the messages and files transfers, emitted with the transfer metrics and,
+optionally, exposed in the OpenMetrics format over HTTP.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import sysconf
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable, Iterable, Iterator
+
+from s3_to_sftp.logger import LOG
+
+PHASES: dict = {
+    "receive": "ReceiveDuration",
+    "queue_wait": "QueueWaitDuration",
+    "parse": "ParseDuration",
+    "s3_first_byte": "S3FirstByteDuration",
+    "s3_download": "S3DownloadDuration",
+    "mkdir": "MkdirDuration",
+    "sftp_open": "SftpOpenDuration",
+    "sftp_write": "SftpWriteDuration",
+    "verify": "VerifyDuration",
+    "throttle": "ThrottleDuration",
+    "ack": "AckDuration",
+}
+BUCKETS: tuple = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+    1800.0,
+)
+METRIC_NAME = "s3_to_sftp_phase_duration_seconds"
+
+
+class Stopwatch:
+    """
+    Accumulates the time spent within its context, over several uses.
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self._start = 0.0
+
+    def __enter__(self) -> Stopwatch:
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed += monotonic() - self._start
+
+
+class PhaseTimers:
+    """
+    Records the duration of each phase. The durations recorded since the last ``flush`` are
+    emitted as EMF metrics values. Histograms of all the durations are kept for the OpenMetrics
+    endpoint.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._samples: dict = {phase: [] for phase in PHASES}
+        self._buckets: dict = {phase: [0] * (len(BUCKETS) + 1) for phase in PHASES}
+        self._sums: dict = dict.fromkeys(PHASES, 0.0)
+
+    def record(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[phase].append(seconds)
+            self._buckets[phase][bisect_left(BUCKETS, seconds)] += 1
+            self._sums[phase] += seconds
+
+    @contextmanager
+    def time(self, phase: str):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, monotonic() - start)
+
+    def timed(self, iterable: Iterable, phase: str) -> Iterator:
+        """
+        Iterates over ``iterable``, recording the total time spent waiting for its items as one duration.
+        """
+        stopwatch = Stopwatch()
+        iterator = iter(iterable)
+        try:
+            while True:
+                with stopwatch:
+                    item = next(iterator, stopwatch)
+                if item is stopwatch:
+                    return
+                yield item
+        finally:
+            self.record(phase, stopwatch.elapsed)
+
+    def flush(self) -> dict:
+        """
+        :return: the durations recorded for each phase since the last flush
+        """
+        with self._lock:
+            samples = {
+                phase: values for phase, values in self._samples.items() if values
+            }
+            self._samples = {phase: [] for phase in PHASES}
+        return samples
+
+    def emit(self, metrics) -> None:
+        """
+        Puts the durations recorded since the last flush into the EMF metrics scope.
+        """
+        for phase, values in self.flush().items():
+            for value in values:
+                metrics.put_metric(PHASES[phase], float(value), "Seconds")
+
+    def render(self) -> str:
+        """
+        :return: the phases durations histograms, in the OpenMetrics text format
+        """
+        lines = [
+            f"# TYPE {METRIC_NAME} histogram",
+            f"# UNIT {METRIC_NAME} seconds",
+            f"# HELP {METRIC_NAME} Duration of the S3 to SFTP transfers phases.",
+        ]
+        with self._lock:
+            for phase in PHASES:
+                count = 0
+                for bound, bucket in zip(BUCKETS + ("+Inf",), self._buckets[phase]):
+                    count += bucket
+                    lines.append(
+                        f'{METRIC_NAME}_bucket{{phase="{phase}",le="{bound}"}} {count}'
+                    )
+                lines.append(f'{METRIC_NAME}_count{{phase="{phase}"}} {count}')
+                lines.append(
+                    f'{METRIC_NAME}_sum{{phase="{phase}"}} {self._sums[phase]}'
+                )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+TIMERS = PhaseTimers()
+
+
+def process_uptime() -> float:
+    """
+    :return: seconds since the process started, interpreter start and imports included, from /proc.
+      0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/stat") as stat_fd:
+            start_ticks = int(stat_fd.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime_fd:
+            uptime = float(uptime_fd.read().split()[0])
+        return max(uptime - start_ticks / sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupClock:
+    """
+    Times the worker startup from the process start: until it is ready to poll the queue, and until the
+    first byte is sent to an SFTP target. Both are emitted once, with the metrics following the first byte.
+    """
+
+    def __init__(self):
+        self.started = monotonic() - process_uptime()
+        self.ready: float = None
+        self.first_byte: float = None
+        self.emitted = False
+        self._lock = Lock()
+
+    def mark_ready(self) -> None:
+        with self._lock:
+            if self.ready is not None:
+                return
+            self.ready = monotonic() - self.started
+        LOG.info(f"Ready to poll the queue {self.ready:.3f}s after start")
+
+    def mark_first_byte(self) -> None:
+        with self._lock:
+            if self.first_byte is not None:
+                return
+            self.first_byte = monotonic() - self.started
+        LOG.info(f"First byte sent to SFTP {self.first_byte:.3f}s after start")
+
+    def emit(self, metrics) -> None:
+        with self._lock:
+            if self.emitted or self.first_byte is None:
+                return
+            self.emitted = True
+        if self.ready is not None:
+            metrics.put_metric("StartupDuration", float(self.ready), "Seconds")
+        metrics.put_metric("TimeToFirstByte", float(self.first_byte), "Seconds")
+
+
+STARTUP = StartupClock()
+
+
+def metric_scope(function: Callable) -> Callable:
+    """
+    ``aws_embedded_metrics.metric_scope``, imported when the function is first called instead of on
+    start, as it pulls aiohttp in, which is not needed before the first metrics are emitted.
+    """
+    scoped: list = []
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not scoped:
+            from aws_embedded_metrics import metric_scope as emf_metric_scope
+
+            scoped.append(emf_metric_scope(function))
+        return scoped[0](*args, **kwargs)
+
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = TIMERS.render().encode()
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            "application/openmetrics-text; version=1.0.0; charset=utf-8",
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """
+    Serves the phases timers on ``http://0.0.0.0:<port>/metrics``, from a background thread.
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    LOG.info(f"Serving OpenMetrics on port {port}")
+    return server
@@ -1,7 +1,12 @@
 # Copyright (C) 2020-2022 John Mille <john@ews-network.net>
 
+from __future__ import annotations
+
 import json
 from tempfile import TemporaryDirectory
+from threading import Lock
+from time import monotonic
+from urllib.parse import unquote_plus
 
 from boto3 import Session
 from compose_x_common.compose_x_common import set_else_none
@@ -12,10 +17,115 @@ from s3_to_sftp.transfer_handler import FileHandler
 MB: int = 1024**2
 
 
+def s3_record_file_information(record: dict) -> dict:
+    """
+    Function to return the file information from a S3 event notification record.
+    Object keys are URL encoded in these notifications.
+    """
+    return {
+        "bucket_name": record["s3"]["bucket"]["name"],
+        "object": unquote_plus(record["s3"]["object"]["key"]),
+        "size": int(record["s3"]["object"]["size"]),
+        "etag": set_else_none("eTag", record["s3"]["object"]),
+        "version_id": set_else_none("versionId", record["s3"]["object"]),
+    }
+
+
+def eventbridge_file_information(event: dict) -> dict:
+    """
+    Function to return the file information from an EventBridge S3 Object Created event.
+    """
+    return {
+        "bucket_name": event["detail"]["bucket"]["name"],
+        "object": event["detail"]["object"]["key"],
+        "size": int(event["detail"]["object"]["size"]),
+        "etag": set_else_none("etag", event["detail"]["object"]),
+        "version_id": set_else_none("version-id", event["detail"]["object"]),
+    }
+
+
+def get_files_information(body: str) -> list[dict]:
+    """
+    Function to return the information of all the files to transfer from a message body.
+    Supports S3 event notifications (with several records), wrapped in SNS notifications or not,
+    and EventBridge S3 events. S3 test events and other events than object creation give no file.
+    """
+    event = json.loads(body)
+    if not isinstance(event, dict):
+        raise TypeError("Message body must be a JSON object. Got", type(event))
+    if event.get("Type") == "Notification" and "Message" in event:
+        return get_files_information(event["Message"])
+    if event.get("Event") == "s3:TestEvent":
+        LOG.info(f"Ignoring S3 test event for bucket {event.get('Bucket')}")
+        return []
+    if event.get("source") == "aws.s3" and "detail-type" in event:
+        if event["detail-type"] != "Object Created":
+            LOG.info(f"Ignoring S3 {event['detail-type']} event")
+            return []
+        return [eventbridge_file_information(event)]
+    records = set_else_none("Records", event, alt_value=[])
+    if not isinstance(records, list):
+        raise TypeError("Records must be a list. Got", type(records))
+    files_information: list = []
+    for record in records:
+        event_name = set_else_none("eventName", record, alt_value="ObjectCreated")
+        if not event_name.startswith("ObjectCreated"):
+            LOG.info(f"Ignoring S3 {event_name} event")
+            continue
+        files_information.append(s3_record_file_information(record))
+    return files_information
+
+
+class TransferMessage:
+    """
+    SQS message and the files to transfer it carries. The message is to be deleted only once the transfers
+    of all of its files succeeded. The files already transferred, from a previous delivery of the same message,
+    are kept in ``completed_units`` and are not transferred again.
+    """
+
+    def __init__(self, message, completed_units: set = None):
+        self.message = message
+        self.completed_units: set = (
+            completed_units if completed_units is not None else set()
+        )
+        self.files: list[TransferFile] = []
+        for file_info in get_files_information(message.body):
+            transfer_file = TransferFile(message, file_info, transfer_message=self)
+            if transfer_file.unit_key in self.completed_units:
+                LOG.info(
+                    f"{transfer_file.file_name} - Already transferred for message {message.message_id}"
+                )
+                continue
+            self.files.append(transfer_file)
+        self.pending = len(self.files)
+        self.failed = False
+        self._lock = Lock()
+
+    def unit_done(self, transfer_file: TransferFile, success: bool) -> bool:
+        """
+        Records the result of one of the message files transfers.
+
+        :return: Whether all the files of the message are now successfully transferred.
+        """
+        with self._lock:
+            if success:
+                self.completed_units.add(transfer_file.unit_key)
+            else:
+                self.failed = True
+            self.pending -= 1
+            return not self.pending and not self.failed
+
+
 class TransferFile:
-    def __init__(self, message):
+    def __init__(
+        self,
+        message,
+        file_info: dict = None,
+        transfer_message: TransferMessage = None,
+    ):
         self.message = message
-        self.file_info = self.get_file_information()
+        self.transfer_message = transfer_message
+        self.file_info = file_info if file_info else self.get_file_information()
         self.file_name = self.file_info["object"]
         self.file_size = self.file_info["size"]
         self.s3_bucket = self.file_info["bucket_name"]
@@ -24,6 +134,25 @@ class TransferFile:
         self.file_transfer_status = "PENDING"
         self.temp_dir = TemporaryDirectory()
         self.file_handler = None
+        self.target = None
+        self.bytes_transferred: int = 0
+        self.resume_offset: int = 0
+        self.checksums: dict = {}
+        self.last_progress_time: float = monotonic()
+        self._progress_lock = Lock()
+
+    @property
+    def unit_key(self) -> tuple:
+        """
+        Identifies the object version to transfer, among the files of a message.
+        """
+        return (
+            self.s3_bucket,
+            self.file_name,
+            set_else_none("version_id", self.file_info)
+            or set_else_none("etag", self.file_info)
+            or self.file_size,
+        )
 
     @property
     def file_transfer_duration(self) -> float:
@@ -39,13 +168,31 @@ class TransferFile:
             return int((self.file_size / MB) / self.file_transfer_duration)
         return -1
 
-    def set_file_handler(self, sftp_info: dict, session: Session):
+    def record_progress(self, nbytes: int) -> None:
+        """
+        Records that ``nbytes`` more bytes were moved, by any of the transfer steps.
+        """
+        with self._progress_lock:
+            self.bytes_transferred += nbytes
+            self.last_progress_time = monotonic()
+
+    def set_file_handler(
+        self,
+        sftp_info: dict,
+        session: Session,
+        s3_client=None,
+        directories_cache=None,
+        rate_limiter=None,
+    ):
         self.file_handler = FileHandler(
             self.s3_bucket,
             self.file_name,
             self.temp_dir,
             sftp_info,
             session=session,
+            s3_client=s3_client,
+            directories_cache=directories_cache,
+            rate_limiter=rate_limiter,
         )
 
     def file_transfer_duration_estimate(
@@ -74,14 +221,7 @@ class TransferFile:
 
     def get_file_information(self) -> dict:
         """
-        Function to return the file information from the event
+        Function to return the information of the first file from the event
         """
-        records = set_else_none("Records", json.loads(self.message.body), alt_value=[])
-        if not isinstance(records, list):
-            raise TypeError("Records must be a list. Got", type(records))
-        for record in records:
-            return {
-                "bucket_name": record["s3"]["bucket"]["name"],
-                "object": record["s3"]["object"]["key"],
-                "size": int(record["s3"]["object"]["size"]),
-            }
+        for file_info in get_files_information(self.message.body):
+            return file_info
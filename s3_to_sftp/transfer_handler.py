@@ -6,38 +6,168 @@ Module to handle the SFTP files transfer.
 
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Union
+from typing import TYPE_CHECKING, Callable, Iterator, Union
 
 if TYPE_CHECKING:
     from boto3.session import Session
     from s3_to_sftp.transfer_file import TransferFile
 
+from collections import OrderedDict
 from datetime import datetime as dt
 from os import path
+from queue import Empty, Full, Queue
 from tempfile import TemporaryDirectory
+from threading import Event, Lock, Thread
+from time import monotonic
 
 from compose_x_common.aws import get_session
 from compose_x_common.compose_x_common import keyisset, set_else_none
-from paramiko import AutoAddPolicy, SFTPClient, SSHClient, Transport
-from paramiko.ssh_exception import AuthenticationException
+from paramiko import ECDSAKey, Ed25519Key, PKey, RSAKey, SFTPClient, Transport
+from paramiko.ssh_exception import AuthenticationException, SSHException
 
+from s3_to_sftp.checksums import ChecksumReader, TransferChecksums, etag_md5
 from s3_to_sftp.logger import LOG
+from s3_to_sftp.rate_limit import RateLimiter, ThrottledReader
+from s3_to_sftp.timers import TIMERS, Stopwatch
 
+MB: int = 1024**2
+DEFAULT_STREAM_CHUNK_SIZE: int = 8 * MB
+DEFAULT_RANGE_SIZE: int = 64 * MB
 
-def recursive_mkdir(sftp, remote_directory):
-    if remote_directory == "/":
-        sftp.chdir("/")
+
+class RemoteDirectoryCache:
+    """
+    Thread-safe LRU of the remote directories known to exist, to avoid checking for these on every file.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._directories: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, remote_directory: str) -> bool:
+        with self._lock:
+            if remote_directory in self._directories:
+                self._directories.move_to_end(remote_directory)
+                return True
+        return False
+
+    def add(self, remote_directory: str) -> None:
+        with self._lock:
+            self._directories[remote_directory] = True
+            self._directories.move_to_end(remote_directory)
+            while len(self._directories) > self.max_size:
+                self._directories.popitem(last=False)
+
+    def discard(self, remote_directory: str) -> None:
+        """
+        Removes the directory, its parents and its children, as any of these might be gone.
+        """
+        remote_directory = remote_directory.rstrip("/")
+        with self._lock:
+            for known_directory in list(self._directories.keys()):
+                if (
+                    known_directory == remote_directory
+                    or known_directory.startswith(f"{remote_directory}/")
+                    or remote_directory.startswith(f"{known_directory.rstrip('/')}/")
+                ):
+                    del self._directories[known_directory]
+
+
+def recursive_mkdir(
+    sftp, remote_directory: str, cache: RemoteDirectoryCache = None
+) -> None:
+    """
+    Creates the remote directory and its missing parents. Uses the full path for stat and mkdir,
+    so the session working directory is left unchanged and the session can be shared.
+    """
+    remote_directory = remote_directory.rstrip("/")
+    if remote_directory in ["", "."]:
         return
-    if remote_directory == "":
+    if cache is not None and remote_directory in cache:
         return
     try:
-        sftp.chdir(remote_directory)
+        sftp.stat(remote_directory)
+    except FileNotFoundError:
+        recursive_mkdir(sftp, path.dirname(remote_directory), cache)
+        try:
+            sftp.mkdir(remote_directory)
+        except OSError:
+            sftp.stat(remote_directory)
+            LOG.debug(f"{remote_directory} was created concurrently")
+    if cache is not None:
+        cache.add(remote_directory)
+
+
+def progress_callback(transfer_file: TransferFile) -> Callable[[int, int], None]:
+    """
+    Returns a paramiko transfer callback, which gets the total bytes so far, recording the progress.
+    """
+    bytes_so_far: list = [0]
+
+    def _callback(transferred: int, _total: int) -> None:
+        transfer_file.record_progress(transferred - bytes_so_far[0])
+        bytes_so_far[0] = transferred
+
+    return _callback
+
+
+def read_ahead(chunks: Iterator[bytes], depth: int) -> Iterator[bytes]:
+    """
+    Iterates over ``chunks`` from a separate thread, keeping up to ``depth`` chunks read ahead of the
+    consumer, so that reading the next chunks overlaps with processing the current one.
+    """
+    buffer: Queue = Queue(maxsize=depth)
+    done = Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not done.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(end)
+        except Exception as error:
+            put(error)
+
+    thread = Thread(target=reader, name="read-ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = buffer.get()
+            if chunk is end:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        done.set()
+
+
+def replace_remote(sftp_fd, source: str, destination: str) -> None:
+    """
+    Renames the remote ``source`` file to ``destination``, replacing it if it exists. Uses the posix-rename
+    extension if the server supports it, else removes ``destination`` first, as plain renames do not replace.
+    """
+    try:
+        sftp_fd.posix_rename(source, destination)
+        return
     except OSError:
-        dirname, basename = path.split(remote_directory.rstrip("/"))
-        recursive_mkdir(sftp, dirname)
-        sftp.mkdir(basename)
-        sftp.chdir(basename)
-        return True
+        pass
+    try:
+        sftp_fd.remove(destination)
+    except FileNotFoundError:
+        pass
+    sftp_fd.rename(source, destination)
 
 
 class FileHandler:
@@ -49,9 +179,131 @@ class FileHandler:
     bucket_name = None
     connection = None
 
-    def push(self, sftp_fd, transfer_file: TransferFile) -> None:
+    def make_remote_dirs(self, sftp_fd) -> None:
+        with TIMERS.time("mkdir"):
+            recursive_mkdir(
+                sftp_fd, path.dirname(self.remote_file_path), self.directories_cache
+            )
+
+    def with_remote_dirs(self, sftp_fd, operation: Callable):
+        """
+        Runs the remote operation. If it fails because the remote directory does not exist (anymore),
+        the directory is removed from the cache, created again, and the operation retried once.
+        """
+        try:
+            return operation()
+        except FileNotFoundError:
+            if self.directories_cache is None:
+                raise
+            LOG.warning(
+                f"{path.dirname(self.remote_file_path)} not found. Creating it again."
+            )
+            self.directories_cache.discard(path.dirname(self.remote_file_path))
+            self.make_remote_dirs(sftp_fd)
+            return operation()
+
+    def remote_checksum_matches(self, sftp_fd, transfer_file: TransferFile) -> bool:
+        """
+        Compares the remote file MD5, computed by the server, with the S3 object ETag. Only possible
+        for objects not uploaded in multiple parts nor encrypted with SSE-KMS or SSE-C, and with servers
+        supporting the check-file extension. Considered matching when not possible to compare.
+        """
+        etag = str(set_else_none("etag", transfer_file.file_info, alt_value="")).strip(
+            '"'
+        )
+        if not etag or "-" in etag:
+            return True
+        try:
+            with sftp_fd.open(self.remote_file_path, "rb") as remote_fd:
+                if remote_fd.check("md5").hex() == etag:
+                    return True
+        except OSError as error:
+            LOG.debug(f"{self.remote_file_path} - Cannot get remote checksum: {error}")
+            return True
+        try:
+            s3_object = self.s3_client.head_object(
+                Bucket=self.bucket_name, Key=self.s3_path
+            )
+        except Exception as error:
+            LOG.debug(f"{self.s3_path} - Cannot get the object encryption: {error}")
+            return True
+        return etag_md5(s3_object) is None
+
+    def check_remote(
+        self, sftp_fd, transfer_file: TransferFile, resume: bool = False
+    ) -> None:
+        """
+        Checks for the file on the SFTP server. The transfer is marked as skipped when the remote file
+        is identical, or to resume from the remote file size when partial and ``resume`` is set.
         """
-        Function to upload the file to SFTP target.
+        try:
+            remote_size = sftp_fd.stat(self.remote_file_path).st_size
+        except FileNotFoundError:
+            return
+        except OSError as error:
+            LOG.warning(
+                f"{self.remote_file_path} - Failed to stat remote file: {error}"
+            )
+            return
+        if remote_size == transfer_file.file_size and self.remote_checksum_matches(
+            sftp_fd, transfer_file
+        ):
+            LOG.info(f"{self.remote_file_path} already on SFTP. Skipping.")
+            transfer_file.file_transfer_status = "SFTP_SKIPPED"
+        elif resume and 0 < remote_size < transfer_file.file_size:
+            LOG.info(
+                f"{self.remote_file_path} partially on SFTP."
+                f" Resuming from {remote_size}/{transfer_file.file_size} bytes."
+            )
+            transfer_file.resume_offset = remote_size
+
+    def expect_checksums(self, checksums: TransferChecksums) -> None:
+        """
+        Sets the checksums to verify from the object ones, read from head_object whatever the transfer mode.
+        """
+        checksums.expect(
+            self.s3_client.head_object(
+                Bucket=self.bucket_name, Key=self.s3_path, ChecksumMode="ENABLED"
+            )
+        )
+
+    def verify_checksums(
+        self, sftp_fd, transfer_file: TransferFile, checksums: TransferChecksums
+    ) -> None:
+        """
+        Compares the checksums computed during the transfer with the S3 ones, and with the server's
+        if requested and supported. Then writes the ``.sha256`` sidecar file, if requested.
+        """
+        transfer_file.checksums = checksums.verify(transfer_file.file_name)
+        if checksums.check_file:
+            try:
+                with sftp_fd.open(self.remote_file_path, "rb") as remote_fd:
+                    remote_sha256 = remote_fd.check("sha256").hex()
+            except OSError as error:
+                LOG.debug(
+                    f"{self.remote_file_path} - Cannot get remote checksum: {error}"
+                )
+            else:
+                if remote_sha256 != transfer_file.checksums["sha256"]:
+                    raise OSError(
+                        f"Remote sha256 checksum mismatch for {self.remote_file_path}!"
+                        f" {remote_sha256} != {transfer_file.checksums['sha256']}"
+                    )
+        if checksums.sidecar:
+            with sftp_fd.open(f"{self.remote_file_path}.sha256", "w") as sidecar_fd:
+                sidecar_fd.write(
+                    f"{transfer_file.checksums['sha256']}  {path.basename(self.remote_file_path)}\n"
+                )
+
+    def push(
+        self,
+        sftp_fd,
+        transfer_file: TransferFile,
+        checksums: TransferChecksums = None,
+    ) -> None:
+        """
+        Function to upload the file to SFTP target. With ``checksums``, these are computed over the
+        bytes read from the local file to be sent, after these are let through by the rate limiter.
         """
         if not path.exists(self.local_file_path):
             transfer_file.file_transfer_status = "SFTP_FAILED"
@@ -59,13 +311,34 @@ class FileHandler:
             raise FileNotFoundError(
                 f"File {self.local_file_path} not found. Aborting transfer."
             )
-        recursive_mkdir(sftp_fd, path.dirname(self.remote_file_path))
+        self.make_remote_dirs(sftp_fd)
 
         LOG.debug(self.local_file_path)
         LOG.debug(self.remote_file_path)
         transfer_file.file_transfer_start_time = dt.utcnow()
+        transfer_file.file_transfer_status = "SFTP_IN_PROGRESS"
         try:
-            sftp_fd.put(self.local_file_path, self.remote_file_path, confirm=True)
+            if checksums:
+                self.expect_checksums(checksums)
+            with open(self.local_file_path, "rb") as local_fd:
+                reader = ThrottledReader(local_fd, self.rate_limiter)
+                write_start = monotonic()
+                self.with_remote_dirs(
+                    sftp_fd,
+                    lambda: sftp_fd.putfo(
+                        ChecksumReader(reader, checksums) if checksums else reader,
+                        self.remote_file_path,
+                        file_size=path.getsize(self.local_file_path),
+                        callback=progress_callback(transfer_file),
+                        confirm=True,
+                    ),
+                )
+                TIMERS.record("sftp_write", monotonic() - write_start - reader.waited)
+                if reader.waited:
+                    TIMERS.record("throttle", reader.waited)
+            if checksums:
+                with TIMERS.time("verify"):
+                    self.verify_checksums(sftp_fd, transfer_file, checksums)
             LOG.info(f"File {self.local_file_path} uploaded to SFTP")
             transfer_file.file_transfer_end_time = dt.utcnow()
             transfer_file.file_transfer_status = "SFTP_COMPLETE"
@@ -75,19 +348,224 @@ class FileHandler:
             transfer_file.file_transfer_status = "SFTP_FAILED"
             transfer_file.file_transfer_start_time = None
 
+    def stream(
+        self,
+        sftp_fd,
+        transfer_file: TransferFile,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+        offset: int = 0,
+        checksums: TransferChecksums = None,
+    ) -> None:
+        """
+        Function to stream the file from S3 straight into the SFTP target, without local copy.
+        Only one chunk of ``chunk_size`` bytes is held in memory at any point in time, plus the
+        ``read_ahead`` chunks pulled from S3 while the current one is written, if set.
+        With ``offset``, the existing remote file is completed from that offset.
+        With ``checksums``, these are computed over the chunks as they are written.
+        """
+        self.make_remote_dirs(sftp_fd)
+        LOG.info(
+            f"Streaming {self.bucket_name}::{self.s3_path} to {self.remote_file_path}"
+        )
+        transfer_file.file_transfer_start_time = dt.utcnow()
+        try:
+            if checksums and not offset:
+                self.expect_checksums(checksums)
+            s3_start = monotonic()
+            if offset:
+                s3_object = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=self.s3_path, Range=f"bytes={offset}-"
+                )
+            else:
+                s3_object = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=self.s3_path
+                )
+            TIMERS.record("s3_first_byte", monotonic() - s3_start)
+        except Exception as error:
+            LOG.error(f"Failed to pull {transfer_file.file_name} from S3")
+            LOG.exception(error)
+            transfer_file.file_transfer_status = "S3_FAILED"
+            transfer_file.file_transfer_start_time = None
+            return
+        try:
+            with TIMERS.time("sftp_open"):
+                remote_fd = self.with_remote_dirs(
+                    sftp_fd,
+                    lambda: sftp_fd.open(
+                        self.remote_file_path, "r+b" if offset else "wb"
+                    ),
+                )
+            write_stopwatch = Stopwatch()
+            throttled = 0.0
+            with remote_fd:
+                remote_fd.seek(offset)
+                remote_fd.set_pipelined(self.pipelined)
+                chunks = s3_object["Body"].iter_chunks(chunk_size)
+                if self.read_ahead:
+                    chunks = read_ahead(chunks, self.read_ahead)
+                for chunk in TIMERS.timed(chunks, "s3_download"):
+                    throttled += self.rate_limiter.throttle(len(chunk))
+                    with write_stopwatch:
+                        remote_fd.write(chunk)
+                        if checksums:
+                            checksums.update(chunk)
+                    transfer_file.record_progress(len(chunk))
+            TIMERS.record("sftp_write", write_stopwatch.elapsed)
+            if throttled:
+                TIMERS.record("throttle", throttled)
+            verify_start = monotonic()
+            remote_size = sftp_fd.stat(self.remote_file_path).st_size
+            if remote_size != transfer_file.file_size:
+                raise OSError(
+                    f"size mismatch in streaming transfer! {remote_size} != {transfer_file.file_size}"
+                )
+            if checksums:
+                self.verify_checksums(sftp_fd, transfer_file, checksums)
+            TIMERS.record("verify", monotonic() - verify_start)
+            LOG.info(f"File {self.s3_path} streamed to SFTP")
+            transfer_file.file_transfer_end_time = dt.utcnow()
+            transfer_file.file_transfer_status = "SFTP_COMPLETE"
+        except Exception as error:
+            LOG.error("Failed to stream via SFTP")
+            LOG.exception(error)
+            transfer_file.file_transfer_status = "SFTP_FAILED"
+            transfer_file.file_transfer_start_time = None
+        finally:
+            s3_object["Body"].close()
+
+    def push_ranges(
+        self,
+        sftp_fd,
+        transfer_file: TransferFile,
+        range_size: int = DEFAULT_RANGE_SIZE,
+        fan_out: int = 4,
+    ) -> None:
+        """
+        Function to transfer the file in ranges. Each range is pulled with a ranged S3 GET and written at
+        its offset in the remote file, over ``sftp_fd`` and up to ``fan_out - 1`` more SFTP channels opened
+        on its transport, fewer if the server does not allow as many. The ranges are written out of order,
+        so to a temporary name, renamed once all written: the remote file is never seen with holes.
+        """
+        self.make_remote_dirs(sftp_fd)
+        partial_path = f"{self.remote_file_path}.part"
+        ranges: Queue = Queue()
+        for start in range(0, transfer_file.file_size, range_size):
+            ranges.put((start, min(start + range_size, transfer_file.file_size) - 1))
+        transport = sftp_fd.get_channel().get_transport()
+        failed = Event()
+        errors: list = []
+
+        def write_ranges(channel: SFTPClient = None):
+            own_channel = channel is None
+            if own_channel:
+                try:
+                    channel = SFTPClient.from_transport(transport)
+                except SSHException as error:
+                    LOG.debug(f"{self.remote_file_path} - No more channels: {error}")
+                    return
+                if channel is None:
+                    return
+            try:
+                with TIMERS.time("sftp_open"):
+                    remote_fd = channel.open(partial_path, "r+b")
+                with remote_fd:
+                    remote_fd.set_pipelined(self.pipelined)
+                    while not failed.is_set():
+                        try:
+                            start, end = ranges.get_nowait()
+                        except Empty:
+                            return
+                        with TIMERS.time("s3_first_byte"):
+                            s3_object = self.s3_client.get_object(
+                                Bucket=self.bucket_name,
+                                Key=self.s3_path,
+                                Range=f"bytes={start}-{end}",
+                            )
+                        remote_fd.seek(start)
+                        write_stopwatch = Stopwatch()
+                        throttled = 0.0
+                        for chunk in TIMERS.timed(
+                            s3_object["Body"].iter_chunks(DEFAULT_STREAM_CHUNK_SIZE),
+                            "s3_download",
+                        ):
+                            throttled += self.rate_limiter.throttle(len(chunk))
+                            with write_stopwatch:
+                                remote_fd.write(chunk)
+                            transfer_file.record_progress(len(chunk))
+                        TIMERS.record("sftp_write", write_stopwatch.elapsed)
+                        if throttled:
+                            TIMERS.record("throttle", throttled)
+            except Exception as error:
+                failed.set()
+                errors.append(error)
+            finally:
+                if own_channel:
+                    channel.close()
+
+        LOG.info(
+            f"Transferring {self.bucket_name}::{self.s3_path} to {self.remote_file_path}"
+            f" in {ranges.qsize()} ranges over up to {fan_out} channels"
+        )
+        transfer_file.file_transfer_start_time = dt.utcnow()
+        try:
+            self.with_remote_dirs(
+                sftp_fd, lambda: sftp_fd.open(partial_path, "wb")
+            ).close()
+            writers = [
+                Thread(
+                    target=write_ranges,
+                    args=(None if index else sftp_fd,),
+                    name=f"range-{index}",
+                    daemon=True,
+                )
+                for index in range(max(min(fan_out, ranges.qsize()), 1))
+            ]
+            for writer in writers:
+                writer.start()
+            for writer in writers:
+                writer.join()
+            if errors:
+                raise errors[0]
+            verify_start = monotonic()
+            remote_size = sftp_fd.stat(partial_path).st_size
+            if remote_size != transfer_file.file_size:
+                raise OSError(
+                    f"size mismatch in ranges transfer! {remote_size} != {transfer_file.file_size}"
+                )
+            replace_remote(sftp_fd, partial_path, self.remote_file_path)
+            TIMERS.record("verify", monotonic() - verify_start)
+            LOG.info(f"File {self.s3_path} uploaded to SFTP in ranges")
+            transfer_file.file_transfer_end_time = dt.utcnow()
+            transfer_file.file_transfer_status = "SFTP_COMPLETE"
+        except Exception as error:
+            LOG.error("Failed to transfer ranges via SFTP")
+            LOG.exception(error)
+            transfer_file.file_transfer_status = "SFTP_FAILED"
+            transfer_file.file_transfer_start_time = None
+            try:
+                sftp_fd.remove(partial_path)
+            except OSError:
+                pass
+
     def pull(self, transfer_file: TransferFile):
         """
         Function to pull the file from s3 to local.
         """
-        client = self.session.client("s3")
         LOG.info(
             f"Downloading {self.bucket_name}::{self.s3_path} to {self.local_file_path}"
         )
         try:
-            with open(self.local_file_path, "wb") as file_fd:
-                client.download_fileobj(self.bucket_name, self.s3_path, file_fd)
+            with open(self.local_file_path, "wb") as file_fd, TIMERS.time(
+                "s3_download"
+            ):
+                self.s3_client.download_fileobj(
+                    self.bucket_name,
+                    self.s3_path,
+                    file_fd,
+                    Callback=transfer_file.record_progress,
+                )
                 LOG.info(f"Downloaded {self.local_file_path} successfully")
-                transfer_file.file_status = "S3_COMPLETE"
+                transfer_file.file_transfer_status = "S3_COMPLETE"
         except Exception as error:
             LOG.error(f"Failed to pull {transfer_file.file_name} from S3")
             LOG.exception(error)
@@ -100,11 +578,22 @@ class FileHandler:
         temp_dir: TemporaryDirectory,
         sftp_info: dict,
         session: Session = None,
+        s3_client=None,
+        directories_cache: RemoteDirectoryCache = None,
+        rate_limiter: RateLimiter = None,
     ):
         """
         Init function for file transfer.
         """
         self.session = get_session(session)
+        self.s3_client = s3_client if s3_client else self.session.client("s3")
+        self.directories_cache = directories_cache
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        transport_options = set_else_none("transport", sftp_info, alt_value={})
+        self.pipelined = transport_options.get("pipelining", True)
+        self.read_ahead = int(
+            set_else_none("read_ahead", transport_options, alt_value=0)
+        )
         self.bucket_name = bucket_name
         self.s3_path = file_path
         prefix_path = set_else_none("default_path", sftp_info, alt_value="")
@@ -134,36 +623,148 @@ def paramiko_auth_interactive_adaptive_best_effort(
     return tuple([TEMP_PASS for _ in fields])
 
 
+def get_transport_options(sftp_connection_details: dict) -> dict:
+    """
+    Returns the ``transport`` settings of the SFTP target.
+    """
+    options = set_else_none("transport", sftp_connection_details, alt_value={})
+    return {
+        "compress": keyisset("compression", options),
+        "ciphers": set_else_none("ciphers", options, alt_value=[]),
+        "macs": set_else_none("macs", options, alt_value=[]),
+        "window_size": set_else_none("window_size", options),
+        "max_packet_size": set_else_none("max_packet_size", options),
+    }
+
+
+def set_security_options(transport: Transport, transport_options: dict) -> None:
+    """
+    Offers the server only the preferred ciphers and MACs, in the order these are listed, and sets the
+    compression. Must be done before the transport is started. Algorithms not supported are ignored.
+    """
+    security_options = transport.get_security_options()
+    for key, option in (("ciphers", "ciphers"), ("macs", "digests")):
+        supported = getattr(security_options, option)
+        preferred = [name for name in transport_options[key] if name in supported]
+        unsupported = [name for name in transport_options[key] if name not in supported]
+        if unsupported:
+            LOG.warning(f"Ignoring unsupported {key}: {unsupported}")
+        if preferred:
+            setattr(security_options, option, preferred)
+    transport.use_compression(transport_options["compress"])
+
+
+def set_transport_sizes(transport: Transport, transport_options: dict) -> None:
+    """
+    Sets the window and max packet sizes used for the channels opened on the transport from now on.
+    """
+    if transport_options["window_size"]:
+        transport.default_window_size = int(transport_options["window_size"])
+    if transport_options["max_packet_size"]:
+        transport.default_max_packet_size = int(transport_options["max_packet_size"])
+
+
+def negotiated_transport_settings(sftp_fd: SFTPClient) -> dict:
+    """
+    Returns the settings negotiated with the server for the session transport and channel.
+    """
+    channel = sftp_fd.get_channel()
+    transport = channel.get_transport()
+    return {
+        "server_version": transport.remote_version,
+        "cipher": transport.local_cipher,
+        "mac": transport.local_mac,
+        "compression": transport.local_compression,
+        "window_size": channel.in_window_size,
+        "max_packet_size": channel.in_max_packet_size,
+        "server_window_size": channel.out_window_size,
+        "server_max_packet_size": channel.out_max_packet_size,
+    }
+
+
+def load_private_key(key_filename: str, passphrase: str = None) -> PKey:
+    """
+    Loads the private key from ``key_filename``, whichever its type.
+    """
+    for key_class in (RSAKey, ECDSAKey, Ed25519Key):
+        try:
+            return key_class.from_private_key_file(key_filename, password=passphrase)
+        except SSHException:
+            continue
+    raise SSHException(f"Unable to load the private key {key_filename}")
+
+
+def open_transport(sftp_connection_details: dict, transport_options: dict) -> Transport:
+    """
+    Opens the SSH transport to the SFTP server, negotiated with the ``transport`` settings.
+    The server host key is accepted without verification.
+    """
+    transport = Transport(
+        (
+            sftp_connection_details["host"],
+            int(set_else_none("port", sftp_connection_details, alt_value=22)),
+        )
+    )
+    try:
+        set_security_options(transport, transport_options)
+        transport.start_client()
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+
+def authenticate(transport: Transport, sftp_connection_details: dict) -> None:
+    """
+    Authenticates with the private key, if set, falling back to the password, if set.
+    """
+    username = sftp_connection_details["username"]
+    password = set_else_none("password", sftp_connection_details)
+    key_filename = set_else_none("private_key", sftp_connection_details)
+    if key_filename:
+        try:
+            transport.auth_publickey(
+                username,
+                load_private_key(
+                    key_filename,
+                    set_else_none("private_key_pass", sftp_connection_details),
+                ),
+            )
+            return
+        except AuthenticationException:
+            if not password:
+                raise
+    transport.auth_password(username, password)
+
+
 def get_sftp_connection(
     sftp_connection_details: dict,
     alternative_function=None,
     attempt_interactive_auth_with_password: bool = False,
 ) -> SFTPClient:
+    transport_options = get_transport_options(sftp_connection_details)
     try:
-        client = SSHClient()
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        client.connect(
-            hostname=sftp_connection_details["host"],
-            username=sftp_connection_details["username"],
-            password=set_else_none("password", sftp_connection_details),
-            port=int(set_else_none("port", sftp_connection_details, alt_value=22)),
-            key_filename=set_else_none("private_key", sftp_connection_details),
-            passphrase=set_else_none("private_key_pass", sftp_connection_details),
-        )
-        return client.open_sftp()
+        transport = open_transport(sftp_connection_details, transport_options)
+        try:
+            authenticate(transport, sftp_connection_details)
+        except Exception:
+            transport.close()
+            raise
+        set_transport_sizes(transport, transport_options)
+        return transport.open_sftp_client()
     except AuthenticationException:
         if attempt_interactive_auth_with_password and keyisset(
             "password", sftp_connection_details
         ):
             try:
-                transport = Transport(sftp_connection_details["host"])
-                transport.connect(username=sftp_connection_details["username"])
+                transport = open_transport(sftp_connection_details, transport_options)
                 global TEMP_PASS
                 TEMP_PASS = sftp_connection_details["password"]
                 transport.auth_interactive(
                     sftp_connection_details["username"],
                     paramiko_auth_interactive_adaptive_best_effort,
                 )
+                set_transport_sizes(transport, transport_options)
                 return transport.open_sftp_client()
             except Exception as error:
                 LOG.error("Failure in attempt to use Transport connectivity")
@@ -0,0 +1,118 @@
+# Copyright (C) 2020-2022 John Mille <john@ews-network.net>
+
+"""
+Keeps the SQS messages of the files being transferred invisible, for as long as the transfers progress.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from s3_to_sftp.transfer_file import TransferFile
+
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from s3_to_sftp.logger import LOG
+from s3_to_sftp.sqs_batch import batch_entries
+
+
+class VisibilityHeartbeat(Thread):
+    """
+    Background thread that, every ``interval`` seconds, extends the visibility of all the tracked messages
+    to ``visibility_timeout`` seconds, with batch API calls. A file that made no progress for
+    ``stall_timeout`` seconds is no longer extended, so its message becomes visible again and is retried.
+    """
+
+    def __init__(
+        self,
+        queue,
+        interval: int = 30,
+        visibility_timeout: int = None,
+        stall_timeout: int = None,
+    ):
+        super().__init__(name="visibility-heartbeat", daemon=True)
+        self.client = queue.meta.client
+        self.queue_url = queue.url
+        self.interval = interval
+        self.visibility_timeout = (
+            visibility_timeout if visibility_timeout else interval * 3
+        )
+        self.stall_timeout = stall_timeout if stall_timeout else interval * 10
+        self._files: dict = {}
+        self._lock = Lock()
+        self._stopped = Event()
+
+    def track(self, transfer_file: TransferFile) -> None:
+        transfer_file.record_progress(0)
+        with self._lock:
+            self._files[id(transfer_file)] = transfer_file
+
+    def untrack(self, transfer_file: TransferFile) -> None:
+        with self._lock:
+            self._files.pop(id(transfer_file), None)
+
+    def is_progressing(self, transfer_file: TransferFile) -> bool:
+        """
+        A file waiting for its turn, or pulled from S3 and waiting for its upload, is considered progressing.
+        """
+        return (
+            transfer_file.file_transfer_status in ["PENDING", "S3_COMPLETE"]
+            or monotonic() - transfer_file.last_progress_time < self.stall_timeout
+        )
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as error:
+                LOG.error("Failed to extend the in-flight messages visibility")
+                LOG.exception(error)
+
+    def beat(self) -> None:
+        with self._lock:
+            transfer_files = list(self._files.values())
+        messages: dict = {}
+        for transfer_file in transfer_files:
+            message, progressing = messages.get(
+                transfer_file.message.receipt_handle, (transfer_file.message, False)
+            )
+            if self.is_progressing(transfer_file):
+                progressing = True
+            else:
+                LOG.warning(
+                    f"{transfer_file.file_name} - No progress for {self.stall_timeout}s."
+                )
+            messages[transfer_file.message.receipt_handle] = (message, progressing)
+        entries: list = []
+        names: dict = {}
+        for receipt_handle, (message, progressing) in messages.items():
+            if not progressing:
+                LOG.warning(
+                    f"Message {message.message_id} visibility no longer extended."
+                )
+                continue
+            names[str(len(entries))] = message.message_id
+            entries.append(
+                {
+                    "Id": str(len(entries)),
+                    "ReceiptHandle": receipt_handle,
+                    "VisibilityTimeout": self.visibility_timeout,
+                }
+            )
+        for batch in batch_entries(entries):
+            response = self.client.change_message_visibility_batch(
+                QueueUrl=self.queue_url, Entries=batch
+            )
+            for failed in response.get("Failed", []):
+                LOG.warning(
+                    f"Message {names[failed['Id']]} - Failed to extend visibility: {failed.get('Message')}"
+                )
+        if entries:
+            LOG.debug(
+                f"Extended visibility of {len(entries)} messages to {self.visibility_timeout}s"
+            )
+
+    def stop(self) -> None:
+        self._stopped.set()
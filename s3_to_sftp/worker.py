@@ -4,22 +4,49 @@
 Module to handle the queue jobs and execute the SFTP transfer.
 
 """
+from __future__ import annotations
+
 import signal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime as dt
 from datetime import timedelta as td
+from functools import cached_property, partial
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Union
 
-from aws_embedded_metrics import metric_scope
 from boto3.session import Session
+from botocore.config import Config
 from compose_x_common.aws import get_session
 from compose_x_common.aws.sqs import SQS_QUEUE_ARN_RE
 from compose_x_common.compose_x_common import keyisset, set_else_none
 
-from s3_to_sftp.transfer_handler import get_sftp_connection
+from s3_to_sftp.checksums import TransferChecksums
+from s3_to_sftp.journal import TransferJournal
+from s3_to_sftp.pipeline import run_pipeline
+from s3_to_sftp.poller import QueuePoller
+from s3_to_sftp.routing import (
+    DEFAULT_TARGET,
+    SFTPTarget,
+    get_router,
+    interleave_targets,
+)
+from s3_to_sftp.scheduler import order_files, split_late_messages
+from s3_to_sftp.sftp_pool import SFTPSessionPool
+from s3_to_sftp.sqs_batch import SQSBatcher
+from s3_to_sftp.throughput import ThroughputModel
+from s3_to_sftp.timers import STARTUP, TIMERS, metric_scope, start_metrics_server
+from s3_to_sftp.visibility import VisibilityHeartbeat
 
 from .logger import LOG
-from .transfer_file import TransferFile
+from .transfer_file import MB, TransferFile, TransferMessage
 
 FOREVER = 42
+COMPLETED_MESSAGES_MEMORY = 1024
+COALESCE_CHECK_INTERVAL = 1
+sftp_connection = None
 
 
 class Worker:
@@ -29,18 +56,31 @@ class Worker:
         self._sftp_info = sftp_info
         self.messages: list = []
         self.keep_running = FOREVER
+        self.s3_client = None
+        self.heartbeat = None
+        self.throughput = None
+        self.sqs_batcher = None
+        self.poller = None
+        self.router = None
+        self.journal = None
+        self.files_waiting = 0
+        self._files_waiting_lock = Lock()
+        self._flush_lock = Lock()
+        self.journal_partials: dict = {}
+        self.completed_units: OrderedDict = OrderedDict()
+        self.stats_queue = None
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
-    @property
+    @cached_property
     def queue(self):
         return self.session.resource("sqs").Queue(self.queue_url)
 
-    @property
+    @cached_property
     def queue_arn(self) -> str:
         return self.queue.attributes["QueueArn"]
 
-    @property
+    @cached_property
     def queue_name(self) -> str:
         return SQS_QUEUE_ARN_RE.match(self.queue_arn).group("id")
 
@@ -62,6 +102,8 @@ class Worker:
 
     @property
     def connection_string(self) -> str:
+        if self.router:
+            return self.router.connection_string
         return f"{self.sftp_username}@{self.sftp_host}:@{self.sftp_port}"
 
     @staticmethod
@@ -69,21 +111,108 @@ class Worker:
         session = get_session(session)
         return session.client("sqs").get_queue_url(QueueName=queue_name)["QueueUrl"]
 
-    def run(self, **kwargs) -> None:
-        global sftp_connection
-        sftp_connection = get_sftp_connection(
+    def set_s3_client(self, **kwargs) -> None:
+        """
+        Creates the S3 client shared by all the files transfers. boto3 clients are thread-safe,
+        the connections pool is sized for all the transfer and ranges threads to get one.
+        """
+        concurrency = int(set_else_none("concurrency", kwargs, alt_value=1))
+        fan_out = int(set_else_none("large_file_fan_out", kwargs, alt_value=4))
+        self.s3_client = self.session.client(
+            "s3",
+            config=Config(
+                max_pool_connections=max(10, concurrency * (fan_out + 1)),
+                tcp_keepalive=True,
+            ),
+        )
+
+    def prepare(self, **kwargs) -> None:
+        """
+        Sets up what the transfers need, whatever the files to transfer come from.
+        """
+        self.set_s3_client(**kwargs)
+        if keyisset("adaptive_rate", kwargs):
+            self.throughput = ThroughputModel(
+                default_rate=set_else_none("transfer_rate", kwargs, alt_value=1),
+                state_file=set_else_none("throughput_state_file", kwargs),
+            )
+        self.router = get_router(
             self.sftp_info,
+            partial(self.new_sftp_pool, **kwargs),
+            concurrency=int(set_else_none("concurrency", kwargs, alt_value=1)),
+            max_bandwidth=float(set_else_none("max_bandwidth", kwargs, alt_value=0)),
+            max_files=int(set_else_none("max_concurrent_files", kwargs, alt_value=0)),
+        )
+        metrics_port = int(set_else_none("metrics_port", kwargs, alt_value=0))
+        if metrics_port:
+            start_metrics_server(metrics_port)
+
+    def new_sftp_pool(self, target: SFTPTarget, **kwargs) -> SFTPSessionPool:
+        return SFTPSessionPool(
+            target.sftp_info,
+            size=target.concurrency,
+            connections=int(set_else_none("sftp_connections", kwargs, alt_value=1)),
             attempt_interactive_auth_with_password=keyisset(
                 "attempt_interactive_auth", kwargs
             ),
+            keepalive=int(set_else_none("sftp_keepalive", kwargs, alt_value=30)),
+            spares=int(set_else_none("sftp_spare_connections", kwargs, alt_value=0)),
         )
-        if not sftp_connection or not hasattr(sftp_connection, "__enter__"):
-            raise ConnectionError(
-                f"Unable to establish connection to SFTP server", self.connection_string
+
+    def run(self, **kwargs) -> None:
+        global sftp_connection
+        self.prepare(**kwargs)
+        journal_file = set_else_none("journal", kwargs)
+        if journal_file:
+            self.journal = TransferJournal(journal_file)
+        self.sqs_batcher = SQSBatcher(
+            self.queue,
+            flush_interval=int(
+                set_else_none("ack_flush_interval", kwargs, alt_value=0)
+            ),
+            on_delete=self.journal.forget if self.journal else None,
+        )
+        self.sqs_batcher.start()
+        heartbeat_interval = int(
+            set_else_none("visibility_heartbeat", kwargs, alt_value=0)
+        )
+        if heartbeat_interval:
+            self.heartbeat = VisibilityHeartbeat(
+                self.queue, interval=heartbeat_interval
+            )
+            self.heartbeat.start()
+        sftp_connection = self.router
+        with self.router:
+            Thread(
+                target=self.router.open,
+                args=(list(self.router.targets.values()),),
+                name="sftp-connect",
+                daemon=True,
+            ).start()
+            if self.journal:
+                self.recover_transfers()
+            self.poller = QueuePoller(
+                self.session.resource("sqs").Queue(self.queue_url),
+                max_buffered=min(
+                    int(set_else_none("max_messages_batch", kwargs, alt_value=2)), 10
+                ),
+                wait_time=int(set_else_none("poll_intervals", kwargs, alt_value=2)),
+                batch_size=partial(self.messages_batch_size, **kwargs),
+                can_poll=self.can_poll,
+                visibility_timeout=int(self.queue.attributes["VisibilityTimeout"]),
             )
-        with sftp_connection as sftp_fd:
-            LOG.info(f"{self.connection_string} - Connection established.")
+            self.poller.start()
+            flush_stopped = Event()
+            flusher = Thread(
+                target=self.flush_coalesced_periodically,
+                args=(flush_stopped,),
+                name="coalesce-flush",
+                daemon=True,
+            )
+            if any(target.coalescer for target in self.router.targets.values()):
+                flusher.start()
             LOG.info(f"Waiting on messages from {self.queue_url}")
+            STARTUP.mark_ready()
             _loop_start = dt.now()
             _output_every = td(seconds=60)
             while self.keep_running:
@@ -91,103 +220,826 @@ class Worker:
                     LOG.info(f"{self.queue_name} - Waiting for files_transfers")
                     _loop_start = dt.now()
                 try:
-                    queue_messages = self.queue.receive_messages(
-                        WaitTimeSeconds=int(
-                            set_else_none("poll_intervals", kwargs, alt_value=2)
-                        ),
-                        MaxNumberOfMessages=min(
-                            [
-                                int(
-                                    set_else_none(
-                                        "max_messages_batch", kwargs, alt_value=2
-                                    )
-                                ),
-                                10,
-                            ]
-                        ),
+                    queue_messages = self.poller.get(
+                        int(set_else_none("poll_intervals", kwargs, alt_value=2))
                     )
-                    if queue_messages:
-                        files_transfers = [TransferFile(msg) for msg in queue_messages]
+                    if not queue_messages:
+                        continue
+                    self.set_files_waiting(len(queue_messages))
+                    with TIMERS.time("parse"):
+                        transfer_messages = self.get_transfer_messages(queue_messages)
+                    files_transfers = [
+                        transfer_file
+                        for transfer_message in transfer_messages
+                        for transfer_file in transfer_message.files
+                    ]
+                    if files_transfers:
                         LOG.info(
                             f"{self.queue_name} - Processing S3 files to transfer from SQS files_transfers"
                         )
-                        self.transfer_files_to_sftp(sftp_fd, files_transfers, **kwargs)
+                        self.transfer_files_to_sftp(files_transfers, **kwargs)
+                    else:
+                        self.set_files_waiting(0)
+                        self.sqs_batcher.flush()
                 except Exception as error:
-                    LOG.error("Failed to retrieve jobs from queue")
+                    LOG.error("Failed to process jobs from queue")
                     LOG.exception(error)
+                    self.set_files_waiting(0)
+            for queue_message in self.poller.stop():
+                self.sqs_batcher.change_visibility(queue_message, 0)
+            flush_stopped.set()
+            if flusher.is_alive():
+                flusher.join()
+            self.flush_coalesced(force=True)
+        if self.heartbeat:
+            self.heartbeat.stop()
+        self.sqs_batcher.stop()
+        if self.journal:
+            self.journal.close()
+
+    def recover_transfers(self) -> None:
+        """
+        Reconciles the journal of a previous run with the SFTP targets. The messages of which all the files
+        were transferred are deleted. The others are released to be received again right away, without
+        the files already transferred, and with the partial files completed instead of sent from the start.
+        """
+        try:
+            with ExitStack() as stack:
+                sftp_fds: dict = {}
+                for name in self.journal.targets():
+                    if name not in self.router.targets:
+                        continue
+                    try:
+                        sftp_fds[name] = stack.enter_context(
+                            self.router.targets[name].checkout()
+                        )
+                    except Exception as error:
+                        LOG.error(f"{name} - Unable to check the journaled transfers")
+                        LOG.exception(error)
+                to_delete, to_release, self.journal_partials = self.journal.reconcile(
+                    sftp_fds
+                )
+        except Exception as error:
+            LOG.error(
+                f"Failed to recover the transfers from {self.journal.journal_file}"
+            )
+            LOG.exception(error)
+            return
+        for message_id, units in self.journal.completed_units().items():
+            self.completed_units.setdefault(message_id, set()).update(units)
+        for message in to_delete:
+            self.sqs_batcher.delete(message)
+        for message in to_release:
+            self.sqs_batcher.change_visibility(message, 0)
+        self.sqs_batcher.flush()
+        if to_delete or to_release:
+            LOG.info(
+                f"Recovered transfers from {self.journal.journal_file} - {len(to_delete)} messages completed,"
+                f" {len(to_release)} released, {len(self.journal_partials)} partial files to resume."
+            )
+
+    def get_transfer_messages(self, queue_messages: list) -> list[TransferMessage]:
+        """
+        Expands the messages into the files to transfer. Messages with nothing (left) to transfer are deleted,
+        and messages that cannot be parsed left to be redelivered.
+        """
+        transfer_messages: list = []
+        for queue_message in queue_messages:
+            sent_timestamp = (queue_message.attributes or {}).get("SentTimestamp")
+            if sent_timestamp:
+                TIMERS.record("queue_wait", max(time() - int(sent_timestamp) / 1000, 0))
+            completed_units = self.completed_units.setdefault(
+                queue_message.message_id, set()
+            )
+            self.completed_units.move_to_end(queue_message.message_id)
+            while len(self.completed_units) > COMPLETED_MESSAGES_MEMORY:
+                self.completed_units.popitem(last=False)
+            try:
+                transfer_message = TransferMessage(queue_message, completed_units)
+            except (ValueError, TypeError, KeyError) as error:
+                LOG.error(f"Unable to parse message {queue_message.message_id}")
+                LOG.exception(error)
+                continue
+            if not transfer_message.files:
+                LOG.info(f"Message {queue_message.message_id} - No file to transfer.")
+                self.sqs_batcher.delete(queue_message)
+                continue
+            transfer_messages.append(transfer_message)
+        return transfer_messages
+
+    def can_poll(self) -> bool:
+        """
+        Whether the poller is to receive the next messages: once none of the files received waits for a
+        transfer slot, the next slot to free up would have nothing to transfer.
+        """
+        return bool(self.keep_running) and self.files_waiting <= 0
+
+    def set_files_waiting(self, count: int) -> None:
+        """
+        Sets how many files received wait for a transfer slot, and wakes the poller up when none does.
+        """
+        with self._files_waiting_lock:
+            self.files_waiting = count
+        if count <= 0 and self.poller:
+            self.poller.notify()
+
+    def file_started(self) -> None:
+        with self._files_waiting_lock:
+            self.files_waiting -= 1
+            files_waiting = self.files_waiting
+        if files_waiting <= 0 and self.poller:
+            self.poller.notify()
+
+    def messages_batch_size(self, **kwargs) -> int:
+        """
+        Number of messages to receive. With the adaptive transfer rate, limited to how many files are
+        expected to be transferred before the queue default visibility timeout expires.
+        """
+        max_batch = min(
+            [int(set_else_none("max_messages_batch", kwargs, alt_value=2)), 10]
+        )
+        if not self.throughput:
+            return max_batch
+        return self.throughput.batch_size(
+            max_batch,
+            time_budget=int(self.queue.attributes["VisibilityTimeout"]),
+            concurrency=int(set_else_none("concurrency", kwargs, alt_value=1)),
+        )
+
+    def transfer_rate_for(self, file_to_transfer: TransferFile, **kwargs) -> float:
+        """
+        Transfer rate, in MB/s, to estimate the file transfer duration with. Capped to the share of the
+        SFTP target bandwidth limit each file gets.
+        """
+        if self.throughput:
+            rate = self.throughput.rate_for(file_to_transfer.file_size)
+        else:
+            rate = set_else_none("transfer_rate", kwargs, alt_value=1)
+        target = file_to_transfer.target
+        if not target:
+            return rate
+        limited_rate = target.rate_limiter.file_rate(
+            min(
+                target.concurrency,
+                int(set_else_none("concurrency", kwargs, alt_value=1)),
+            )
+        )
+        return min(rate, limited_rate) if limited_rate else rate
+
+    def schedule_files(
+        self, files_transfers: list[TransferFile], **kwargs
+    ) -> list[TransferFile]:
+        """
+        Orders the files with the scheduling policy. With ``release_late_messages``, the messages of the files
+        not expected to be transferred before the queue default visibility timeout are released right away,
+        for another worker, or the next batch, to process these.
+
+        :return: the files to transfer, in order
+        """
+        files_transfers = order_files(
+            files_transfers,
+            policy=set_else_none("schedule", kwargs, alt_value="fifo"),
+            prefix_depth=int(
+                set_else_none("schedule_prefix_depth", kwargs, alt_value=1)
+            ),
+        )
+        if not keyisset("release_late_messages", kwargs):
+            return files_transfers
+        files_transfers, released = split_late_messages(
+            files_transfers,
+            duration_of=lambda _file: (_file.file_size / MB)
+            / max(self.transfer_rate_for(_file, **kwargs), 0.001),
+            concurrency=int(set_else_none("concurrency", kwargs, alt_value=1)),
+            deadline=int(self.queue.attributes["VisibilityTimeout"]),
+        )
+        for message in released:
+            self.sqs_batcher.change_visibility(message, 0)
+        return files_transfers
+
+    def route_files(self, files_transfers: list[TransferFile]) -> list[TransferFile]:
+        """
+        Sets the SFTP target of each file, from the routes. The files not matching any route fail.
+
+        :return: the files routed to a target
+        """
+        files_routed: list = []
+        for file_to_transfer in files_transfers:
+            file_to_transfer.target = self.router.route(
+                file_to_transfer.s3_bucket, file_to_transfer.file_name
+            )
+            if file_to_transfer.target:
+                files_routed.append(file_to_transfer)
+            else:
+                self.fail_files(
+                    [file_to_transfer],
+                    f"No route to an SFTP target for s3://{file_to_transfer.s3_bucket}",
+                )
+        return files_routed
+
+    def fail_files(self, files_transfers: list[TransferFile], reason: str) -> None:
+        """
+        Counts the files as failed without transferring these, and makes their messages visible again
+        right away, so these are received again.
+        """
+        for file_to_transfer in files_transfers:
+            LOG.error(f"{file_to_transfer.file_name} - {reason}")
+            file_to_transfer.file_transfer_status = "SFTP_FAILED"
+            file_to_transfer.transfer_message.unit_done(file_to_transfer, False)
+            self.release_file(file_to_transfer)
+            self.end_transfer(file_to_transfer)
+
+    def coalesce_files(self, files_transfers: list[TransferFile]) -> list[TransferFile]:
+        """
+        Buffers the files small enough to be coalesced into an archive for their target, and keeps their
+        messages invisible until the archive is uploaded: with the heartbeat, the files are tracked until then.
+
+        :return: the files to transfer on their own
+        """
+        files_to_transfer: list = []
+        for file_to_transfer in files_transfers:
+            coalescer = file_to_transfer.target.coalescer
+            if not coalescer or not coalescer.accepts(file_to_transfer):
+                files_to_transfer.append(file_to_transfer)
+                continue
+            coalescer.add(file_to_transfer)
+            self.sqs_batcher.change_visibility(
+                file_to_transfer.message, coalescer.visibility_timeout
+            )
+            if self.heartbeat:
+                self.heartbeat.track(file_to_transfer)
+        return files_to_transfer
+
+    def coalescing_timeout(self, transfer_message: TransferMessage) -> int:
+        """
+        :return: the visibility timeout the message is kept invisible for while some of its files are
+            buffered for an archive, or 0 if none is
+        """
+        return max(
+            (
+                _file.target.coalescer.visibility_timeout
+                for _file in transfer_message.files
+                if _file.target
+                and _file.target.coalescer
+                and _file.target.coalescer.buffers(_file)
+            ),
+            default=0,
+        )
+
+    def flush_coalesced(self, force: bool = False) -> None:
+        """
+        Uploads the archive of the files buffered for each target once due, or now with ``force``.
+        """
+        with self._flush_lock:
+            for target in self.router.targets.values():
+                if target.coalescer and target.coalescer.files:
+                    if force or target.coalescer.due():
+                        self.upload_coalesced(target)
+
+    def flush_coalesced_periodically(self, stopped: Event) -> None:
+        """
+        Uploads the archives once due, from a background thread, so that these are not held back past
+        their messages visibility timeout by the batch of transfers in progress.
+        """
+        while not stopped.wait(COALESCE_CHECK_INTERVAL):
+            try:
+                self.flush_coalesced()
+            except Exception as error:
+                LOG.error("Failed to upload the coalesced files")
+                LOG.exception(error)
+
+    @metric_scope
+    def upload_coalesced(self, target: SFTPTarget, metrics) -> None:
+        """
+        Uploads the archive of the files buffered for the target, and deletes the messages of the files
+        all at once. If the upload fails, the messages are made visible again right away.
+        """
+        metrics.set_namespace("S3ToSFTP")
+        files = target.coalescer.take()
+        remote_path = target.coalescer.archive_path(target.sftp_info)
+        start = dt.utcnow()
+        try:
+            with target.rate_limiter.file_slot(), target.checkout() as sftp_fd:
+                archive_size = target.coalescer.upload(
+                    sftp_fd,
+                    files,
+                    remote_path,
+                    self.s3_client,
+                    rate_limiter=target.rate_limiter,
+                    directories_cache=target.pool.directories,
+                )
+            uploaded = True
+        except Exception as error:
+            LOG.error(f"Failed to upload {len(files)} files to {remote_path}")
+            LOG.exception(error)
+            archive_size = 0
+            uploaded = False
+        end = dt.utcnow()
+        for file_to_transfer in files:
+            if uploaded:
+                file_to_transfer.file_transfer_start_time = start
+                file_to_transfer.file_transfer_end_time = end
+                file_to_transfer.file_transfer_status = "SFTP_COMPLETE"
+                self.complete_transfer(file_to_transfer)
+            else:
+                file_to_transfer.file_transfer_status = "SFTP_FAILED"
+                file_to_transfer.transfer_message.unit_done(file_to_transfer, False)
+                self.release_file(file_to_transfer)
+            self.end_transfer(file_to_transfer)
+            file_to_transfer.temp_dir.cleanup()
+        self.sqs_batcher.flush()
+        duration = (end - start).total_seconds()
+        total_files_size = sum(_file.file_size for _file in files) if uploaded else 0
+        metrics.put_metric("TotalFilesSize", float(total_files_size), "Bytes")
+        metrics.put_metric("ArchiveSize", float(archive_size), "Bytes")
+        metrics.put_metric("BatchDuration", float(duration), "Seconds")
+        if duration > 0:
+            metrics.put_metric(
+                "TransferRate", float(total_files_size / duration), "Bytes/Second"
+            )
+        TIMERS.emit(metrics)
+        STARTUP.emit(metrics)
+        metrics.put_metric("FilesProcessed", float(len(files)), "None")
+        metrics.put_metric("FilesFailed", float(0 if uploaded else len(files)), "None")
+        if self.stats_queue:
+            self.stats_queue.put(
+                {
+                    "files_processed": len(files),
+                    "files_failed": 0 if uploaded else len(files),
+                    "total_files_size": total_files_size,
+                }
+            )
+        metrics.put_dimensions({"Queue": self.queue_name})
+        metrics.set_property("Archive", remote_path)
+        metrics.set_property("SftpTarget", target.name)
+
+    def reserve_messages(self, files_transfers: list[TransferFile], **kwargs) -> None:
+        """
+        Sets the visibility of all the batch messages at once. Without heartbeat, each message visibility
+        covers for the estimated transfer time of the file, plus the files transferred before it on the same
+        transfer slot, and at least for the archive of its files buffered for one.
+        """
+        if self.heartbeat:
+            for file_to_transfer in files_transfers:
+                self.sqs_batcher.change_visibility(
+                    file_to_transfer.message, self.heartbeat.visibility_timeout
+                )
+                self.heartbeat.track(file_to_transfer)
+        else:
+            slots = [0] * int(set_else_none("concurrency", kwargs, alt_value=1))
+            messages_timeouts: dict = {}
+            for file_to_transfer in files_transfers:
+                transfer_time_estimate = (
+                    file_to_transfer.file_transfer_duration_estimate(
+                        transfer_margin=set_else_none(
+                            "error_margin", kwargs, alt_value=15
+                        ),
+                        speed_in_mbytes=self.transfer_rate_for(
+                            file_to_transfer, **kwargs
+                        ),
+                    )
+                )
+                slot = slots.index(min(slots))
+                slots[slot] += transfer_time_estimate
+                LOG.info(
+                    f"Estimated transfer time for {file_to_transfer.file_name}: {transfer_time_estimate}s"
+                    f" - Visibility timeout: {slots[slot]}s"
+                )
+                message, timeout = messages_timeouts.get(
+                    file_to_transfer.message.receipt_handle,
+                    (
+                        file_to_transfer.message,
+                        self.coalescing_timeout(file_to_transfer.transfer_message),
+                    ),
+                )
+                messages_timeouts[file_to_transfer.message.receipt_handle] = (
+                    message,
+                    max(timeout, slots[slot]),
+                )
+            for message, timeout in messages_timeouts.values():
+                self.sqs_batcher.change_visibility(message, timeout)
+        self.sqs_batcher.flush()
+
+    def start_transfer(
+        self, file_to_transfer: TransferFile, **kwargs
+    ) -> Union[bool, None]:
+        """
+        :return: True, or None if the worker was stopped and the file is not to be processed.
+        """
+        self.file_started()
+        if not self.keep_running:
+            LOG.warning(
+                f"Worker instructed to stop. Skipping {file_to_transfer.file_name}"
+            )
+            self.sqs_batcher.change_visibility(file_to_transfer.message, 0)
+            return None
+        LOG.info(f"Processing file {file_to_transfer.file_name}")
+        if self.journal:
+            self.journal.begin(
+                file_to_transfer,
+                size_only=not self.sends_in_ranges(file_to_transfer, **kwargs)
+                and self.new_checksums(file_to_transfer, **kwargs) is None,
+            )
+        return True
+
+    def release_file(self, file_to_transfer: TransferFile) -> None:
+        """
+        Makes the message of a file left unprocessed visible again right away, for it to be received again,
+        or once the archive of its files buffered for one is uploaded.
+        """
+        self.sqs_batcher.change_visibility(
+            file_to_transfer.message,
+            self.coalescing_timeout(file_to_transfer.transfer_message),
+        )
+
+    def end_transfer(self, file_to_transfer: TransferFile) -> None:
+        """
+        Stops extending the file message visibility, whether the transfer succeeded or not.
+        """
+        if self.heartbeat:
+            self.heartbeat.untrack(file_to_transfer)
+
+    def complete_transfer(self, file_to_transfer: TransferFile) -> bool:
+        """
+        Queues the file message for deletion if it was successfully transferred, along with all
+        the other files of the message.
+        """
+        if file_to_transfer.file_transfer_status == "SFTP_SKIPPED":
+            if self.journal:
+                self.journal.complete(file_to_transfer)
+            if file_to_transfer.transfer_message.unit_done(file_to_transfer, True):
+                self.sqs_batcher.delete(file_to_transfer.message)
+            return True
+        if file_to_transfer.file_transfer_duration > 0:
+            if self.journal:
+                self.journal.complete(file_to_transfer)
+            if file_to_transfer.transfer_message.unit_done(file_to_transfer, True):
+                self.sqs_batcher.delete(file_to_transfer.message)
+            LOG.info(
+                f"{file_to_transfer.file_name} - Transfer complete in: "
+                f"{file_to_transfer.file_transfer_duration}"
+                f" - Approximate transfer rate: {file_to_transfer.file_transfer_speed}MB/s"
+            )
+            return True
+        return False
+
+    def is_large_file(self, file_to_transfer: TransferFile, **kwargs) -> bool:
+        """
+        Whether the file is to be transferred in ranges written in parallel.
+        """
+        threshold = int(set_else_none("large_file_threshold", kwargs, alt_value=0) * MB)
+        if self.throughput:
+            threshold = self.throughput.large_file_threshold(threshold)
+        return bool(threshold) and file_to_transfer.file_size >= threshold
+
+    def sends_in_ranges(self, file_to_transfer: TransferFile, **kwargs) -> bool:
+        """
+        Whether the file is transferred in ranges. Partial remote files are resumed in order instead.
+        """
+        return (
+            self.is_large_file(file_to_transfer, **kwargs)
+            and not file_to_transfer.resume_offset
+        )
+
+    def sends_from_s3(self, file_to_transfer: TransferFile, **kwargs) -> bool:
+        """
+        Whether the file is sent without a local copy, in ranges, resumed, or skipped altogether.
+        """
+        return (
+            self.is_large_file(file_to_transfer, **kwargs)
+            or file_to_transfer.resume_offset > 0
+            or file_to_transfer.file_transfer_status == "SFTP_SKIPPED"
+        )
+
+    def new_checksums(
+        self, file_to_transfer: TransferFile, **kwargs
+    ) -> Union[TransferChecksums, None]:
+        """
+        The checksums to compute while sending the file, if enabled. Files sent in ranges, or resumed,
+        are not sent in a single pass over all their bytes, so only their size is verified.
+        """
+        sidecar = keyisset("checksum_sidecar", kwargs)
+        check_file = keyisset("checksum_check_file", kwargs)
+        if not (keyisset("verify_checksums", kwargs) or sidecar or check_file):
+            return None
+        if file_to_transfer.resume_offset or self.is_large_file(
+            file_to_transfer, **kwargs
+        ):
+            LOG.debug(f"{file_to_transfer.file_name} - Not computing checksums")
+            return None
+        return TransferChecksums(sidecar=sidecar, check_file=check_file)
+
+    def check_remote_files(self, files_transfers: list[TransferFile], **kwargs) -> None:
+        """
+        With ``existing_files`` set to skip or resume, looks for the files already on the SFTP server,
+        to skip these if identical or, with resume, to complete them if partial. The files left partial
+        by a previous run, according to the journal, are always checked, to be completed.
+        """
+        mode = set_else_none("existing_files", kwargs, alt_value="overwrite")
+        if mode == "overwrite":
+            files_transfers = [
+                file_to_transfer
+                for file_to_transfer in files_transfers
+                if file_to_transfer.unit_key in self.journal_partials
+            ]
+        targets_files: dict = {}
+        for file_to_transfer in files_transfers:
+            targets_files.setdefault(file_to_transfer.target, []).append(
+                file_to_transfer
+            )
+        for target, target_files in targets_files.items():
+            try:
+                with target.checkout() as sftp_fd:
+                    for file_to_transfer in target_files:
+                        partial = self.journal_partials.pop(
+                            file_to_transfer.unit_key, None
+                        )
+                        file_to_transfer.file_handler.check_remote(
+                            sftp_fd,
+                            file_to_transfer,
+                            resume=mode == "resume" or partial is not None,
+                        )
+            except Exception as error:
+                LOG.error(f"{target.name} - Failed to check for existing files on SFTP")
+                LOG.exception(error)
+
+    def send_file(self, sftp_fd, file_to_transfer: TransferFile, **kwargs) -> None:
+        """
+        Transfers the file from S3 to SFTP, with the transfer mode fitting the settings and file size.
+        Partial remote files are only ever written in order, so are resumed by streaming, even if large.
+        """
+        handler = file_to_transfer.file_handler
+        if file_to_transfer.file_transfer_status == "SFTP_SKIPPED":
+            return
+        if self.sends_in_ranges(file_to_transfer, **kwargs):
+            handler.push_ranges(
+                sftp_fd,
+                file_to_transfer,
+                range_size=int(
+                    set_else_none("large_file_chunk_size", kwargs, alt_value=64) * MB
+                ),
+                fan_out=int(set_else_none("large_file_fan_out", kwargs, alt_value=4)),
+            )
+        elif keyisset("streaming", kwargs) or file_to_transfer.resume_offset:
+            handler.stream(
+                sftp_fd,
+                file_to_transfer,
+                chunk_size=int(
+                    set_else_none("stream_chunk_size", kwargs, alt_value=8) * MB
+                ),
+                offset=file_to_transfer.resume_offset,
+                checksums=self.new_checksums(file_to_transfer, **kwargs),
+            )
+        else:
+            handler.pull(file_to_transfer)
+            if file_to_transfer.file_transfer_status != "S3_COMPLETE":
+                raise OSError(f"{file_to_transfer.file_name} - Failed to pull from S3")
+            handler.push(
+                sftp_fd,
+                file_to_transfer,
+                checksums=self.new_checksums(file_to_transfer, **kwargs),
+            )
+
+    def transfer_file(
+        self, file_to_transfer: TransferFile, **kwargs
+    ) -> Union[bool, None]:
+        """
+        Transfers a single file over one of its target SFTP sessions, and deletes its message once done.
+
+        :return: Whether the file was transferred, None if the worker stopped before processing it.
+        """
+        try:
+            if not self.start_transfer(file_to_transfer, **kwargs):
+                return None
+            target = file_to_transfer.target
+            with target.rate_limiter.file_slot(), target.checkout() as sftp_fd:
+                self.send_file(sftp_fd, file_to_transfer, **kwargs)
+            return self.complete_transfer(file_to_transfer)
+        except Exception as error:
+            LOG.error("Failed to push file to SFTP")
+            LOG.exception(error)
+            return False
+        finally:
+            self.end_transfer(file_to_transfer)
+
+    def prefetch_file(
+        self, file_to_transfer: TransferFile, **kwargs
+    ) -> Union[bool, None]:
+        """
+        First stage of the pipelined transfer: pulls the file from S3 to local.
+        Large, resumed and skipped files are not pulled, as the second stage sends these from S3.
+        """
+        if not self.start_transfer(file_to_transfer, **kwargs):
+            return None
+        if self.sends_from_s3(file_to_transfer, **kwargs):
+            return True
+        try:
+            file_to_transfer.file_handler.pull(file_to_transfer)
+        finally:
+            if file_to_transfer.file_transfer_status != "S3_COMPLETE":
+                self.end_transfer(file_to_transfer)
+        return file_to_transfer.file_transfer_status == "S3_COMPLETE"
+
+    def push_prefetched_file(self, file_to_transfer: TransferFile, **kwargs) -> bool:
+        """
+        Second stage of the pipelined transfer: pushes the local file to SFTP.
+        """
+        try:
+            target = file_to_transfer.target
+            with target.rate_limiter.file_slot(), target.checkout() as sftp_fd:
+                if self.sends_from_s3(file_to_transfer, **kwargs):
+                    self.send_file(sftp_fd, file_to_transfer, **kwargs)
+                else:
+                    file_to_transfer.file_handler.push(
+                        sftp_fd,
+                        file_to_transfer,
+                        checksums=self.new_checksums(file_to_transfer, **kwargs),
+                    )
+            return self.complete_transfer(file_to_transfer)
+        except Exception as error:
+            LOG.error("Failed to push file to SFTP")
+            LOG.exception(error)
+            return False
+        finally:
+            self.end_transfer(file_to_transfer)
+            file_to_transfer.temp_dir.cleanup()
 
     @metric_scope
     def transfer_files_to_sftp(
-        self, sftp_fd, files_transfers: list[TransferFile], metrics, **kwargs
+        self,
+        files_transfers: list[TransferFile],
+        metrics,
+        **kwargs,
     ):
         from . import SFTP_HOST, SFTP_PORT, SFTP_USER
 
         metrics.set_namespace("S3ToSFTP")
+        batch_start = monotonic()
         total_files_size = 0
         files_processed = 0
-        files_failed = 0
-        elapsed_time = 0
-        transfer_rate = kwargs.pop("transfer_rate", 1)
-        error_margin = kwargs.pop("error_margin", 15)
-
-        for file_to_transfer in files_transfers:
-            if not self.keep_running:
-                LOG.warning("Worker instructed to stop")
-                break
-
-            LOG.info(f"Processing file {file_to_transfer.file_name}")
-            transfer_time_estimate = file_to_transfer.file_transfer_duration_estimate(
-                transfer_margin=error_margin, speed_in_mbytes=transfer_rate
+        files_skipped = 0
+        prefetch_size = int(set_else_none("prefetch_size", kwargs, alt_value=0) * MB)
+        concurrency = int(set_else_none("concurrency", kwargs, alt_value=1))
+        received = len(files_transfers)
+        self.set_files_waiting(received)
+        files_transfers = self.route_files(files_transfers)
+        files_failed = received - len(files_transfers)
+        routed = len(files_transfers)
+        files_transfers = self.schedule_files(files_transfers, **kwargs)
+        files_released = routed - len(files_transfers)
+        files_transfers = interleave_targets(self.coalesce_files(files_transfers))
+        self.reserve_messages(files_transfers, **kwargs)
+        unreachable = self.router.open(
+            list(
+                {_file.target.name: _file.target for _file in files_transfers}.values()
             )
-            LOG.info(
-                f"Estimated transfer time for {file_to_transfer.file_name}: {transfer_time_estimate}s"
+        )
+        if unreachable:
+            unreachable_files = [
+                _file for _file in files_transfers if _file.target in unreachable
+            ]
+            self.fail_files(unreachable_files, "SFTP target unreachable")
+            files_failed += len(unreachable_files)
+            files_transfers = [
+                _file for _file in files_transfers if _file.target not in unreachable
+            ]
+        for file_to_transfer in files_transfers:
+            file_to_transfer.set_file_handler(
+                file_to_transfer.target.sftp_info,
+                self.session,
+                s3_client=self.s3_client,
+                directories_cache=file_to_transfer.target.pool.directories,
+                rate_limiter=file_to_transfer.target.rate_limiter,
             )
-            file_to_transfer.message.change_visibility(
-                VisibilityTimeout=transfer_time_estimate
+        self.check_remote_files(files_transfers, **kwargs)
+        self.set_files_waiting(len(files_transfers))
+
+        if concurrency > 1 and len(files_transfers) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(concurrency, len(files_transfers)),
+                thread_name_prefix="transfer",
+            ) as executor:
+                results = list(
+                    executor.map(
+                        partial(self.transfer_file, **kwargs),
+                        files_transfers,
+                    )
+                )
+        elif (
+            prefetch_size
+            and not keyisset("streaming", kwargs)
+            and len(files_transfers) > 1
+        ):
+            results = run_pipeline(
+                files_transfers,
+                partial(self.prefetch_file, **kwargs),
+                partial(self.push_prefetched_file, **kwargs),
+                size_of=lambda _file: (
+                    0 if self.sends_from_s3(_file, **kwargs) else _file.file_size
+                ),
+                max_bytes=prefetch_size,
+                on_skipped=self.release_file,
             )
-            file_to_transfer.set_file_handler(self.sftp_info, self.session)
-            try:
-                file_to_transfer.file_handler.pull(file_to_transfer)
-                file_to_transfer.file_handler.push(sftp_fd, file_to_transfer)
-                if file_to_transfer.file_transfer_duration > 0:
-                    elapsed_time += file_to_transfer.file_transfer_duration
-                    total_files_size += file_to_transfer.file_size
-                    file_to_transfer.message.delete()
-                    LOG.info(
-                        f"{file_to_transfer.file_name} - Transfer complete in: "
-                        f"{file_to_transfer.file_transfer_duration}"
-                        f" - Approximate transfer rate: {file_to_transfer.file_transfer_speed}MB/s"
+        else:
+            results = [
+                self.transfer_file(file_to_transfer, **kwargs)
+                for file_to_transfer in files_transfers
+            ]
+
+        self.set_files_waiting(0)
+        files_processed += files_failed
+        for file_to_transfer, result in zip(files_transfers, results):
+            if not result:
+                file_to_transfer.transfer_message.unit_done(file_to_transfer, False)
+                if self.journal:
+                    self.journal.discard(file_to_transfer)
+            if result is None:
+                continue
+            files_processed += 1
+            if result and file_to_transfer.file_transfer_status == "SFTP_SKIPPED":
+                files_skipped += 1
+            elif result:
+                transferred_size = (
+                    file_to_transfer.file_size - file_to_transfer.resume_offset
+                )
+                if self.throughput:
+                    self.throughput.observe(
+                        transferred_size,
+                        file_to_transfer.file_transfer_duration,
                     )
-            except Exception as error:
-                LOG.error("Failed to push file to SFTP")
-                LOG.exception(error)
+                total_files_size += transferred_size
+                metrics.put_metric(
+                    "FileTransferDuration",
+                    float(file_to_transfer.file_transfer_duration),
+                    "Seconds",
+                )
+            else:
                 files_failed += 1
-            finally:
-                files_processed += 1
 
+        for file_to_transfer in files_transfers:
+            self.end_transfer(file_to_transfer)
+        self.sqs_batcher.flush()
+        if self.throughput:
+            self.throughput.save()
+        batch_duration = monotonic() - batch_start
         metrics.put_metric("TotalFilesSize", float(total_files_size), "Bytes")
-        if elapsed_time and elapsed_time > 0:
+        metrics.put_metric("BatchDuration", float(batch_duration), "Seconds")
+        if batch_duration > 0:
             metrics.put_metric(
-                "TransferRate", float(total_files_size / elapsed_time), "Bytes/Second"
+                "TransferRate",
+                float(total_files_size / batch_duration),
+                "Bytes/Second",
             )
+        TIMERS.emit(metrics)
+        STARTUP.emit(metrics)
         metrics.put_metric("FilesProcessed", float(files_processed), "None")
         metrics.put_metric("FilesFailed", float(files_failed), "None")
+        if files_skipped:
+            metrics.put_metric("FilesSkipped", float(files_skipped), "None")
+        if files_released:
+            metrics.put_metric("FilesReleased", float(files_released), "None")
+        if self.stats_queue:
+            self.stats_queue.put(
+                {
+                    "files_processed": files_processed,
+                    "files_failed": files_failed,
+                    "total_files_size": total_files_size,
+                }
+            )
         metrics.put_dimensions({"Queue": self.queue_name})
-        metrics.set_property(
-            "SftpServer",
-            {
-                SFTP_HOST: self.sftp_host,
-                SFTP_USER: self.sftp_username,
-                SFTP_PORT: self.sftp_port,
-            },
-        )
+        targets = {_file.target.name: _file.target for _file in files_transfers}
+        servers = {
+            name: {
+                SFTP_HOST: target.sftp_info[SFTP_HOST],
+                SFTP_USER: target.sftp_info[SFTP_USER],
+                SFTP_PORT: target.sftp_info[SFTP_PORT],
+            }
+            for name, target in targets.items()
+        }
+        if list(servers) == [DEFAULT_TARGET]:
+            metrics.set_property("SftpServer", servers[DEFAULT_TARGET])
+            if targets[DEFAULT_TARGET].pool.negotiated:
+                metrics.set_property(
+                    "SftpTransport", targets[DEFAULT_TARGET].pool.negotiated
+                )
+        elif servers:
+            metrics.set_property("SftpTargets", servers)
 
     def exit_gracefully(self, signum: int, frame):
         """
         Handles gracious shutdown
         """
-        LOG.warning(f"Received signal {signum}. Stopping process.")
+        if self.keep_running:
+            LOG.warning(
+                f"Received signal {signum}. Stopping once the in-flight transfers are done."
+            )
+            self.keep_running = 0
+            return
+        LOG.warning(f"Received signal {signum} again. Stopping process.")
         LOG.info("Stopping Worker")
-        self.keep_running = 0
-        sftp_connection.close()
+        if self.heartbeat:
+            self.heartbeat.stop()
+        if self.sqs_batcher:
+            self.sqs_batcher.stop()
+        if sftp_connection:
+            sftp_connection.close()
         exit(0)
@@ -0,0 +1,189 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from datetime import datetime, timezone
+from os import path
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+sys.path.insert(0, f"{there}/benchmarks")
+
+from s3_to_sftp.backfill import (
+    BackfillCheckpoint,
+    BackfillMessage,
+    BackfillWorker,
+    list_objects,
+    parse_datetime,
+    parse_s3_url,
+)
+from s3_to_sftp.transfer_file import TransferMessage
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+        self.options = None
+
+    def paginate(self, **options):
+        self.options = options
+        yield from self.pages
+
+
+class FakeS3:
+    def __init__(self, pages):
+        self.paginator = FakePaginator(pages)
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return self.paginator
+
+
+def s3_object(key, size=10, day=1):
+    return {
+        "Key": key,
+        "Size": size,
+        "ETag": '"etag"',
+        "LastModified": datetime(2022, 1, day, tzinfo=timezone.utc),
+    }
+
+
+def test_parse_source():
+    assert parse_s3_url("s3://bucket/some/prefix") == ("bucket", "some/prefix")
+    assert parse_s3_url("s3://bucket") == ("bucket", "")
+    with pytest.raises(ValueError):
+        parse_s3_url("bucket/prefix")
+    assert parse_datetime("2022-01-02") == datetime(2022, 1, 2, tzinfo=timezone.utc)
+    assert parse_datetime(None) is None
+
+
+def test_list_objects():
+    """
+    Function checking the objects are filtered, and the listing starts after the checkpoint.
+    """
+    s3_client = FakeS3(
+        [
+            {
+                "Contents": [
+                    s3_object("p/"),
+                    s3_object("p/a", day=1),
+                    s3_object("p/b", day=5),
+                ]
+            },
+            {},
+            {"Contents": [s3_object("p/c", size=0, day=5), s3_object("p/d", day=9)]},
+        ]
+    )
+    stats = {"listed": 0}
+    objects = list_objects(
+        s3_client,
+        "bucket",
+        "p/",
+        start_after="p/0",
+        modified_after=parse_datetime("2022-01-02"),
+        modified_before=parse_datetime("2022-01-09"),
+        min_size=1,
+        stats=stats,
+    )
+    assert [_object["Key"] for _object in objects] == ["p/b"]
+    assert stats["listed"] == 5
+    assert s3_client.paginator.options == {
+        "Bucket": "bucket",
+        "Prefix": "p/",
+        "StartAfter": "p/0",
+    }
+
+
+def test_checkpoint(tmp_path):
+    """
+    Function checking the checkpoint stops at the first object released once stopped, and is resumed from.
+    """
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    checkpoint = BackfillCheckpoint(checkpoint_file, "s3://bucket/p/")
+    messages = [
+        TransferMessage(BackfillMessage("bucket", s3_object(key, size=10)))
+        for key in ["p/a+b c", "p/b", "p/c", "p/d"]
+    ]
+    assert messages[0].files[0].file_name == "p/a+b c"
+    checkpoint.delete(messages[0].message)
+    checkpoint.change_visibility(messages[1].message, 30)
+    checkpoint.delete(messages[2].message)
+    checkpoint.change_visibility(messages[3].message, 0)
+    assert not checkpoint.advance(messages, stopped=True)
+    assert checkpoint.start_after == "p/c"
+    assert checkpoint.failed == ["p/b"]
+
+    resumed = BackfillCheckpoint(checkpoint_file, "s3://bucket/p/")
+    resumed.load()
+    assert resumed.start_after == "p/c"
+    assert resumed.stats["transferred"] == 2
+    assert resumed.stats["bytes"] == 20
+    assert resumed.stats["failed"] == 1
+    other = BackfillCheckpoint(checkpoint_file, "s3://bucket/other/")
+    other.load()
+    assert other.start_after is None
+
+
+def test_checkpoint_failed_released(tmp_path):
+    """
+    Function checking the objects released while the worker runs are failed, and the backfill goes on.
+    """
+    checkpoint = BackfillCheckpoint(str(tmp_path / "checkpoint.json"), "s3://bucket/")
+    messages = [
+        TransferMessage(BackfillMessage("bucket", s3_object(key))) for key in "abc"
+    ]
+    checkpoint.delete(messages[0].message)
+    checkpoint.change_visibility(messages[1].message, 0)
+    checkpoint.delete(messages[2].message)
+    assert checkpoint.advance(messages)
+    assert checkpoint.start_after == "c"
+    assert checkpoint.failed == ["b"]
+    assert checkpoint.stats["transferred"] == 2
+
+
+def test_backfill_unrouted(tmp_path, monkeypatch):
+    """
+    Function checking the objects not routed are failed, without stopping the backfill.
+    """
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    from sftp_server import LocalSFTPServer
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_EMF_ENVIRONMENT", "Local")
+    sftp_root = tmp_path / "sftp"
+    sftp_root.mkdir()
+    server = LocalSFTPServer(str(sftp_root)).start()
+    sftp_info = dict(server.connection_details, default_path="/upload")
+    sftp_info.update(
+        targets={"default": {}},
+        routes=[
+            {"prefix": "a/", "target": "default"},
+            {"prefix": "c/", "target": "default"},
+        ],
+    )
+    try:
+        with moto.mock_aws():
+            session = boto3.session.Session()
+            s3_client = session.client("s3")
+            s3_client.create_bucket(
+                Bucket="bucket",
+                CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+            )
+            for key in ["a/1", "b/2", "c/3"]:
+                s3_client.put_object(Bucket="bucket", Key=key, Body=b"data")
+            summary = BackfillWorker("s3://bucket/", sftp_info, session=session).run(
+                backfill_checkpoint=str(tmp_path / "checkpoint.json")
+            )
+    finally:
+        server.stop()
+    assert summary["completed"]
+    assert summary["transferred"] == 2
+    assert summary["failed"] == 1
+    assert path.exists(sftp_root / "upload" / "a" / "1")
+    assert not path.exists(sftp_root / "upload" / "b")
+    assert path.exists(sftp_root / "upload" / "c" / "3")
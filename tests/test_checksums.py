@@ -0,0 +1,88 @@
+#  -*- coding: utf-8 -*-
+
+import hashlib
+import sys
+import zlib
+from base64 import b64encode
+from io import BytesIO
+from os import path
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.checksums import ChecksumReader, TransferChecksums, etag_md5
+
+DATA = b"0123456789" * 1000
+
+
+def test_verify_while_reading():
+    """
+    Function checking the checksums computed over the bytes read match the S3 ones.
+    """
+    checksums = TransferChecksums(sidecar=True)
+    checksums.expect(
+        {
+            "ETag": f'"{hashlib.md5(DATA).hexdigest()}"',
+            "ChecksumCRC32": b64encode(zlib.crc32(DATA).to_bytes(4, "big")).decode(),
+            "ChecksumSHA1": "composite-3",
+        }
+    )
+    assert set(checksums.hashers) == {"md5", "crc32", "sha256"}
+    reader = ChecksumReader(BytesIO(DATA), checksums)
+    while reader.read(333):
+        pass
+    computed = checksums.verify("file")
+    assert computed["sha256"] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_mismatch():
+    """
+    Function checking a mismatching checksum raises, and multipart ETags are not compared.
+    """
+    checksums = TransferChecksums()
+    checksums.expect({"ETag": '"abcdef-2"'})
+    assert not checksums.hashers
+    checksums.expect(
+        {"ChecksumSHA256": b64encode(hashlib.sha256(b"other").digest()).decode()}
+    )
+    checksums.update(DATA)
+    with pytest.raises(OSError):
+        checksums.verify("file")
+
+
+def test_etag_not_md5():
+    """
+    Function checking the ETag of objects encrypted with SSE-KMS or SSE-C is not taken for their MD5.
+    """
+    etag = f'"{hashlib.md5(DATA).hexdigest()}"'
+    assert etag_md5({"ETag": etag, "ServerSideEncryption": "AES256"})
+    assert etag_md5({"ETag": etag, "ServerSideEncryption": "aws:kms"}) is None
+    assert etag_md5({"ETag": etag, "SSECustomerAlgorithm": "AES256"}) is None
+    checksums = TransferChecksums()
+    checksums.expect({"ETag": etag, "ServerSideEncryption": "aws:kms:dsse"})
+    assert not checksums.expected
+
+
+def test_composite_checksums():
+    """
+    Function checking the checksums of objects uploaded in parts are only compared when of the whole object,
+    as head_object does not suffix composite checksums with the part count.
+    """
+    crc32 = b64encode(zlib.crc32(DATA).to_bytes(4, "big")).decode()
+    checksums = TransferChecksums()
+    checksums.expect({"ETag": '"abcdef-3"', "ChecksumCRC32": "qJqPzQ=="})
+    assert not checksums.expected
+    checksums.expect(
+        {"ETag": '"abcdef-3"', "ChecksumCRC32": crc32, "ChecksumType": "COMPOSITE"}
+    )
+    assert not checksums.expected
+    checksums.expect(
+        {"ETag": '"abcdef-3"', "ChecksumCRC32": crc32, "ChecksumType": "FULL_OBJECT"}
+    )
+    checksums.update(DATA)
+    assert checksums.verify("file") == {
+        "crc32": zlib.crc32(DATA).to_bytes(4, "big").hex()
+    }
@@ -0,0 +1,228 @@
+#  -*- coding: utf-8 -*-
+
+import io
+import json
+import sys
+import tarfile
+import zipfile
+from contextlib import nullcontext
+from functools import partial
+from os import path
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp import worker as worker_module
+from s3_to_sftp.coalesce import MB, ArchiveWriter, Coalescer, get_coalescer
+from s3_to_sftp.worker import Worker
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        content = self.objects[Key]
+        return {"ContentLength": len(content), "Body": io.BytesIO(content)}
+
+
+class FakeRemoteFile(io.BytesIO):
+    def close(self):
+        pass
+
+
+def transfer_file(key, size):
+    return SimpleNamespace(
+        s3_bucket="bucket",
+        file_name=key,
+        file_size=size,
+        file_info={"etag": "etag", "version_id": None},
+    )
+
+
+class FakeBatcher:
+    def __init__(self):
+        self.visibility = {}
+
+    def change_visibility(self, message, timeout):
+        self.visibility[message.receipt_handle] = timeout
+
+    def flush(self):
+        pass
+
+
+def message_files(target, *sizes):
+    """
+    :return: the files of one message, of the ``sizes`` set, all routed to ``target``
+    """
+    transfer_message = SimpleNamespace(
+        files=[], unit_done=lambda transfer_file, success: False
+    )
+    message = SimpleNamespace(receipt_handle="handle")
+    for index, size in enumerate(sizes):
+        _file = transfer_file(f"file-{index}", size)
+        _file.message = message
+        _file.transfer_message = transfer_message
+        _file.target = target
+        _file.temp_dir = SimpleNamespace(cleanup=lambda: None)
+        transfer_message.files.append(_file)
+    return transfer_message.files
+
+
+def new_worker(**attributes):
+    worker = SimpleNamespace(
+        sqs_batcher=FakeBatcher(),
+        heartbeat=None,
+        transfer_rate_for=lambda transfer_file, **kwargs: 1,
+        **attributes,
+    )
+    for method in [
+        "coalesce_files",
+        "coalescing_timeout",
+        "reserve_messages",
+        "release_file",
+        "end_transfer",
+    ]:
+        setattr(worker, method, partial(getattr(Worker, method), worker))
+    return worker
+
+
+def test_buffering():
+    """
+    Function checking the files are buffered until the archive is large enough.
+    """
+    coalescer = Coalescer(max_wait=3600, max_size=10, max_file_size=6)
+    assert not coalescer.accepts(transfer_file("big", 7))
+    assert not coalescer.due()
+    coalescer.add(transfer_file("a", 6))
+    assert not coalescer.due()
+    coalescer.add(transfer_file("b", 4))
+    assert coalescer.due()
+    assert [_file.file_name for _file in coalescer.take()] == ["a", "b"]
+    assert not coalescer.due()
+    assert coalescer.visibility_timeout == 3600 * 2 + 60
+
+    coalescer = Coalescer(max_wait=0)
+    coalescer.add(transfer_file("a", 1))
+    assert coalescer.due()
+    with pytest.raises(ValueError):
+        Coalescer("rar")
+
+
+def test_get_coalescer():
+    assert get_coalescer({"host": "sftp"}) is None
+    coalescer = get_coalescer(
+        {"coalesce": {"format": "zip", "max_size": 0.5, "manifest": True}}
+    )
+    assert coalescer.archive_format == "zip"
+    assert coalescer.max_size == MB // 2
+    assert coalescer.max_file_size == MB
+    assert coalescer.manifest
+    assert coalescer.archive_path({"default_path": "/out"}).startswith("/out/batch-")
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "tar.gz", "zip"])
+def test_write_archive(archive_format):
+    """
+    Function checking the objects and the manifest are written in the archive.
+    """
+    objects = {"p/a.csv": b"a" * 10, "p/b.csv": b"b" * 3}
+    files = [transfer_file(key, len(content)) for key, content in objects.items()]
+    coalescer = Coalescer(archive_format, manifest=True)
+    remote_fd = FakeRemoteFile()
+    writer = ArchiveWriter(remote_fd)
+    coalescer.write_archive(writer, files, FakeS3(objects))
+    assert writer.written == len(remote_fd.getvalue())
+
+    remote_fd.seek(0)
+    if archive_format == "zip":
+        with zipfile.ZipFile(remote_fd) as archive:
+            members = {name: archive.read(name) for name in archive.namelist()}
+    else:
+        with tarfile.open(fileobj=remote_fd) as archive:
+            members = {
+                member.name: archive.extractfile(member).read() for member in archive
+            }
+    manifest = json.loads(members.pop("manifest.json"))
+    assert members == objects
+    assert [entry["key"] for entry in manifest] == ["p/a.csv", "p/b.csv"]
+    assert manifest[0]["size"] == 10
+
+
+def test_flush_while_transferring(monkeypatch):
+    """
+    Function checking the archives are uploaded once due from the background thread, not after the batch.
+    """
+    monkeypatch.setattr(worker_module, "COALESCE_CHECK_INTERVAL", 0.01)
+    uploaded = []
+    coalescer = Coalescer(max_wait=0)
+    worker = SimpleNamespace(
+        router=SimpleNamespace(
+            targets={"default": SimpleNamespace(coalescer=coalescer)}
+        ),
+        upload_coalesced=lambda target: uploaded.append(target.coalescer.take()),
+        _flush_lock=Lock(),
+    )
+    worker.flush_coalesced = partial(Worker.flush_coalesced, worker)
+    coalescer.add(transfer_file("a", 1))
+    stopped = Event()
+    flusher = Thread(target=Worker.flush_coalesced_periodically, args=(worker, stopped))
+    flusher.start()
+    for _ in range(500):
+        if uploaded or stopped.wait(0.01):
+            break
+    stopped.set()
+    flusher.join()
+    assert [[_file.file_name for _file in files] for files in uploaded] == [["a"]]
+
+
+def test_coalesced_visibility():
+    """
+    Function checking the message of a file coalesced and of a file transferred on its own stays invisible
+    until the archive is uploaded, even when its transfer is estimated shorter, or failed.
+    """
+    coalescer = Coalescer(max_wait=600, max_file_size=10)
+    small, large = message_files(SimpleNamespace(coalescer=coalescer), 10, 11)
+    large.file_transfer_duration_estimate = lambda **kwargs: 30
+    worker = new_worker()
+    assert worker.coalesce_files([small, large]) == [large]
+    worker.reserve_messages([large])
+    assert worker.sqs_batcher.visibility == {"handle": 600 * 2 + 60}
+    worker.release_file(large)
+    assert worker.sqs_batcher.visibility == {"handle": 600 * 2 + 60}
+    coalescer.take()
+    worker.release_file(large)
+    assert worker.sqs_batcher.visibility == {"handle": 0}
+
+
+def test_upload_coalesced_failure():
+    """
+    Function checking the messages of the files of an archive failed to upload are made visible again.
+    """
+
+    def checkout():
+        raise ConnectionError("connection reset")
+
+    coalescer = Coalescer(max_wait=600)
+    target = SimpleNamespace(
+        name="default",
+        coalescer=coalescer,
+        sftp_info={},
+        rate_limiter=SimpleNamespace(file_slot=nullcontext),
+        checkout=checkout,
+    )
+    worker = new_worker(
+        s3_client=None, stats_queue=None, queue_name="queue", journal=None
+    )
+    files = message_files(target, 1, 2)
+    worker.coalesce_files(files)
+    assert worker.sqs_batcher.visibility == {"handle": 600 * 2 + 60}
+    Worker.upload_coalesced(worker, target)
+    assert [_file.file_transfer_status for _file in files] == ["SFTP_FAILED"] * 2
+    assert worker.sqs_batcher.visibility == {"handle": 0}
+    assert not coalescer.files
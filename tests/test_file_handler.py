@@ -0,0 +1,311 @@
+#  -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import sys
+from base64 import b64encode
+from os import path
+from threading import Condition, current_thread
+from types import SimpleNamespace
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+sys.path.insert(0, f"{there}/benchmarks")
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from paramiko import ChannelException
+from sftp_server import LocalSFTPServer
+
+from s3_to_sftp import transfer_handler
+from s3_to_sftp.checksums import TransferChecksums
+from s3_to_sftp.transfer_handler import FileHandler, get_sftp_connection
+
+BUCKET = "source-bucket"
+REMOTE_PATH = "/upload"
+
+
+class FakeTransferFile:
+    """
+    File to transfer, recording the size of each progress step.
+    """
+
+    def __init__(self, key, body):
+        self.file_name = key
+        self.file_size = len(body)
+        self.file_info = {}
+        self.file_transfer_status = "PENDING"
+        self.file_transfer_start_time = None
+        self.file_transfer_end_time = None
+        self.checksums = {}
+        self.progress = []
+
+    def record_progress(self, nbytes):
+        self.progress.append(nbytes)
+
+
+class WrongChecksumsClient:
+    """
+    S3 client returning a SHA-256 checksum not matching the object content.
+    """
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def head_object(self, **kwargs):
+        return dict(
+            self.s3_client.head_object(**kwargs),
+            ChecksumSHA256=b64encode(hashlib.sha256(b"other").digest()).decode(),
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+
+class RangesClient:
+    """
+    S3 client recording the ranges got, and the threads getting these, failing for the ``failing`` one.
+    The ranges are only returned once ``writers`` threads got one, for these to all take part.
+    """
+
+    def __init__(self, s3_client, writers=1, failing=None):
+        self.s3_client = s3_client
+        self.writers = writers
+        self.failing = failing
+        self.ranges = []
+        self.threads = set()
+        self._condition = Condition()
+
+    def get_object(self, **kwargs):
+        with self._condition:
+            self.ranges.append(kwargs["Range"])
+            self.threads.add(current_thread().name)
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: len(self.threads) >= self.writers, 5)
+        if kwargs["Range"] == self.failing:
+            raise ConnectionError("connection reset")
+        return self.s3_client.get_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+
+class Storage:
+    def __init__(self, s3_client, sftp_root, sftp_info):
+        self.s3 = s3_client
+        self.sftp_root = sftp_root
+        self.sftp_info = sftp_info
+        self.s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+        )
+        self.sftp_fd = get_sftp_connection(sftp_info)
+
+    def put_object(self, key, body, **kwargs):
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body, **kwargs)
+
+    def new_transfer(self, key, body, s3_client=None, **kwargs):
+        """
+        :return: the handler of the object put in S3 with ``body``, and the file to transfer
+        """
+        self.put_object(key, body, **kwargs)
+        handler = FileHandler(
+            BUCKET,
+            key,
+            SimpleNamespace(name=self.sftp_root),
+            self.sftp_info,
+            s3_client=s3_client or self.s3,
+        )
+        return handler, FakeTransferFile(key, body)
+
+    def write_remote(self, key, body):
+        remote_path = f"{self.sftp_root}{REMOTE_PATH}/{key}"
+        os.makedirs(path.dirname(remote_path), exist_ok=True)
+        with open(remote_path, "wb") as remote_fd:
+            remote_fd.write(body)
+
+    def remote_files(self, directory=""):
+        return sorted(
+            os.listdir(path.join(f"{self.sftp_root}{REMOTE_PATH}", directory))
+        )
+
+    def remote_file(self, key):
+        with open(f"{self.sftp_root}{REMOTE_PATH}/{key}", "rb") as remote_fd:
+            return remote_fd.read()
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    sftp_root = tmp_path / "sftp"
+    sftp_root.mkdir()
+    server = LocalSFTPServer(str(sftp_root)).start()
+    with moto.mock_aws():
+        env = Storage(
+            boto3.session.Session().client("s3"),
+            str(sftp_root),
+            dict(server.connection_details, default_path=REMOTE_PATH),
+        )
+        yield env
+        env.sftp_fd.close()
+    server.stop()
+
+
+def test_stream_chunks(storage):
+    """
+    Function checking the object is streamed in chunks of the size set, and written byte for byte.
+    """
+    body = os.urandom(10 * 1024 + 100)
+    handler, transfer_file = storage.new_transfer("a/b/file.bin", body)
+    handler.stream(storage.sftp_fd, transfer_file, chunk_size=1024)
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    assert transfer_file.progress == [1024] * 10 + [100]
+    assert storage.remote_file("a/b/file.bin") == body
+
+
+def test_stream_read_ahead(storage):
+    """
+    Function checking the chunks read ahead are written in order.
+    """
+    storage.sftp_info["transport"] = {"read_ahead": 3}
+    body = os.urandom(20 * 1024)
+    handler, transfer_file = storage.new_transfer("file.bin", body)
+    handler.stream(storage.sftp_fd, transfer_file, chunk_size=1000)
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    assert storage.remote_file("file.bin") == body
+
+
+def test_stream_resume(storage):
+    """
+    Function checking a partial remote file is completed from the offset, without sending it again.
+    """
+    body = os.urandom(8 * 1024)
+    handler, transfer_file = storage.new_transfer("a/partial.bin", body)
+    storage.write_remote("a/partial.bin", body[:3000])
+    handler.stream(storage.sftp_fd, transfer_file, chunk_size=1024, offset=3000)
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    assert sum(transfer_file.progress) == len(body) - 3000
+    assert storage.remote_file("a/partial.bin") == body
+
+
+def test_stream_checksums(storage):
+    """
+    Function checking the checksums are computed while streaming, and compared with the S3 ones.
+    """
+    body = os.urandom(5000)
+    handler, transfer_file = storage.new_transfer(
+        "checked.bin", body, ChecksumAlgorithm="SHA256"
+    )
+    handler.stream(
+        storage.sftp_fd,
+        transfer_file,
+        chunk_size=1024,
+        checksums=TransferChecksums(sidecar=True),
+    )
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    sha256 = hashlib.sha256(body).hexdigest()
+    assert transfer_file.checksums["sha256"] == sha256
+    assert transfer_file.checksums["md5"] == hashlib.md5(body).hexdigest()
+    assert (
+        storage.remote_file("checked.bin.sha256") == f"{sha256}  checked.bin\n".encode()
+    )
+
+
+def test_stream_checksum_mismatch(storage):
+    """
+    Function checking a file not matching the S3 checksum is failed.
+    """
+    body = os.urandom(5000)
+    handler, transfer_file = storage.new_transfer(
+        "corrupt.bin", body, s3_client=WrongChecksumsClient(storage.s3)
+    )
+    handler.stream(
+        storage.sftp_fd, transfer_file, chunk_size=1024, checksums=TransferChecksums()
+    )
+    assert transfer_file.file_transfer_status == "SFTP_FAILED"
+
+
+def test_push_ranges(storage):
+    """
+    Function checking the object is split in ranges, written at their offsets over several channels,
+    then replacing the remote file.
+    """
+    body = os.urandom(10 * 1024 + 10)
+    s3_client = RangesClient(storage.s3, writers=3)
+    handler, transfer_file = storage.new_transfer(
+        "a/ranges.bin", body, s3_client=s3_client
+    )
+    storage.write_remote("a/ranges.bin", b"previous")
+    handler.push_ranges(storage.sftp_fd, transfer_file, range_size=1024, fan_out=3)
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    assert sorted(s3_client.ranges) == sorted(
+        [f"bytes={start}-{start + 1023}" for start in range(0, 10 * 1024, 1024)]
+        + ["bytes=10240-10249"]
+    )
+    assert s3_client.threads == {"range-0", "range-1", "range-2"}
+    assert sum(transfer_file.progress) == len(body)
+    assert storage.remote_file("a/ranges.bin") == body
+    assert storage.remote_files("a") == ["ranges.bin"]
+
+
+def test_push_ranges_failure(storage):
+    """
+    Function checking the file is failed when one of its ranges cannot be transferred, without leaving
+    the remote file with holes, nor replacing the previous one.
+    """
+    body = os.urandom(8 * 1024)
+    s3_client = RangesClient(storage.s3, failing="bytes=0-1023")
+    handler, transfer_file = storage.new_transfer(
+        "failed.bin", body, s3_client=s3_client
+    )
+    storage.write_remote("failed.bin", b"previous")
+    handler.push_ranges(storage.sftp_fd, transfer_file, range_size=1024, fan_out=2)
+    assert transfer_file.file_transfer_status == "SFTP_FAILED"
+    assert transfer_file.file_transfer_start_time is None
+    assert "bytes=0-1023" in s3_client.ranges
+    assert storage.remote_file("failed.bin") == b"previous"
+    assert storage.remote_files() == ["failed.bin"]
+
+
+def test_push_ranges_channels_refused(storage, monkeypatch):
+    """
+    Function checking the ranges are written over the session alone when no more channels can be opened.
+    """
+
+    class NoChannels:
+        @staticmethod
+        def from_transport(transport):
+            raise ChannelException(1, "Administratively prohibited")
+
+    monkeypatch.setattr(transfer_handler, "SFTPClient", NoChannels)
+    body = os.urandom(4 * 1024)
+    s3_client = RangesClient(storage.s3)
+    handler, transfer_file = storage.new_transfer(
+        "refused.bin", body, s3_client=s3_client
+    )
+    handler.push_ranges(storage.sftp_fd, transfer_file, range_size=1024, fan_out=4)
+    assert transfer_file.file_transfer_status == "SFTP_COMPLETE"
+    assert s3_client.threads == {"range-0"}
+    assert storage.remote_file("refused.bin") == body
+
+
+@pytest.mark.parametrize(
+    "ciphers", [["aes128-ctr", "aes256-ctr"], ["aes256-ctr", "aes128-ctr"]]
+)
+def test_preferred_ciphers_order(storage, ciphers):
+    """
+    Function checking the cipher negotiated is the first of the preferred ones.
+    """
+    storage.sftp_info["transport"] = {"ciphers": ciphers}
+    sftp_fd = get_sftp_connection(storage.sftp_info)
+    transport = sftp_fd.get_channel().get_transport()
+    try:
+        assert transport.local_cipher == ciphers[0]
+    finally:
+        transport.close()
@@ -0,0 +1,103 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from types import SimpleNamespace
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.journal import TransferJournal
+
+
+class FakeSFTP:
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def stat(self, remote_path):
+        if remote_path not in self.sizes:
+            raise FileNotFoundError(remote_path)
+        return SimpleNamespace(st_size=self.sizes[remote_path])
+
+
+def new_file(message_id, name, size, message_files=1, target="default"):
+    transfer_message = SimpleNamespace(
+        files=[None] * message_files, completed_units=set()
+    )
+    return SimpleNamespace(
+        message=SimpleNamespace(
+            message_id=message_id, receipt_handle=f"handle-{message_id}"
+        ),
+        transfer_message=transfer_message,
+        unit_key=("bucket", name, "etag"),
+        file_size=size,
+        file_handler=SimpleNamespace(remote_file_path=f"/remote/{name}"),
+        target=SimpleNamespace(name=target),
+    )
+
+
+def test_reconcile(tmp_path):
+    """
+    Function checking the journal survives being reopened, and is reconciled with the remote files.
+    """
+    journal_file = str(tmp_path / "journal.db")
+    journal = TransferJournal(journal_file)
+    done = new_file("m1", "done", 10)
+    on_remote = new_file("m2", "on_remote", 10, message_files=2)
+    partial = new_file("m2", "partial", 10, message_files=2)
+    missing = new_file("m3", "missing", 10)
+    acked = new_file("m4", "acked", 10)
+    other_target = new_file("m5", "other", 10, target="other")
+    removed_target = new_file("m6", "removed", 10, target="removed")
+    for transfer_file in [done, on_remote, partial, missing, acked, other_target]:
+        journal.begin(transfer_file)
+    journal.begin(removed_target)
+    journal.complete(done)
+    journal.complete(acked)
+    journal.forget([acked.message])
+    journal.close()
+
+    journal = TransferJournal(journal_file)
+    assert sorted(journal.targets()) == ["default", "other", "removed"]
+    to_delete, to_release, partials = journal.reconcile(
+        {
+            "default": FakeSFTP({"/remote/on_remote": 10, "/remote/partial": 4}),
+            "other": FakeSFTP({"/remote/other": 10}),
+        }
+    )
+    assert [message.message_id for message in to_delete] == ["m1", "m5"]
+    assert [message.message_id for message in to_release] == ["m2", "m3", "m6"]
+    assert to_release[0].receipt_handle == "handle-m2"
+    assert partials == {("bucket", "partial", "etag"): 4}
+    assert journal.completed_units() == {
+        "m1": {("bucket", "done", "etag")},
+        "m2": {("bucket", "on_remote", "etag")},
+        "m5": {("bucket", "other", "etag")},
+    }
+    journal.discard(done)
+    journal.discard(partial)
+    assert [entry["remote_path"] for entry in journal.entries()] == [
+        "/remote/done",
+        "/remote/on_remote",
+        "/remote/other",
+    ]
+
+
+def test_reconcile_not_size_only(tmp_path):
+    """
+    Function checking the transfers verifying more than the remote file size, or sent in ranges, are
+    transferred again rather than completed from a remote file of the object size.
+    """
+    journal = TransferJournal(str(tmp_path / "journal.db"))
+    checked = new_file("m1", "checked", 10)
+    sized = new_file("m2", "sized", 10)
+    journal.begin(checked, size_only=False)
+    journal.begin(sized)
+    to_delete, to_release, partials = journal.reconcile(
+        {"default": FakeSFTP({"/remote/checked": 10, "/remote/sized": 10})}
+    )
+    assert [message.message_id for message in to_delete] == ["m2"]
+    assert [message.message_id for message in to_release] == ["m1"]
+    assert partials == {}
+    journal.close()
@@ -0,0 +1,86 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+import threading
+import time
+from os import path
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.pipeline import ByteBudget, run_pipeline
+
+
+def test_pipeline_keeps_order_and_skips_failed():
+    """
+    Function checking results are returned in order and failed first stage skip the second.
+    """
+    pushed = []
+
+    def pull(item):
+        if item == 2:
+            raise OSError("pull failed")
+        return True
+
+    def push(item):
+        pushed.append(item)
+        return item * 10
+
+    results = run_pipeline(range(5), pull, push, size_of=lambda _: 1, max_bytes=2)
+    assert results == [0, 10, False, 30, 40]
+    assert pushed == [0, 1, 3, 4]
+
+
+def test_pipeline_stops_on_none():
+    """
+    Function checking that a first stage returning None stops the pipeline, and the items left are skipped.
+    """
+    skipped = []
+    results = run_pipeline(
+        range(5),
+        lambda item: None if item == 2 else True,
+        lambda item: True,
+        size_of=lambda _: 1,
+        max_bytes=10,
+        on_skipped=skipped.append,
+    )
+    assert results == [True, True, None, None, None]
+    assert skipped == [3, 4]
+
+
+def test_budget_caps_prefetched_bytes():
+    """
+    Function checking the prefetch never goes above the budget, except for one oversized item.
+    """
+    held = []
+    budget_max = 10
+
+    def pull(item):
+        held.append(item)
+        assert sum(held) <= budget_max or len(held) == 1
+        return True
+
+    def push(item):
+        time.sleep(0.01)
+        held.remove(item)
+        return True
+
+    assert all(run_pipeline([4, 4, 4, 12, 3], pull, push, lambda x: x, budget_max))
+
+
+def test_byte_budget_lets_oversized_item_through():
+    """
+    Function checking an item bigger than the budget does not block forever.
+    """
+    budget = ByteBudget(5)
+    done = threading.Event()
+
+    def acquire():
+        budget.acquire(50)
+        done.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert done.wait(1)
+    thread.join()
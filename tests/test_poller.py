@@ -0,0 +1,106 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from threading import Event
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp import poller
+from s3_to_sftp.poller import QueuePoller
+
+
+class FakeClient:
+    def __init__(self):
+        self.extended = []
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.extended += Entries
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+class FakeQueue:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = []
+        self.received = Event()
+        self.meta = SimpleNamespace(client=FakeClient())
+        self.url = "queue-url"
+
+    def receive_messages(self, WaitTimeSeconds, MaxNumberOfMessages, AttributeNames):
+        self.calls.append(MaxNumberOfMessages)
+        self.received.set()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("SQS unavailable")
+        return [
+            SimpleNamespace(receipt_handle=f"message-{len(self.calls)}-{index}")
+            for index in range(MaxNumberOfMessages)
+        ]
+
+
+def wait_until(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        sleep(0.01)
+    return condition()
+
+
+def test_buffer_bounded():
+    """
+    Function checking the poller does not receive more than the buffer holds, nor while told not to.
+    """
+    queue = FakeQueue()
+    allowed = Event()
+    queue_poller = QueuePoller(
+        queue, max_buffered=3, batch_size=lambda: 2, can_poll=allowed.is_set
+    )
+    assert queue_poller.wanted() == 0
+    allowed.set()
+    assert queue_poller.wanted() == 2
+    queue_poller.start()
+    assert queue.received.wait(5)
+    assert wait_until(lambda: not queue_poller.wanted())
+    allowed.clear()
+    assert len(queue_poller.get(5)) == 2
+    assert queue.calls == [2]
+    assert queue_poller.get(0.1) == []
+    assert queue_poller.stop() == []
+    assert not queue_poller.is_alive()
+
+
+def test_buffered_messages_kept_invisible(monkeypatch):
+    """
+    Function checking the visibility of the messages buffered is extended until these are taken.
+    """
+    monkeypatch.setattr(poller, "CHECK_INTERVAL", 0.01)
+    queue = FakeQueue()
+    queue_poller = QueuePoller(queue, max_buffered=2, visibility_timeout=0.1)
+    queue_poller.start()
+    assert wait_until(lambda: len(queue.meta.client.extended) >= 4)
+    assert queue.meta.client.extended[0] == {
+        "Id": "0",
+        "ReceiptHandle": "message-1-0",
+        "VisibilityTimeout": 0.1,
+    }
+    assert len(queue_poller.get(1)) == 2
+    queue_poller.stop()
+
+
+def test_backoff_on_errors(monkeypatch):
+    """
+    Function checking the failed calls are retried, and the failures count reset once received.
+    """
+    monkeypatch.setattr(poller, "MAX_RETRY_DELAY", 0)
+    queue = FakeQueue(failures=3)
+    queue_poller = QueuePoller(queue, max_buffered=1)
+    queue_poller.start()
+    assert [message.receipt_handle for message in queue_poller.get(5)] == [
+        "message-4-0"
+    ]
+    queue_poller.stop()
+    assert queue_poller.failures == 0
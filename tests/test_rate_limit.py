@@ -0,0 +1,99 @@
+#  -*- coding: utf-8 -*-
+
+import io
+import sys
+from os import path
+from threading import Thread
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp import rate_limit
+from s3_to_sftp.rate_limit import (
+    MB,
+    RateLimiter,
+    ThrottledReader,
+    TokenBucket,
+    get_rate_limiter,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket(monkeypatch):
+    """
+    Function checking the bucket lets the burst through, then holds back to the rate.
+    """
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limit, "sleep", clock.sleep)
+    bucket = TokenBucket(100)
+    assert bucket.consume(100) == 0
+    assert bucket.consume(50) == 0.5
+    assert clock.now == 0.5
+    assert bucket.consume(250) == 2.5
+    clock.now += 10
+    assert bucket.consume(100) == 0
+
+
+def test_throttled_reader(monkeypatch):
+    """
+    Function checking the bytes read are taken from the limiter.
+    """
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limit, "sleep", clock.sleep)
+    reader = ThrottledReader(io.BytesIO(b"x" * 3 * MB), RateLimiter(max_bandwidth=1))
+    while reader.read(MB):
+        pass
+    assert reader.waited == 2
+    assert ThrottledReader(io.BytesIO(b"x" * MB), RateLimiter()).read() == b"x" * MB
+
+
+def test_file_slots():
+    """
+    Function checking no more than max_files hold a slot at once.
+    """
+    limiter = RateLimiter(max_files=1)
+    holding: list = []
+    entered: list = []
+
+    def transfer():
+        with limiter.file_slot():
+            entered.append(len(holding))
+            holding.append(True)
+            holding.pop()
+
+    threads = [Thread(target=transfer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert entered == [0] * 8
+    with RateLimiter().file_slot():
+        pass
+
+
+def test_limits():
+    """
+    Function checking the target limits take precedence, and the rate each file gets.
+    """
+    limiter = get_rate_limiter({"host": "sftp"}, max_bandwidth=10, max_files=2)
+    assert limiter.file_rate(4) == 5
+    assert limiter.file_rate(1) == 10
+    limiter = get_rate_limiter(
+        {"limits": {"max_bandwidth": 8}}, max_bandwidth=10, max_files=0
+    )
+    assert limiter.max_bandwidth == 8
+    assert limiter.file_rate(4) == 2
+    assert get_rate_limiter({}).file_rate(4) == 0
@@ -0,0 +1,133 @@
+#  -*- coding: utf-8 -*-
+
+import json
+import sys
+from os import path
+from types import SimpleNamespace
+
+import pytest
+from jsonschema import ValidationError, validate
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.routing import (
+    DEFAULT_TARGET,
+    get_router,
+    get_targets_settings,
+    interleave_targets,
+)
+
+with open(f"{there}/s3_to_sftp/secret-format.json") as secret_format_fd:
+    SECRET_SCHEMA = json.load(secret_format_fd)
+
+ROUTING = {
+    "username": "user",
+    "password": "secret",
+    "limits": {"max_bandwidth": 10},
+    "targets": {
+        "a": {"host": "sftp-a", "port": 22, "default_path": "/in", "concurrency": 2},
+        "b": {"host": "sftp-b", "port": 2222, "limits": {"max_concurrent_files": 1}},
+    },
+    "routes": [
+        {"bucket": "exports-*", "prefix": "partner-a/", "target": "a"},
+        {"prefix": "partner-*/", "target": "b"},
+    ],
+}
+
+
+class FakePool:
+    def __init__(self, target, fail=False):
+        self.fail = fail
+        self.opened = 0
+        self.closed = 0
+
+    def open(self):
+        self.opened += 1
+        if self.fail:
+            raise ConnectionError("unreachable")
+
+    def close(self):
+        self.closed += 1
+
+
+def test_targets_settings():
+    """
+    Function checking the shared settings apply to the targets, and the routes are to known targets.
+    """
+    validate(ROUTING, SECRET_SCHEMA)
+    targets, routes = get_targets_settings(ROUTING)
+    assert targets["a"]["username"] == "user"
+    assert targets["a"]["limits"] == {"max_bandwidth": 10}
+    assert targets["b"]["limits"] == {"max_concurrent_files": 1}
+    for target in targets.values():
+        validate(target, SECRET_SCHEMA)
+    assert len(routes) == 2
+
+    legacy = {"host": "sftp", "port": 22, "username": "user", "password": "secret"}
+    validate(legacy, SECRET_SCHEMA)
+    assert get_targets_settings(legacy) == (
+        {DEFAULT_TARGET: legacy},
+        [{"target": DEFAULT_TARGET}],
+    )
+    with pytest.raises(ValidationError):
+        validate({k: v for k, v in ROUTING.items() if k != "routes"}, SECRET_SCHEMA)
+    with pytest.raises(ValidationError):
+        validate({"host": "sftp", "port": 22, "password": "secret"}, SECRET_SCHEMA)
+    with pytest.raises(ValueError):
+        get_targets_settings(dict(ROUTING, routes=[{"target": "c"}]))
+
+
+def test_router():
+    """
+    Function checking the objects go to the first matching route, and the targets settings.
+    """
+    router = get_router(ROUTING, FakePool, concurrency=4, max_files=3)
+    assert router.route("exports-2022", "partner-a/file").name == "a"
+    assert router.route("other", "partner-a/file").name == "b"
+    assert router.route("exports-2022", "partner-c/file").name == "b"
+    assert router.route("exports-2022", "file") is None
+
+    target_a, target_b = router.targets["a"], router.targets["b"]
+    assert target_a.concurrency == 2
+    assert target_b.concurrency == 4
+    assert target_a.rate_limiter.max_bandwidth == 10
+    assert target_a.rate_limiter.max_files == 3
+    assert target_b.rate_limiter.max_files == 1
+    assert target_b.connection_string == "user@sftp-b:2222"
+
+
+def test_open_targets():
+    """
+    Function checking the targets are connected once, and the unreachable ones reported.
+    """
+    router = get_router(
+        ROUTING, lambda target: FakePool(target, fail=target.name == "b")
+    )
+    target_a, target_b = router.targets["a"], router.targets["b"]
+    assert router.open([target_a, target_b]) == [target_b]
+    assert router.open([target_a]) == []
+    assert target_a.pool.opened == 1
+    assert target_a.opened and not target_b.opened
+    assert target_b.pool.closed == 1
+    assert router.open([target_b]) == [target_b]
+    assert target_b.pool.opened == 1
+    router.close()
+    assert target_a.pool.closed == 1
+    assert not target_a.opened
+
+
+def test_interleave_targets():
+    files = [
+        SimpleNamespace(name=name, target=SimpleNamespace(name=name[0]))
+        for name in ["a1", "a2", "a3", "b1", "c1", "b2"]
+    ]
+    assert [_file.name for _file in interleave_targets(files)] == [
+        "a1",
+        "b1",
+        "c1",
+        "a2",
+        "b2",
+        "a3",
+    ]
@@ -0,0 +1,90 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from types import SimpleNamespace
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.scheduler import order_files, split_late_messages
+
+
+def new_file(name, size, message="1", bucket="bucket"):
+    return SimpleNamespace(
+        file_name=name,
+        file_size=size,
+        s3_bucket=bucket,
+        message=SimpleNamespace(receipt_handle=message),
+    )
+
+
+def test_order_files():
+    """
+    Function checking the files order of each policy.
+    """
+    files = [
+        new_file("a/big", 300),
+        new_file("a/small", 1),
+        new_file("a/medium", 20),
+        new_file("b/medium", 10),
+        new_file("root", 5),
+    ]
+    names = lambda _files: [_file.file_name for _file in _files]
+    assert order_files(files) == files
+    assert names(order_files(files, "sjf")) == [
+        "a/small",
+        "root",
+        "b/medium",
+        "a/medium",
+        "a/big",
+    ]
+    assert names(order_files(files, "fair")) == [
+        "a/small",
+        "root",
+        "b/medium",
+        "a/medium",
+        "a/big",
+    ]
+    assert names(order_files(files, "fair", prefix_depth=0)) == names(
+        order_files(files, "sjf")
+    )
+    files.append(new_file("c/tiny", 0, bucket="other"))
+    assert names(order_files(files, "fair"))[:5] == [
+        "c/tiny",
+        "a/small",
+        "root",
+        "b/medium",
+        "a/medium",
+    ]
+    with pytest.raises(ValueError):
+        order_files(files, "lifo")
+
+
+def test_split_late_messages():
+    """
+    Function checking the messages of the files that cannot be transferred in time are released, but for
+    the first file of each slot and the messages with a file on time.
+    """
+    files = [
+        new_file("one", 10, "m1"),
+        new_file("two", 10, "m2"),
+        new_file("three", 50, "m3"),
+        new_file("four", 10, "m2"),
+        new_file("five", 100, "m4"),
+    ]
+    duration_of = lambda _file: _file.file_size
+    kept, released = split_late_messages(files, duration_of, concurrency=2)
+    assert kept == files and not released
+
+    kept, released = split_late_messages(files, duration_of, concurrency=2, deadline=40)
+    assert [_file.file_name for _file in kept] == ["one", "two", "four"]
+    assert [message.receipt_handle for message in released] == ["m3", "m4"]
+
+    kept, released = split_late_messages(
+        [new_file("huge", 1000)], duration_of, deadline=40
+    )
+    assert len(kept) == 1 and not released
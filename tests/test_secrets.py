@@ -0,0 +1,103 @@
+#  -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+from functools import lru_cache
+from os import path
+from tempfile import TemporaryDirectory
+from threading import current_thread, main_thread
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+import s3_to_sftp
+from s3_to_sftp import get_secret_validator, get_secrets, get_sftp_info
+from s3_to_sftp.secrets_cache import SecretsCache
+
+SECRET_PREFIX = "arn:aws:secretsmanager:eu-west-1:012345678912:secret:"
+SFTP_DETAILS = {"host": "sftp", "port": 22, "username": "user", "password": "secret"}
+
+
+class FakeSecretsManager:
+    def __init__(self, secrets):
+        self.secrets = secrets
+        self.fetched = []
+
+    def get_secret_value(self, SecretId):
+        self.fetched.append(SecretId)
+        return {"SecretString": self.secrets[SecretId]}
+
+
+@pytest.fixture
+def secrets_manager(monkeypatch):
+    client = FakeSecretsManager(
+        {
+            f"{SECRET_PREFIX}sftp-AbCdEf": json.dumps(SFTP_DETAILS),
+            f"{SECRET_PREFIX}key-AbCdEf": "PRIVATE KEY",
+        }
+    )
+    monkeypatch.setattr(s3_to_sftp, "get_secrets_manager_client", lambda: client)
+    return client
+
+
+def test_get_sftp_info(secrets_manager, monkeypatch):
+    """
+    Function checking the secrets are fetched once each, and the private key stored in the temp dir.
+    """
+    monkeypatch.setenv("SFTP_TARGET", f"{SECRET_PREFIX}sftp-AbCdEf")
+    monkeypatch.setenv("PRIVATE_KEY_SECRET_ARN", f"{SECRET_PREFIX}key-AbCdEf")
+    monkeypatch.delenv("PRIVATE_KEY_PASSPHRASE_SECRET_ARN", raising=False)
+    for key in SFTP_DETAILS:
+        monkeypatch.delenv(key, raising=False)
+    temp_dir = TemporaryDirectory()
+    sftp_info = get_sftp_info(temp_dir)
+    assert sorted(secrets_manager.fetched) == sorted(
+        [f"{SECRET_PREFIX}sftp-AbCdEf", f"{SECRET_PREFIX}key-AbCdEf"]
+    )
+    assert sftp_info["host"] == "sftp"
+    with open(sftp_info["private_key"]) as key_fd:
+        assert key_fd.read() == "PRIVATE KEY"
+    assert get_secret_validator() is get_secret_validator()
+
+
+def test_client_created_once(secrets_manager, monkeypatch):
+    """
+    Function checking the Secrets Manager client is created before fetching the secrets in parallel.
+    """
+    created_by = []
+
+    @lru_cache()
+    def get_client():
+        created_by.append(current_thread())
+        return secrets_manager
+
+    monkeypatch.setattr(s3_to_sftp, "get_secrets_manager_client", get_client)
+    get_secrets([f"{SECRET_PREFIX}sftp-AbCdEf", f"{SECRET_PREFIX}key-AbCdEf"])
+    assert created_by == [main_thread()]
+
+
+def test_secrets_cache(secrets_manager):
+    """
+    Function checking the secrets cached are not fetched again until expired, and the cache file private.
+    """
+    secret_arn = f"{SECRET_PREFIX}key-AbCdEf"
+    with TemporaryDirectory() as temp_dir:
+        cache_file = f"{temp_dir}/secrets.json"
+        assert get_secrets([secret_arn], cache_file=cache_file) == {
+            secret_arn: "PRIVATE KEY"
+        }
+        assert os.stat(cache_file).st_mode & 0o777 == 0o600
+        assert get_secrets([secret_arn], cache_file=cache_file) == {
+            secret_arn: "PRIVATE KEY"
+        }
+        assert secrets_manager.fetched == [secret_arn]
+        get_secrets([secret_arn], cache_file=cache_file, cache_ttl=0)
+        assert secrets_manager.fetched == [secret_arn, secret_arn]
+
+        with open(cache_file, "w") as cache_fd:
+            cache_fd.write("{")
+        assert SecretsCache(cache_file).load([secret_arn]) == {}
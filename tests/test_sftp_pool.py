@@ -0,0 +1,118 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from types import SimpleNamespace
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.sftp_pool import SFTPSessionPool
+
+
+class FakeTransport:
+    def __init__(self):
+        self.active = True
+        self.keepalive = None
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def close(self):
+        self.active = False
+
+
+class FakeSession:
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_channel(self):
+        return self
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+
+@pytest.fixture(autouse=True)
+def fake_connections(monkeypatch):
+    monkeypatch.setattr(
+        "s3_to_sftp.sftp_pool.get_sftp_connection",
+        lambda *args, **kwargs: FakeSession(),
+    )
+    monkeypatch.setattr(
+        "s3_to_sftp.sftp_pool.negotiated_transport_settings", lambda sftp_fd: {}
+    )
+
+
+def from_transport(transport):
+    session = FakeSession()
+    session.transport = transport
+    return session
+
+
+class FakePool(SFTPSessionPool):
+    """
+    Opens fake connections, failing the first ``failures`` attempts.
+    """
+
+    def __init__(self, failures=0, **kwargs):
+        super().__init__({"host": "sftp"}, health_check_interval=0, **kwargs)
+        self.failures = failures
+        self.attempts = 0
+
+    def new_connection(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("Unable to establish connection to SFTP server")
+        return super().new_connection()
+
+
+def test_reconnect_on_checkout():
+    """
+    Function checking a session whose transport died is replaced at checkout, retrying failed connections.
+    """
+    pool = FakePool(size=2, connections=2, keepalive=15, max_reconnect_delay=0)
+    with pool:
+        first = pool.sessions[0]
+        assert first.transport.keepalive == 15
+        first.transport.active = False
+        pool.failures = pool.attempts + 2
+        with pool.checkout() as sftp_fd:
+            assert sftp_fd is not first
+            assert sftp_fd.transport.is_active()
+        assert pool.reconnections == 1
+        assert pool.attempts == 5
+        assert first.closed
+
+
+def test_spares_replace_dead_transports(monkeypatch):
+    """
+    Function checking the spare connections are used first, and topped up by the health checks.
+    """
+    monkeypatch.setattr(
+        "s3_to_sftp.sftp_pool.SFTPClient",
+        SimpleNamespace(from_transport=from_transport),
+    )
+    pool = FakePool(spares=1)
+    with pool:
+        pool.check_connections()
+        spare = pool._spares.queue[0]
+        pool.transports[0].active = False
+        pool.check_connections()
+        assert pool.transports[0] is spare.transport
+        assert pool._spares.qsize() == 1
+        with pool.checkout() as sftp_fd:
+            assert sftp_fd.transport is spare.transport
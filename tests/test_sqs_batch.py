@@ -0,0 +1,113 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from types import SimpleNamespace
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.sqs_batch import SQSBatcher
+
+
+class FakeClient:
+    """
+    Fails the entries of the receipt handles set in ``failures``, with their sender fault flag.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.deleted = []
+        self.visibility = {}
+        self.calls = 0
+
+    def _respond(self, Entries, apply):
+        self.calls += 1
+        response = {"Successful": [], "Failed": []}
+        for entry in Entries:
+            if entry["ReceiptHandle"] in self.failures:
+                response["Failed"].append(
+                    {
+                        "Id": entry["Id"],
+                        "SenderFault": self.failures.pop(entry["ReceiptHandle"]),
+                        "Code": "Failure",
+                    }
+                )
+            else:
+                apply(entry)
+                response["Successful"].append({"Id": entry["Id"]})
+        return response
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        return self._respond(
+            Entries, lambda entry: self.deleted.append(entry["ReceiptHandle"])
+        )
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        return self._respond(
+            Entries,
+            lambda entry: self.visibility.update(
+                {entry["ReceiptHandle"]: entry["VisibilityTimeout"]}
+            ),
+        )
+
+
+def new_batcher(client):
+    return SQSBatcher(SimpleNamespace(meta=SimpleNamespace(client=client), url="url"))
+
+
+def message(index):
+    return SimpleNamespace(receipt_handle=f"handle-{index}")
+
+
+def test_flush_groups_by_ten():
+    """
+    Function checking deletions are sent 10 at a time, and supersede visibility changes.
+    """
+    client = FakeClient()
+    batcher = new_batcher(client)
+    for index in range(25):
+        batcher.change_visibility(message(index), 60)
+    for index in range(23):
+        batcher.delete(message(index))
+    batcher.change_visibility(message(0), 120)
+    assert batcher.flush() == []
+    assert len(client.deleted) == 23
+    assert client.visibility == {"handle-23": 60, "handle-24": 60}
+    assert client.calls == 4
+
+
+def test_partial_failures():
+    """
+    Function checking SQS side failures are retried on next flush, sender faults are returned.
+    """
+    client = FakeClient(failures={"handle-1": False, "handle-2": True})
+    batcher = new_batcher(client)
+    for index in range(3):
+        batcher.delete(message(index))
+    failed = batcher.flush()
+    assert [entry["ReceiptHandle"] for entry in failed] == ["handle-2"]
+    assert client.deleted == ["handle-0"]
+    assert batcher.flush() == []
+    assert client.deleted == ["handle-0", "handle-1"]
+
+
+def test_on_delete():
+    """
+    Function checking only the messages actually deleted are reported.
+    """
+    client = FakeClient(failures={"handle-1": False, "handle-2": True})
+    deleted = []
+    batcher = SQSBatcher(
+        SimpleNamespace(meta=SimpleNamespace(client=client), url="url"),
+        on_delete=lambda messages: deleted.extend(
+            message.receipt_handle for message in messages
+        ),
+    )
+    for index in range(3):
+        batcher.delete(message(index))
+    batcher.flush()
+    assert deleted == ["handle-0"]
+    batcher.flush()
+    assert deleted == ["handle-0", "handle-1"]
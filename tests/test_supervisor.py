@@ -0,0 +1,47 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from types import SimpleNamespace
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp import supervisor
+from s3_to_sftp.supervisor import Supervisor
+
+
+def test_restart_backoff(monkeypatch):
+    """
+    Function checking exited workers are restarted, later each time they exit shortly after starting.
+    """
+    now = [100.0]
+    monkeypatch.setattr(supervisor, "monotonic", lambda: now[0])
+    started = []
+    workers = Supervisor(2, "https://sqs/123456789012/queue", {})
+    workers.start_child = lambda index: (
+        started.append(index),
+        workers.children.__setitem__(
+            index, SimpleNamespace(pid=index, exitcode=1, is_alive=lambda: False)
+        ),
+        workers.started_at.__setitem__(index, now[0]),
+    )
+    workers.check_children()
+    assert started == [0, 1]
+    now[0] += 1
+    workers.check_children()
+    assert started == [0, 1]
+    assert workers.restarts == 2
+    now[0] += 1
+    workers.check_children()
+    assert started == [0, 1, 0, 1]
+    now[0] += 1
+    workers.check_children()
+    now[0] += 2
+    workers.check_children()
+    assert started == [0, 1, 0, 1]
+    now[0] += 1
+    workers.check_children()
+    assert started == [0, 1, 0, 1, 0, 1]
+    assert workers.queue_name == "queue"
@@ -0,0 +1,51 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.throughput import MB, ThroughputModel
+
+
+def test_rates_per_size_class():
+    """
+    Function checking rates are learned per size class, with fallback to the closest one.
+    """
+    model = ThroughputModel(default_rate=2)
+    assert model.rate_for(10 * MB) == 2
+    model.observe(100 * MB, 10)
+    assert model.rate_for(100 * MB) == 10
+    assert model.rate_for(50 * 1024 * MB) == 10
+    model.observe(100 * MB, 5)
+    assert 10 < model.rate_for(100 * MB) < 20
+    model.observe(1024, 0)
+    assert model.size_class(1024) not in model.rates
+
+
+def test_batch_size():
+    """
+    Function checking the batch size fits the time budget.
+    """
+    model = ThroughputModel()
+    assert model.batch_size(10, time_budget=30) == 10
+    model.observe(10 * MB, 5)
+    assert model.batch_size(10, time_budget=30) == 6
+    assert model.batch_size(10, time_budget=30, concurrency=4) == 10
+    assert model.batch_size(10, time_budget=1) == 1
+
+
+def test_state_file(tmp_path):
+    """
+    Function checking the model is restored from its state file.
+    """
+    state_file = f"{tmp_path}/state/rates.json"
+    model = ThroughputModel(state_file=state_file)
+    model.observe(200 * MB, 20)
+    model.save()
+    restored = ThroughputModel(state_file=state_file)
+    assert restored.rate_for(200 * MB) == 10
+    assert restored.large_file_threshold(512 * MB) == 1200 * MB
+    assert restored.large_file_threshold(0) == 0
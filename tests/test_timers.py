@@ -0,0 +1,70 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.timers import PhaseTimers, StartupClock, process_uptime
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.values = []
+
+    def put_metric(self, name, value, unit):
+        self.values.append((name, value, unit))
+
+
+def test_emit_and_render():
+    """
+    Function checking the durations are emitted once, and kept in the histograms.
+    """
+    timers = PhaseTimers()
+    timers.record("mkdir", 0.02)
+    timers.record("mkdir", 3)
+    assert list(timers.timed([1, 2, 3], "s3_download")) == [1, 2, 3]
+    metrics = FakeMetrics()
+    timers.emit(metrics)
+    assert ("MkdirDuration", 3.0, "Seconds") in metrics.values
+    assert len(metrics.values) == 3
+    metrics = FakeMetrics()
+    timers.emit(metrics)
+    assert not metrics.values
+
+    rendered = timers.render()
+    assert (
+        's3_to_sftp_phase_duration_seconds_bucket{phase="mkdir",le="0.01"} 0'
+        in rendered
+    )
+    assert (
+        's3_to_sftp_phase_duration_seconds_bucket{phase="mkdir",le="0.025"} 1'
+        in rendered
+    )
+    assert 's3_to_sftp_phase_duration_seconds_count{phase="mkdir"} 2' in rendered
+    assert 's3_to_sftp_phase_duration_seconds_count{phase="s3_download"} 1' in rendered
+    assert rendered.endswith("# EOF\n")
+
+
+def test_startup_clock():
+    """
+    Function checking the startup durations are emitted once, after the first byte is sent.
+    """
+    assert process_uptime() >= 0
+    clock = StartupClock()
+    clock.mark_ready()
+    metrics = FakeMetrics()
+    clock.emit(metrics)
+    assert not metrics.values
+    clock.mark_first_byte()
+    first_byte = clock.first_byte
+    clock.mark_first_byte()
+    assert clock.first_byte == first_byte >= clock.ready
+    clock.emit(metrics)
+    clock.emit(metrics)
+    assert [name for name, _, _ in metrics.values] == [
+        "StartupDuration",
+        "TimeToFirstByte",
+    ]
@@ -0,0 +1,97 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from json import dumps
+from os import path
+from types import SimpleNamespace
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.transfer_file import TransferMessage, get_files_information
+
+
+def s3_record(key, size=10, event_name="ObjectCreated:Put"):
+    return {
+        "eventName": event_name,
+        "s3": {
+            "bucket": {"name": "bucket"},
+            "object": {"key": key, "size": size, "eTag": f"etag-{key}"},
+        },
+    }
+
+
+def queue_message(body, message_id="message-id"):
+    return SimpleNamespace(
+        body=dumps(body), message_id=message_id, receipt_handle="handle"
+    )
+
+
+def test_s3_records():
+    """
+    Function checking all records are returned, with keys decoded, and only for created objects.
+    """
+    files = get_files_information(
+        dumps(
+            {
+                "Records": [
+                    s3_record("folder/my+file.txt"),
+                    s3_record("other", event_name="ObjectRemoved:Delete"),
+                    s3_record("second%21", size=20),
+                ]
+            }
+        )
+    )
+    assert [(file["object"], file["size"]) for file in files] == [
+        ("folder/my file.txt", 10),
+        ("second!", 20),
+    ]
+
+
+def test_envelopes():
+    """
+    Function checking SNS, EventBridge and test events are parsed.
+    """
+    sns = {"Type": "Notification", "Message": dumps({"Records": [s3_record("a")]})}
+    assert get_files_information(dumps(sns))[0]["object"] == "a"
+    eventbridge = {
+        "source": "aws.s3",
+        "detail-type": "Object Created",
+        "detail": {
+            "bucket": {"name": "bucket"},
+            "object": {"key": "b c", "size": 5, "etag": "etag"},
+        },
+    }
+    assert get_files_information(dumps(eventbridge)) == [
+        {
+            "bucket_name": "bucket",
+            "object": "b c",
+            "size": 5,
+            "etag": "etag",
+            "version_id": None,
+        }
+    ]
+    assert get_files_information(dumps({"Event": "s3:TestEvent"})) == []
+    with pytest.raises(TypeError):
+        get_files_information(dumps({"Records": "a"}))
+
+
+def test_message_units():
+    """
+    Function checking the message is complete only once all its files succeeded,
+    and completed files are skipped on redelivery.
+    """
+    body = {"Records": [s3_record("a"), s3_record("b"), s3_record("c")]}
+    completed_units = set()
+    transfer_message = TransferMessage(queue_message(body), completed_units)
+    file_a, file_b, file_c = transfer_message.files
+    assert not transfer_message.unit_done(file_a, True)
+    assert not transfer_message.unit_done(file_b, False)
+    assert not transfer_message.unit_done(file_c, True)
+
+    redelivered = TransferMessage(queue_message(body), completed_units)
+    assert [transfer_file.file_name for transfer_file in redelivered.files] == ["b"]
+    assert redelivered.unit_done(redelivered.files[0], True)
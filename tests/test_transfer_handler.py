@@ -0,0 +1,226 @@
+#  -*- coding: utf-8 -*-
+
+import socket
+import sys
+from os import path
+from types import SimpleNamespace
+
+import pytest
+from paramiko import ECDSAKey, RSAKey, Transport
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.transfer_handler import (
+    FileHandler,
+    RemoteDirectoryCache,
+    get_transport_options,
+    load_private_key,
+    read_ahead,
+    recursive_mkdir,
+    set_security_options,
+)
+
+
+class FakeSFTP:
+    """
+    Minimal in-memory SFTP client recording the calls made.
+    """
+
+    def __init__(self, existing=None):
+        self.directories = set(existing or ["/"])
+        self.calls = []
+
+    def stat(self, remote_path):
+        self.calls.append(("stat", remote_path))
+        if remote_path not in self.directories:
+            raise FileNotFoundError(remote_path)
+
+    def mkdir(self, remote_path):
+        self.calls.append(("mkdir", remote_path))
+        self.directories.add(remote_path)
+
+    def chdir(self, remote_path):
+        raise AssertionError("chdir must not be used")
+
+
+def test_recursive_mkdir_creates_parents():
+    """
+    Function checking the missing parent directories are created with full paths.
+    """
+    sftp = FakeSFTP(["/", "/upload"])
+    recursive_mkdir(sftp, "/upload/a/b/")
+    assert {"/upload/a", "/upload/a/b"} <= sftp.directories
+    assert [call for call in sftp.calls if call[0] == "mkdir"] == [
+        ("mkdir", "/upload/a"),
+        ("mkdir", "/upload/a/b"),
+    ]
+
+
+def test_recursive_mkdir_uses_cache():
+    """
+    Function checking a cached directory does not trigger any remote call.
+    """
+    sftp = FakeSFTP(["/", "/upload"])
+    cache = RemoteDirectoryCache()
+    recursive_mkdir(sftp, "/upload/a", cache)
+    sftp.calls.clear()
+    recursive_mkdir(sftp, "/upload/a", cache)
+    assert not sftp.calls
+
+
+def test_cache_discard_and_lru():
+    """
+    Function checking the cache invalidation and eviction.
+    """
+    cache = RemoteDirectoryCache(max_size=3)
+    for directory in ["/upload", "/upload/a", "/upload/a/b"]:
+        cache.add(directory)
+    cache.discard("/upload/a")
+    assert "/upload/a" not in cache
+    assert "/upload/a/b" not in cache
+    assert "/upload" not in cache
+
+    for directory in ["/x", "/y", "/z", "/w"]:
+        cache.add(directory)
+    assert "/x" not in cache
+    assert "/w" in cache
+
+
+def test_transport_options():
+    """
+    Function checking only the supported preferred algorithms are offered, in the order listed.
+    """
+    options = get_transport_options(
+        {
+            "transport": {
+                "ciphers": ["aes256-ctr", "unknown-cipher", "aes128-ctr"],
+                "macs": ["unknown-mac"],
+                "window_size": 8388608,
+            }
+        }
+    )
+    assert options["window_size"] == 8388608
+    assert not options["compress"]
+    with socket.socket() as sock:
+        transport = Transport(sock)
+        default_macs = transport.get_security_options().digests
+        set_security_options(transport, options)
+        security_options = transport.get_security_options()
+        assert security_options.ciphers == ("aes256-ctr", "aes128-ctr")
+        assert security_options.digests == default_macs
+
+
+def test_load_private_key(tmp_path):
+    """
+    Function checking the private keys are loaded whichever their type, with their passphrase.
+    """
+    for key in [RSAKey.generate(2048), ECDSAKey.generate()]:
+        key_file = str(tmp_path / key.get_name())
+        key.write_private_key_file(key_file, password="passphrase")
+        loaded = load_private_key(key_file, "passphrase")
+        assert type(loaded) is type(key)
+        assert loaded.get_fingerprint() == key.get_fingerprint()
+
+
+def test_read_ahead():
+    """
+    Function checking chunks are all read ahead in order, and errors are raised to the consumer.
+    """
+
+    def failing():
+        yield b"a"
+        raise OSError("connection reset")
+
+    assert list(read_ahead(iter([b"a", b"b", b"c"]), 2)) == [b"a", b"b", b"c"]
+    chunks = read_ahead(failing(), 1)
+    assert next(chunks) == b"a"
+    with pytest.raises(OSError):
+        next(chunks)
+
+
+class FakeRemoteFiles:
+    """
+    SFTP client with remote files of the given sizes, not supporting the check-file extension.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def stat(self, remote_path):
+        if remote_path not in self.sizes:
+            raise FileNotFoundError(remote_path)
+        return SimpleNamespace(st_size=self.sizes[remote_path])
+
+    def open(self, remote_path, mode):
+        raise OSError("Operation unsupported")
+
+
+def test_check_remote(tmp_path):
+    """
+    Function checking identical remote files are skipped, and partial ones resumed only if enabled.
+    """
+    sftp = FakeRemoteFiles({"/upload/a/full": 100, "/upload/a/partial": 40})
+
+    def check(key, resume):
+        transfer_file = SimpleNamespace(
+            file_size=100,
+            file_info={"etag": "d41d8cd98f00b204e9800998ecf8427e"},
+            file_transfer_status="PENDING",
+            resume_offset=0,
+        )
+        handler = FileHandler(
+            "bucket",
+            key,
+            SimpleNamespace(name=str(tmp_path)),
+            {"default_path": "upload"},
+            s3_client=object(),
+        )
+        handler.check_remote(sftp, transfer_file, resume=resume)
+        return transfer_file.file_transfer_status, transfer_file.resume_offset
+
+    assert check("a/full", resume=False) == ("SFTP_SKIPPED", 0)
+    assert check("a/partial", resume=False) == ("PENDING", 0)
+    assert check("a/partial", resume=True) == ("PENDING", 40)
+    assert check("a/missing", resume=True) == ("PENDING", 0)
+
+
+class FakeCheckedFile:
+    def __init__(self, md5):
+        self.md5 = md5
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def check(self, algorithm):
+        return bytes.fromhex(self.md5)
+
+
+def test_remote_checksum_encrypted(tmp_path):
+    """
+    Function checking the ETag of objects encrypted with SSE-KMS is not compared to the remote MD5.
+    """
+    etag = "d41d8cd98f00b204e9800998ecf8427e"
+    sftp = FakeRemoteFiles({"/upload/a/full": 100})
+    sftp.open = lambda remote_path, mode: FakeCheckedFile("0" * 32)
+    transfer_file = SimpleNamespace(file_size=100, file_info={"etag": etag})
+
+    def matches(encryption):
+        s3_object = {"ETag": f'"{etag}"', "ServerSideEncryption": encryption}
+        handler = FileHandler(
+            "bucket",
+            "a/full",
+            SimpleNamespace(name=str(tmp_path)),
+            {"default_path": "upload"},
+            s3_client=SimpleNamespace(head_object=lambda Bucket, Key: s3_object),
+        )
+        return handler.remote_checksum_matches(sftp, transfer_file)
+
+    assert matches("aws:kms")
+    assert not matches("AES256")
+    sftp.open = lambda remote_path, mode: FakeCheckedFile(etag)
+    assert matches("AES256")
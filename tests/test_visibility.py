@@ -0,0 +1,65 @@
+#  -*- coding: utf-8 -*-
+
+import sys
+from os import path
+from time import monotonic
+from types import SimpleNamespace
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+
+from s3_to_sftp.sqs_batch import batch_entries
+from s3_to_sftp.visibility import VisibilityHeartbeat
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.calls.append(Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+def fake_queue():
+    return SimpleNamespace(meta=SimpleNamespace(client=FakeClient()), url="queue-url")
+
+
+def fake_file(name):
+    transfer_file = SimpleNamespace(
+        file_name=name,
+        file_transfer_status="SFTP_IN_PROGRESS",
+        last_progress_time=monotonic(),
+        message=SimpleNamespace(receipt_handle=f"handle-{name}", message_id=name),
+    )
+    transfer_file.record_progress = lambda nbytes: setattr(
+        transfer_file, "last_progress_time", monotonic()
+    )
+    return transfer_file
+
+
+def test_batch_entries():
+    assert [len(batch) for batch in batch_entries(range(23))] == [10, 10, 3]
+    assert list(batch_entries([])) == []
+
+
+def test_heartbeat_extends_progressing_files_only():
+    """
+    Function checking stalled files are no longer extended, and all others are, in batches of 10.
+    """
+    queue = fake_queue()
+    heartbeat = VisibilityHeartbeat(queue, interval=5)
+    files = [fake_file(f"file-{index}") for index in range(12)]
+    for transfer_file in files:
+        heartbeat.track(transfer_file)
+    files[0].last_progress_time -= heartbeat.stall_timeout + 1
+    heartbeat.untrack(files[1])
+
+    heartbeat.beat()
+    calls = queue.meta.client.calls
+    assert [len(call) for call in calls] == [10]
+    handles = {entry["ReceiptHandle"] for entry in calls[0]}
+    assert "handle-file-0" not in handles
+    assert "handle-file-1" not in handles
+    assert all(entry["VisibilityTimeout"] == 15 for entry in calls[0])
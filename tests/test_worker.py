@@ -0,0 +1,245 @@
+#  -*- coding: utf-8 -*-
+
+import json
+import sys
+from os import makedirs, path
+from queue import Queue
+from threading import current_thread
+
+import pytest
+
+here = path.abspath(path.dirname(__file__))
+there = path.abspath(f"{here}/..")
+sys.path.insert(0, there)
+sys.path.insert(0, f"{there}/benchmarks")
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from sftp_server import LocalSFTPServer
+
+from s3_to_sftp.sqs_batch import SQSBatcher
+from s3_to_sftp.transfer_handler import FileHandler
+from s3_to_sftp.worker import Worker
+
+BUCKET = "source-bucket"
+REMOTE_PATH = "/upload"
+
+
+class CountingSession:
+    """
+    Session counting the clients and resources created, by service.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.created = []
+
+    def client(self, service_name, **kwargs):
+        self.created.append(service_name)
+        return self.session.client(service_name, **kwargs)
+
+    def resource(self, service_name, **kwargs):
+        self.created.append(service_name)
+        return self.session.resource(service_name, **kwargs)
+
+
+class Environment:
+    def __init__(self, session, sftp_root):
+        self.session = session
+        self.sftp_root = sftp_root
+        self.s3 = session.client("s3")
+        self.sqs = session.client("sqs")
+        self.s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+        )
+        self.queue_url = self.sqs.create_queue(QueueName="transfers")["QueueUrl"]
+
+    def put_object(self, key, body):
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    def send(self, key, size):
+        self.send_files({key: size})
+
+    def send_files(self, files: dict):
+        """
+        Sends one message for all the ``files``, by key with their size.
+        """
+        records = [
+            {"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": size}}}
+            for key, size in files.items()
+        ]
+        self.sqs.send_message(
+            QueueUrl=self.queue_url, MessageBody=json.dumps({"Records": records})
+        )
+
+    def messages_left(self) -> int:
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=["All"]
+        )["Attributes"]
+        return int(attributes["ApproximateNumberOfMessages"]) + int(
+            attributes["ApproximateNumberOfMessagesNotVisible"]
+        )
+
+    def remote_file(self, key):
+        remote_path = f"{self.sftp_root}{REMOTE_PATH}/{key}"
+        if not path.exists(remote_path):
+            return None
+        with open(remote_path, "rb") as remote_fd:
+            return remote_fd.read()
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_EMF_ENVIRONMENT", "Local")
+    sftp_root = tmp_path / "sftp"
+    sftp_root.mkdir()
+    server = LocalSFTPServer(str(sftp_root)).start()
+    with moto.mock_aws():
+        env = Environment(boto3.session.Session(), str(sftp_root))
+        env.sftp_info = dict(server.connection_details, default_path=REMOTE_PATH)
+        yield env
+    server.stop()
+
+
+def new_worker(environment, **kwargs) -> Worker:
+    worker = Worker(environment.queue_url, environment.sftp_info, environment.session)
+    worker.prepare(**kwargs)
+    worker.sqs_batcher = SQSBatcher(worker.queue)
+    return worker
+
+
+def process_batch(worker, **kwargs) -> None:
+    queue_messages = worker.queue.receive_messages(
+        MaxNumberOfMessages=10, AttributeNames=["SentTimestamp"]
+    )
+    files_transfers = [
+        transfer_file
+        for transfer_message in worker.get_transfer_messages(queue_messages)
+        for transfer_file in transfer_message.files
+    ]
+    worker.transfer_files_to_sftp(files_transfers, **kwargs)
+
+
+def test_missing_object_not_acknowledged(environment):
+    """
+    Function checking a file that could not be pulled from S3 is not sent, nor its message deleted.
+    """
+    environment.send("missing.csv", 10)
+    worker = new_worker(environment)
+    with worker.router:
+        process_batch(worker)
+    assert environment.remote_file("missing.csv") is None
+    assert environment.messages_left() == 1
+
+
+def test_failed_files_released(environment):
+    """
+    Function checking the messages of the files failed without a transfer are visible again right away.
+    """
+    environment.put_object("unsent.csv", b"a,b\n")
+    environment.send("unsent.csv", 4)
+    worker = new_worker(environment)
+    queue_messages = worker.queue.receive_messages(
+        MaxNumberOfMessages=10, VisibilityTimeout=600
+    )
+    files_transfers = [
+        transfer_file
+        for transfer_message in worker.get_transfer_messages(queue_messages)
+        for transfer_file in transfer_message.files
+    ]
+    worker.fail_files(files_transfers, "SFTP target unreachable")
+    worker.sqs_batcher.flush()
+    assert len(worker.queue.receive_messages(MaxNumberOfMessages=10)) == 1
+
+
+def test_concurrent_files_accounting(environment):
+    """
+    Function checking the files transferred concurrently are counted each, and only the messages with
+    all their files transferred deleted.
+    """
+    sizes = {"ok-1.csv": 100, "ok-2.csv": 2000, "ok-3.csv": 30}
+    for key, size in sizes.items():
+        environment.put_object(key, b"x" * size)
+    environment.send("ok-1.csv", 100)
+    environment.send("ok-2.csv", 2000)
+    environment.send("missing-1.csv", 10)
+    environment.send_files({"ok-3.csv": 30, "missing-2.csv": 10})
+    worker = new_worker(environment, concurrency=3)
+    worker.stats_queue = Queue()
+    threads = set()
+    transfer_file = worker.transfer_file
+
+    def record_thread(file_to_transfer, **kwargs):
+        threads.add(current_thread().name)
+        return transfer_file(file_to_transfer, **kwargs)
+
+    worker.transfer_file = record_thread
+    with worker.router:
+        process_batch(worker, concurrency=3)
+    assert threads and all(name.startswith("transfer") for name in threads)
+    assert worker.stats_queue.get_nowait() == {
+        "files_processed": 5,
+        "files_failed": 2,
+        "total_files_size": sum(sizes.values()),
+    }
+    for key, size in sizes.items():
+        assert environment.remote_file(key) == b"x" * size
+    assert environment.messages_left() == 2
+
+
+def test_clients_reused(environment):
+    """
+    Function checking the queue, its attributes and the S3 client are reused across batches.
+    """
+    environment.session = CountingSession(environment.session)
+    worker = new_worker(environment)
+    queue_attributes = []
+    worker.queue.meta.client.meta.events.register(
+        "before-call.sqs.GetQueueAttributes",
+        lambda **kwargs: queue_attributes.append(kwargs),
+    )
+    handlers_clients = []
+    transfer_file = worker.transfer_file
+
+    def record_client(file_to_transfer, **kwargs):
+        handlers_clients.append(file_to_transfer.file_handler.s3_client)
+        return transfer_file(file_to_transfer, **kwargs)
+
+    worker.transfer_file = record_client
+    with worker.router:
+        for key in ["first.csv", "second.csv"]:
+            environment.put_object(key, b"a,b\n")
+            environment.send(key, 4)
+            process_batch(worker)
+            assert environment.remote_file(key) == b"a,b\n"
+    assert sorted(environment.session.created) == ["s3", "sqs"]
+    assert handlers_clients == [worker.s3_client, worker.s3_client]
+    assert len(queue_attributes) == 1
+
+
+def test_large_file_resumed_in_order(environment, monkeypatch):
+    """
+    Function checking a partial remote file is completed in order, rather than in ranges, even if large.
+    """
+
+    def push_ranges(*args, **kwargs):
+        raise AssertionError("partial files must not be completed in ranges")
+
+    monkeypatch.setattr(FileHandler, "push_ranges", push_ranges)
+    body = bytes(range(256)) * 8
+    environment.put_object("large.bin", body)
+    environment.send("large.bin", len(body))
+    remote_path = f"{environment.sftp_root}{REMOTE_PATH}/large.bin"
+    makedirs(path.dirname(remote_path))
+    with open(remote_path, "wb") as remote_fd:
+        remote_fd.write(body[:1000])
+    worker = new_worker(environment)
+    with worker.router:
+        process_batch(worker, existing_files="resume", large_file_threshold=0.001)
+    assert environment.remote_file("large.bin") == body
+    assert environment.messages_left() == 0